@@ -0,0 +1,150 @@
+import hashlib
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from financeqa.app.schema import ReferencedResponse
+from financeqa.indexing.manifest import IndexManifest
+from financeqa.retrieval.metadata_filtering import Response
+
+
+class CachedAnswer:
+    def __init__(self, embedding: np.ndarray, response: ReferencedResponse, expires_at: float, versions: dict):
+        self.embedding = embedding
+        self.response = response
+        self.expires_at = expires_at
+        self.versions = versions
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        manifest_path: str | Path,
+        threshold: float = 0.95,
+        ttl: float = 3600.0,
+        max_entries_per_scope: int = 256,
+    ):
+        """Cache of the answers to previous questions, looked up by the similarity of the question embeddings.
+
+        Answers are scoped by the documents the question is about, so that a similar question about another filing
+        never gets the cached answer. They are invalidated when one of these documents is re-indexed, or for the
+        questions about no document in particular when any document is, according to the index manifest written by
+        `populate_db`.
+
+        Args:
+            manifest_path: path of the index manifest
+            threshold: minimum cosine similarity between the questions for a cached answer to be returned
+            ttl: number of seconds after which a cached answer expires
+            max_entries_per_scope: maximum number of answers cached per set of documents
+        """
+        self.manifest_path = Path(manifest_path)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries_per_scope = max_entries_per_scope
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._lock = threading.Lock()
+        self._entries: dict[tuple[str, ...], list[CachedAnswer]] = {}
+        self._manifest = IndexManifest()
+        self._manifest_mtime: Optional[float] = None
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __str__(self) -> str:
+        num_entries = sum(len(entries) for entries in self._entries.values())
+        return (
+            f"{num_entries} answers in {len(self._entries)} scopes, {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate), {self.invalidations} invalidations"
+        )
+
+    @staticmethod
+    def get_scope(extracted_metadata: Response) -> tuple[str, ...]:
+        """Get the scope of a question, i.e. the names of the documents it is about
+
+        Args:
+            extracted_metadata: the documents extracted from the question
+
+        Returns:
+            the sorted document names
+        """
+        return tuple(sorted({f"{doc.year} {doc.quarter} {doc.ticker}" for doc in extracted_metadata.list_of_docs}))
+
+    def _get_versions(self, scope: tuple[str, ...]) -> dict[str, str]:
+        # the manifest is only re-read when populate_db rewrote it
+        mtime = self.manifest_path.stat().st_mtime if self.manifest_path.exists() else None
+        if mtime != self._manifest_mtime:
+            self._manifest = IndexManifest.load(self.manifest_path)
+            self._manifest_mtime = mtime
+
+        # unfiltered questions are answered from the whole index, so any re-indexing invalidates their answers
+        if len(scope) == 0:
+            return {"": self._manifest.get_digest()}
+
+        versions = {}
+        for doc_name in scope:
+            entry = self._manifest.documents.get(doc_name)
+            entry_json = entry.model_dump_json() if entry is not None else ""
+            versions[doc_name] = hashlib.sha256(f"{self._manifest.config_hash}{entry_json}".encode()).hexdigest()
+
+        return versions
+
+    def get(self, embedding: list[float], scope: tuple[str, ...]) -> Optional[ReferencedResponse]:
+        """Look up the answer to a similar question about the same documents
+
+        Args:
+            embedding: embedding of the question
+            scope: the documents the question is about
+
+        Returns:
+            the cached answer, None if there is none
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        now = time.time()
+
+        with self._lock:
+            versions = self._get_versions(scope)
+            entries = self._entries.get(scope, [])
+
+            valid = [entry for entry in entries if entry.expires_at > now and entry.versions == versions]
+            self.invalidations += sum(1 for entry in entries if entry.versions != versions)
+            self._entries[scope] = valid
+
+            if len(valid) > 0:
+                similarities = np.stack([entry.embedding for entry in valid]) @ query
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    return valid[best].response
+
+            self.misses += 1
+            return None
+
+    def put(self, embedding: list[float], scope: tuple[str, ...], response: ReferencedResponse):
+        """Store the answer to a question
+
+        Args:
+            embedding: embedding of the question
+            scope: the documents the question is about
+            response: the answer
+        """
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+
+        with self._lock:
+            entry = CachedAnswer(vector, response, time.time() + self.ttl, self._get_versions(scope))
+            entries = self._entries.setdefault(scope, [])
+            entries.append(entry)
+
+            # the oldest answers are dropped first
+            del entries[: -self.max_entries_per_scope]
@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 from dotenv import load_dotenv
 from fastapi import FastAPI
@@ -5,10 +7,20 @@ from starlette.responses import RedirectResponse
 
 from financeqa.app.routers.chat import chat
 from financeqa.app.routers.health import health
+from financeqa.app.startup import warmup
 
 load_dotenv()
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the app serves its liveness probe while the models are loaded, and its queries once they are
+    warmup.start()
+    yield
+    warmup.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(chat.router)
 app.include_router(health.router)
 
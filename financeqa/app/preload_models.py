@@ -0,0 +1,40 @@
+import time
+
+import click
+
+from financeqa.db.embeddings import build_embeddings
+from financeqa.retrieval.context_assembly import load_token_counter
+from financeqa.retrieval.reranking import Reranker
+from financeqa.settings import hf_settings, retrieval_settings, startup_settings
+
+
+@click.command()
+def main():
+    """Download the models loaded by the app at startup (embeddings, reranker, tokenizer) into MODEL_CACHE_DIR, e.g.
+    when building its image, so that the app loads them from disk instead of the Hugging Face Hub.
+    """
+    if not startup_settings.model_cache_dir:
+        raise click.UsageError("MODEL_CACHE_DIR isn't set")
+
+    start = time.perf_counter()
+    build_embeddings()
+    print(f"embedding model: {time.perf_counter() - start:.1f}s")
+
+    if retrieval_settings.rerank:
+        start = time.perf_counter()
+        Reranker(model_name=retrieval_settings.rerank_model, cache_dir=startup_settings.model_cache_dir)
+        print(f"reranker: {time.perf_counter() - start:.1f}s")
+
+    if retrieval_settings.context_tokenizer:
+        start = time.perf_counter()
+        token = hf_settings.api_key.get_secret_value() if hf_settings.api_key is not None else None
+        load_token_counter(
+            retrieval_settings.context_tokenizer, token=token, cache_dir=startup_settings.model_cache_dir
+        )
+        print(f"tokenizer: {time.perf_counter() - start:.1f}s")
+
+    print(f"models cached in {startup_settings.model_cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
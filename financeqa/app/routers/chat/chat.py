@@ -1,73 +1,356 @@
+import asyncio
+import json
 import logging
+import re
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from langchain_core.documents import Document as LangChainDocument
-from langchain_core.vectorstores import VectorStoreRetriever
 
-from financeqa.app.routers.chat.prompt import SYSTEM_MESSAGE
-from financeqa.app.schema import Message, ReferencedResponse
+from financeqa.app.answer_cache import SemanticAnswerCache
+from financeqa.app.routers.chat.prompt import STREAMING_SYSTEM_MESSAGE, SYSTEM_MESSAGE
+from financeqa.app.schema import Message, ReferencedDoc, ReferencedResponse
 from financeqa.app.security import get_current_api_key
-from financeqa.constants import DOC_ROOT, TOP_K, MessageType
-from financeqa.db.vector_store import get_vs
+from financeqa.app.startup import require_ready, warmup
+from financeqa.constants import DB_DOC_NAME_KEY, DOC_ROOT, GENERATOR_MODEL_NAME, TOP_K, MessageType
+from financeqa.db.vector_store import get_partition_router
+from financeqa.generate.base_inference_client import BaseInferenceClient
+from financeqa.generate.coalescing import CoalescingInferenceClient
 from financeqa.generate.hf_inference import HFChatCompletion
+from financeqa.retrieval.bm25_index import BM25Index, matches_filter
+from financeqa.retrieval.concurrent_search import ConcurrentSearcher, SearchTimeoutError
+from financeqa.retrieval.context_assembly import ContextAssembler, approximate_token_count, load_token_counter
+from financeqa.retrieval.document_routing import DocumentRouter, DocumentRoutingIndex
+from financeqa.retrieval.extraction_cache import ExtractionCache
+from financeqa.retrieval.metadata_filtering import Response as ExtractedMetadata
 from financeqa.retrieval.metadata_filtering import generate_combined_search_kwargs  # type: ignore
-from financeqa.retrieval.metadata_filtering import extract_search_kwargs, generate_separated_kwargs
-from financeqa.settings import hf_settings
-from financeqa.utils import format_docs_for_context, get_document_ids
+from financeqa.retrieval.metadata_filtering import (
+    RuleBasedMetadataExtractor,
+    extract_search_kwargs,
+    generate_separated_kwargs,
+)
+from financeqa.retrieval.reranking import Reranker
+from financeqa.settings import (
+    answer_cache_settings,
+    hf_settings,
+    inference_settings,
+    retrieval_settings,
+    startup_settings,
+)
+from financeqa.utils import get_document_ids
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 
+ANSWER_CACHE_HEADER = "X-Answer-Cache"
+CONTEXT_TOKENS_HEADER = "X-Context-Tokens"
+# references as formatted by `format_doc_for_context`, cited in the streamed answers
+REFERENCE_RE = re.compile(r"Reference: (?P<doc>\d{4} Q[1-4] [A-Z]+), page (?P<page>\d+)")
+
 router = APIRouter()
-vector_store = get_vs()
-generator = HFChatCompletion(hf_settings.api_key.get_secret_value())
-doc_ids = get_document_ids(
-    doc_root=DOC_ROOT
-)  # depending the usage of the app, this can be moved to be dynamically retrieved
+
+# the components below are loaded in the background by the warmup, started by the lifespan of the app, the optional
+# ones are used in a degraded version until then: no reranking and approximate token counts
+searcher: ConcurrentSearcher = None  # type: ignore
+reranker: Optional[Reranker] = None
+generator: BaseInferenceClient = None  # type: ignore
+context_assembler = ContextAssembler(approximate_token_count, max_tokens=retrieval_settings.context_max_tokens)
+doc_ids: list[str] = []
+rule_based_extractor: RuleBasedMetadataExtractor = None  # type: ignore
+document_router: Optional[DocumentRouter] = None
+
+extraction_cache = ExtractionCache(
+    max_entries=retrieval_settings.extraction_cache_size,
+    ttl=retrieval_settings.extraction_cache_ttl,
+    db_path=retrieval_settings.extraction_cache_path,
+)
+answer_cache = (
+    SemanticAnswerCache(
+        answer_cache_settings.manifest_path,
+        threshold=answer_cache_settings.threshold,
+        ttl=answer_cache_settings.ttl,
+        max_entries_per_scope=answer_cache_settings.max_entries_per_scope,
+    )
+    if answer_cache_settings.enabled
+    else None
+)
+
+
+@warmup.component("searcher")
+def load_searcher():
+    """Load the embedding model, connect to the vector store and load the BM25 index"""
+    global searcher
+
+    lexical_index = None
+    if retrieval_settings.hybrid_search:
+        if Path(retrieval_settings.bm25_index_path).exists():
+            lexical_index = BM25Index.load(retrieval_settings.bm25_index_path)
+        else:
+            logger.warning(f"No BM25 index at {retrieval_settings.bm25_index_path}, falling back to dense search only")
+
+    searcher = ConcurrentSearcher(
+        get_partition_router(),
+        max_concurrency=retrieval_settings.max_concurrency,
+        timeout=retrieval_settings.search_timeout,
+        queue_timeout=retrieval_settings.search_queue_timeout,
+        lexical_index=lexical_index,
+    )
+
+
+@warmup.component("reranker", required=False)
+def load_reranker():
+    """Load the cross-encoder of the reranker"""
+    global reranker
+
+    reranker = (
+        Reranker(
+            model_name=retrieval_settings.rerank_model,
+            budget_ms=retrieval_settings.rerank_budget_ms,
+            cache_dir=startup_settings.model_cache_dir or None,
+        )
+        if retrieval_settings.rerank
+        else None
+    )
+
+
+@warmup.component("generator")
+def load_generator():
+    """Build the inference client of the LLM"""
+    global generator
+
+    if hf_settings.api_key is None:
+        raise ValueError("HF_API_KEY is required by the generator")
+
+    # concurrent identical queries and extraction prompts share a single LLM call
+    generator = (
+        CoalescingInferenceClient(HFChatCompletion(hf_settings.api_key.get_secret_value()))
+        if inference_settings.coalesce
+        else HFChatCompletion(hf_settings.api_key.get_secret_value())
+    )
+
+
+@warmup.component("context_assembler", required=False)
+def load_context_assembler():
+    """Load the tokenizer of the generator"""
+    global context_assembler
+
+    context_assembler = ContextAssembler(
+        load_token_counter(
+            retrieval_settings.context_tokenizer,
+            token=hf_settings.api_key.get_secret_value() if hf_settings.api_key is not None else None,
+            cache_dir=startup_settings.model_cache_dir or None,
+        ),
+        max_tokens=retrieval_settings.context_max_tokens,
+    )
+
+
+@warmup.component("documents")
+def load_documents():
+    """List the documents and load the routing index"""
+    global doc_ids, rule_based_extractor, document_router
+
+    # depending the usage of the app, this can be moved to be dynamically retrieved
+    doc_ids = get_document_ids(doc_root=DOC_ROOT)
+    rule_based_extractor = RuleBasedMetadataExtractor(doc_ids)
+
+    if retrieval_settings.document_routing:
+        if Path(retrieval_settings.routing_index_path).exists():
+            document_router = DocumentRouter(
+                DocumentRoutingIndex.load(retrieval_settings.routing_index_path),
+                top_k=retrieval_settings.routing_top_k,
+                min_score=retrieval_settings.routing_min_score,
+                min_margin=retrieval_settings.routing_min_margin,
+                prompt_k=retrieval_settings.routing_prompt_k,
+            )
+        else:
+            logger.warning(
+                f"No routing index at {retrieval_settings.routing_index_path}, documents are routed by the LLM"
+            )
+
+
+async def extract_metadata(query: str) -> ExtractedMetadata:
+    """Extract the documents the query is about
+
+    Args:
+        query: the query
+
+    Returns:
+        the extracted documents
+    """
+    # the query embedding is shared with the searches of the request
+    query_embedding = await searcher.embed_query(query) if document_router is not None else None
+    extracted_search_kwargs = await extract_search_kwargs(
+        doc_ids,
+        query,
+        generator=generator,
+        cache=extraction_cache,
+        rule_based_extractor=rule_based_extractor,
+        document_router=document_router,
+        query_embedding=query_embedding,
+    )
+    logger.debug(f"Extraction cache: {extraction_cache}")
+
+    return extracted_search_kwargs
 
 
-async def get_context_documents(query: str) -> list[LangChainDocument]:
+async def get_answer_cache_key(query: str) -> tuple[list[float], tuple[str, ...]]:
+    """Get the key of the query in the answer cache, i.e. its embedding and the documents it is about
+
+    Args:
+        query: the query
+
+    Returns:
+        the query embedding and the scope
+    """
+    embedding, extracted_metadata = await asyncio.gather(searcher.embed_query(query), extract_metadata(query))
+    return embedding, SemanticAnswerCache.get_scope(extracted_metadata)
+
+
+def start_speculative_search(query: str) -> Optional[asyncio.Task]:
+    """Start the unfiltered search of the query, before its metadata is extracted, if speculative search is enabled
+
+    Args:
+        query: the query
+
+    Returns:
+        the task of the search, to be passed to `get_context_documents` or cancelled with `cancel_speculative_search`
+    """
+    if not retrieval_settings.speculative_search:
+        return None
+
+    # dense only, the lexical search of each filter is cheap and fused with the post-filtered candidates
+    return asyncio.ensure_future(searcher.search(query, [{"k": retrieval_settings.speculative_k}], dense_only=True))
+
+
+def cancel_speculative_search(speculative_search: Optional[asyncio.Task]):
+    """Cancel a speculative search whose candidates are not needed, e.g. because the answer was cached
+
+    Args:
+        speculative_search: the task of the search
+    """
+    if speculative_search is None:
+        return
+
+    speculative_search.cancel()
+    # the search may already have failed, its exception is not reported as never retrieved
+    speculative_search.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+
+def filter_speculative_candidates(
+    candidates: list[LangChainDocument], search_kwargs: dict[str, Any]
+) -> Optional[list[LangChainDocument]]:
+    """Get the results of a filtered dense search from the candidates of the unfiltered dense search
+
+    The candidates are sorted by similarity, so the first `k` candidates matching the filter are the results of the
+    filtered dense search, as long as there are `k` of them. With hybrid search, they are still to be fused with the
+    filtered lexical search.
+
+    Args:
+        candidates: the candidates of the unfiltered dense search, best first
+        search_kwargs: `k` and optionally the `filter` of the search
+
+    Returns:
+        the results, None if the candidates don't cover the search
+    """
+    search_filter = search_kwargs.get("filter")
+    matched = [doc for doc in candidates if not search_filter or matches_filter(doc.metadata, search_filter)]
+
+    return matched[: search_kwargs["k"]] if len(matched) >= search_kwargs["k"] else None
+
+
+async def get_context_documents(
+    query: str, speculative_search: Optional[asyncio.Task] = None
+) -> list[LangChainDocument]:
     """Get context documents for the query
 
+    If speculative search is enabled, an unfiltered dense search runs while the metadata is extracted, and its
+    candidates are post-filtered by the extracted documents (and fused with the filtered lexical search). Only the
+    searches that the candidates don't cover are then sent to the vector store.
+
     Args:
         query: the query
+        speculative_search: the unfiltered search of the query, if already started by `start_speculative_search`
 
     Returns:
         the context documents
     """
-    logger.info("Extracting search kwargs.")
-    extracted_search_kwargs = await extract_search_kwargs(doc_ids, query, generator=generator)
-    logger.debug(f"Extracted search kwargs: {extracted_search_kwargs}")
+    if speculative_search is None:
+        speculative_search = start_speculative_search(query)
+
+    try:
+        logger.info("Extracting search kwargs.")
+        extracted_search_kwargs = await extract_metadata(query)
+        logger.debug(f"Extracted search kwargs: {extracted_search_kwargs}")
+    except BaseException:
+        cancel_speculative_search(speculative_search)
+        raise
 
     logger.info("Generating separated kwargs for Chroma search.")
-    chroma_search_kwargs = generate_separated_kwargs(extracted_search_kwargs)
+    # unfiltered queries are searched on the whole global collection
+    chroma_search_kwargs = generate_separated_kwargs(extracted_search_kwargs) or [{}]
     logger.debug(f"Chroma search kwargs: {chroma_search_kwargs}")
 
     individual_k = TOP_K // len(chroma_search_kwargs) + 1
+    if reranker is not None:
+        # over-fetch the candidates, the re-ranker keeps the best TOP_K of them
+        individual_k *= retrieval_settings.rerank_overfetch
     logger.debug(f"Calculated individual_k: {individual_k}")
 
-    context_docs = []
     for search_kwargs in chroma_search_kwargs:
         search_kwargs["k"] = individual_k
-        retriever = VectorStoreRetriever(vectorstore=vector_store, search_kwargs=search_kwargs)
 
-        logger.info(f"Invoking retriever for search kwargs: {search_kwargs}")
-        documents = retriever.invoke(query)
-        # documents = retriever.similarity_search_with_score(query, k=individual_k, **search_kwargs)
-        logger.debug(f"Retrieved documents: {documents}")
+    covered: list[Optional[list[LangChainDocument]]] = [None] * len(chroma_search_kwargs)
+    if speculative_search is not None:
+        try:
+            candidates = (await speculative_search)[0]
+            covered = [
+                filter_speculative_candidates(candidates, search_kwargs) for search_kwargs in chroma_search_kwargs
+            ]
+        except Exception as e:
+            logger.warning(f"Speculative search failed, searching with the filters: {str(e)}")
+
+    results = [documents if documents is not None else [] for documents in covered]
+    uncovered = [i for i, documents in enumerate(covered) if documents is None]
+    logger.debug(f"Speculative candidates cover {len(covered) - len(uncovered)}/{len(covered)} searches")
+
+    covered_indices = [i for i, documents in enumerate(covered) if documents is not None]
+    fused = await asyncio.gather(
+        *(searcher.fuse_lexical_search(query, results[i], chroma_search_kwargs[i]) for i in covered_indices)
+    )
+    for i, documents in zip(covered_indices, fused, strict=True):
+        results[i] = documents
+
+    if len(uncovered) > 0:
+        uncovered_search_kwargs = [chroma_search_kwargs[i] for i in uncovered]
+        logger.info(f"Searching concurrently for search kwargs: {uncovered_search_kwargs}")
+        for i, documents in zip(uncovered, await searcher.search(query, uncovered_search_kwargs), strict=True):
+            results[i] = documents
+
+    context_docs = []
+    for search_kwargs, documents in zip(chroma_search_kwargs, results, strict=True):
+        logger.debug(f"Retrieved documents for search kwargs {search_kwargs}: {documents}")
         context_docs.extend(documents)
 
-    # ideally we would filter, rank and return the top k documents here
-    logger.debug(f"Final documents: {documents}")
+    if len(context_docs) == 0:
+        # the answer is generated without context, most likely from a filter matching no chunk
+        logger.warning(f"No documents were retrieved for search kwargs: {chroma_search_kwargs}")
+
+    if reranker is not None:
+        logger.info("Re-ranking the retrieved documents.")
+        context_docs = await asyncio.to_thread(reranker.rerank, query, results, TOP_K)
+
+    logger.debug(f"Final documents: {context_docs}")
     return context_docs
 
 
 @router.post(
     "/query",
     response_model=ReferencedResponse,
-    dependencies=[Depends(get_current_api_key)],
+    dependencies=[Depends(get_current_api_key), Depends(require_ready)],
 )
-async def query(message_input: list[Message]):
+async def query(message_input: list[Message], response: Response):
     # Log input messages
     logger.debug(f"Received input messages: {message_input}")
 
@@ -75,10 +358,26 @@ async def query(message_input: list[Message]):
     last_message = message_input[-1].message
     logger.debug(f"Processing last message: {last_message}")
 
+    speculative_search = None
     try:
-        context_docs = await get_context_documents(last_message)
-        docs_string = format_docs_for_context(context_docs)
+        answer_cache_key: Optional[tuple[list[float], tuple[str, ...]]] = None
+        if answer_cache is not None:
+            # the speculative search runs while the metadata is extracted for the answer cache lookup
+            speculative_search = start_speculative_search(last_message)
+            answer_cache_key = await get_answer_cache_key(last_message)
+            cached_answer = answer_cache.get(*answer_cache_key)
+            logger.debug(f"Answer cache: {answer_cache}")
+
+            response.headers[ANSWER_CACHE_HEADER] = "hit" if cached_answer is not None else "miss"
+            if cached_answer is not None:
+                logger.info("Returning cached answer.")
+                return cached_answer
+
+        context_docs = await get_context_documents(last_message, speculative_search)
+        docs_string, num_context_tokens = context_assembler.assemble(context_docs)
+        logger.info(f"Assembled context of {num_context_tokens} tokens.")
         logger.debug(f"Formatted documents string: {docs_string[:500]}")  # Log only the first 500 characters
+        response.headers[CONTEXT_TOKENS_HEADER] = str(num_context_tokens)
 
         prompt = SYSTEM_MESSAGE.format(context=docs_string)
         messages = [
@@ -88,14 +387,178 @@ async def query(message_input: list[Message]):
         logger.debug(f"Generated messages: {messages}")
 
         logger.info("Sending messages to generator for completions.")
-        response = await generator.get_completions(
-            messages, model_name="meta-llama/Meta-Llama-3-8B-Instruct", response_pydantic_type=ReferencedResponse
+        answer = await generator.get_completions(
+            messages, model_name=GENERATOR_MODEL_NAME, response_pydantic_type=ReferencedResponse
         )
         logger.info("Response successfully generated.")
-        logger.debug(f"Generator response: {response}")
+        if isinstance(generator, CoalescingInferenceClient):
+            logger.debug(f"LLM call coalescing: {generator}")
+        logger.debug(f"Generator response: {answer}")
+
+        if answer_cache is not None and answer_cache_key is not None:
+            answer_cache.put(*answer_cache_key, answer)
 
-        return response
+        return answer
 
+    except SearchTimeoutError as e:
+        logger.error(f"Search timed out: {str(e)}")
+        raise HTTPException(
+            status_code=503, detail="The search timed out, please retry", headers={"Retry-After": "1"}
+        ) from e
     except Exception as e:
         logger.error(f"Unexpected error occurred: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="An unexpected server error occurred") from e
+    finally:
+        # no-op if the speculative search was awaited
+        cancel_speculative_search(speculative_search)
+
+
+def get_references(answer: str, context_docs: list[LangChainDocument]) -> list[ReferencedDoc]:
+    """Get the references of a streamed answer, i.e. the context documents it cites
+
+    Args:
+        answer: the answer
+        context_docs: the context documents
+
+    Returns:
+        the cited pages, or all the context pages if the answer doesn't cite any
+    """
+    cited = {(match.group("doc"), int(match.group("page"))) for match in REFERENCE_RE.finditer(answer)}
+
+    references = {}
+    for doc in context_docs:
+        key = (doc.metadata[DB_DOC_NAME_KEY], int(doc.metadata["page_number"]))
+        if key in references or (len(cited) > 0 and key not in cited):
+            continue
+
+        references[key] = ReferencedDoc(
+            year=doc.metadata["year"],
+            quarter=doc.metadata["quarter"],
+            company=doc.metadata["ticker"],
+            page=doc.metadata["page_number"],
+        )
+
+    return list(references.values())
+
+
+async def stream_completions(messages: list[dict[str, str]]) -> AsyncIterator[str]:
+    """Stream the completions of the generator, at once if its client can't stream
+
+    Args:
+        messages: the messages of the prompt
+
+    Yields:
+        the text of the answer, as it is generated
+    """
+    client = generator.client if isinstance(generator, CoalescingInferenceClient) else generator
+    if callable(getattr(client, "stream_completions", None)):
+        async for token in generator.stream_completions(messages, model_name=GENERATOR_MODEL_NAME):
+            yield token
+        return
+
+    # e.g. the Hugging Face client, the whole answer is a single token
+    yield await generator.get_completions(messages, model_name=GENERATOR_MODEL_NAME)
+
+
+def format_event(event: str, data: dict[str, Any]) -> str:
+    """Format a server-sent event
+
+    Args:
+        event: name of the event
+        data: data of the event, sent as JSON
+
+    Returns:
+        the event
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_answer(
+    query: str,
+    cached_answer: Optional[ReferencedResponse],
+    answer_cache_key: Optional[tuple[list[float], tuple[str, ...]]],
+    speculative_search: Optional[asyncio.Task] = None,
+) -> AsyncIterator[str]:
+    """Stream the answer to the query as server-sent events: a `token` event per generated chunk of text, followed by a
+    `references` event, or an `error` event if the generation fails
+
+    Args:
+        query: the query
+        cached_answer: cached answer to the query, streamed at once if not None
+        answer_cache_key: key of the query in the answer cache, the answer is not cached if None
+        speculative_search: the unfiltered search of the query, if already started by `start_speculative_search`
+
+    Yields:
+        the events
+    """
+    if cached_answer is not None:
+        cancel_speculative_search(speculative_search)
+        yield format_event("token", {"token": cached_answer.response})
+        yield format_event("references", {"references": [ref.model_dump() for ref in cached_answer.references]})
+        return
+
+    try:
+        context_docs = await get_context_documents(query, speculative_search)
+        docs_string, num_context_tokens = context_assembler.assemble(context_docs)
+        logger.info(f"Assembled context of {num_context_tokens} tokens.")
+        prompt = STREAMING_SYSTEM_MESSAGE.format(context=docs_string)
+        messages = [
+            {"role": MessageType.SYSTEM.value, "content": prompt},
+            {"role": MessageType.USER.value, "content": query},
+        ]
+
+        logger.info("Streaming completions from generator.")
+        tokens = []
+        async for token in stream_completions(messages):
+            tokens.append(token)
+            yield format_event("token", {"token": token})
+
+        answer = "".join(tokens)
+        references = get_references(answer, context_docs)
+        yield format_event("references", {"references": [ref.model_dump() for ref in references]})
+        logger.info("Response successfully streamed.")
+
+        if answer_cache is not None and answer_cache_key is not None:
+            answer_cache.put(*answer_cache_key, ReferencedResponse(response=answer, references=references))
+    except SearchTimeoutError as e:
+        logger.error(f"Search timed out: {str(e)}")
+        yield format_event("error", {"detail": "The search timed out, please retry"})
+    except Exception as e:
+        # the response status is already sent, the error is reported as an event
+        logger.error(f"Unexpected error occurred: {str(e)}", exc_info=True)
+        yield format_event("error", {"detail": "An unexpected server error occurred"})
+    finally:
+        cancel_speculative_search(speculative_search)
+
+
+@router.post(
+    "/query/stream",
+    dependencies=[Depends(get_current_api_key), Depends(require_ready)],
+)
+async def query_stream(message_input: list[Message]) -> StreamingResponse:
+    logger.debug(f"Received input messages: {message_input}")
+
+    last_message = message_input[-1].message
+    logger.debug(f"Processing last message: {last_message}")
+
+    headers = {}
+    cached_answer = None
+    answer_cache_key = None
+    speculative_search = None
+
+    try:
+        if answer_cache is not None:
+            speculative_search = start_speculative_search(last_message)
+            answer_cache_key = await get_answer_cache_key(last_message)
+            cached_answer = answer_cache.get(*answer_cache_key)
+            headers[ANSWER_CACHE_HEADER] = "hit" if cached_answer is not None else "miss"
+    except Exception as e:
+        cancel_speculative_search(speculative_search)
+        logger.error(f"Unexpected error occurred: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An unexpected server error occurred") from e
+
+    return StreamingResponse(
+        stream_answer(last_message, cached_answer, answer_cache_key, speculative_search),
+        media_type="text/event-stream",
+        headers=headers,
+    )
@@ -1,6 +1,8 @@
-from typing import Dict
+from typing import Any, Dict
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+
+from financeqa.app.startup import warmup
 
 router = APIRouter()
 
@@ -8,7 +10,19 @@ router = APIRouter()
 @router.get("/health")
 async def health() -> Dict[str, str]:
     """
-    Health check endpoint.
+    Liveness check endpoint, answering as soon as the app is started.
     """
-    # ideally check the database connection here
     return {"status": "alive"}
+
+
+@router.get("/health/ready")
+async def ready(response: Response) -> Dict[str, Any]:
+    """
+    Readiness check endpoint, answering 503 until all the required components of the app are loaded, with the loading
+    status and time of each of them.
+    """
+    status = warmup.get_status()
+    if not warmup.is_ready:
+        response.status_code = 503
+
+    return status
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import httpx
+import requests
+from fastapi import HTTPException
+
+from financeqa.settings import startup_settings
+
+logger = logging.getLogger(__name__)
+
+# errors a component may recover from by itself, e.g. the database or the Hugging Face Hub being unreachable
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, httpx.TransportError, requests.ConnectionError, requests.Timeout)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Check whether an error may go away by retrying, rather than being caused by the configuration or the code
+
+    Args:
+        error: the error
+
+    Returns:
+        whether the error is transient
+    """
+    # the clients often wrap the connection errors, e.g. chromadb raises a ValueError when the server is down
+    seen = set()
+    current: Optional[BaseException] = error
+    while current is not None and id(current) not in seen:
+        if isinstance(current, TRANSIENT_ERRORS):
+            return True
+        seen.add(id(current))
+        current = current.__cause__ or current.__context__
+
+    return False
+
+
+class Warmup:
+    def __init__(self, max_workers: int = 4, retry_interval: float = 10.0):
+        """Loads the components of the app (models, indexes, clients...) in background threads, so that importing the
+        app is fast, its liveness probe answers at once and a missing dependency doesn't crash it.
+
+        The components are loaded concurrently, once. The ones failing with a transient error, e.g. because the
+        database isn't up yet, are retried every `retry_interval` seconds until they load or the warmup is stopped.
+        The other errors, e.g. a wrong model name or a missing API key, aren't retried. The app is ready once all
+        the required components are loaded, the optional ones keep their fallback until they are.
+
+        Args:
+            max_workers: number of components loaded at once
+            retry_interval: number of seconds between two attempts to load the failed components
+        """
+        self.max_workers = max_workers
+        self.retry_interval = retry_interval
+
+        # loading time of each loaded component, in seconds
+        self.timings: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        # components failing with a non transient error, not retried
+        self.failed: set[str] = set()
+
+        self._loaders: dict[str, Callable[[], None]] = {}
+        self._required: set[str] = set()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started_at: Optional[float] = None
+
+    def component(self, name: str, required: bool = True) -> Callable[[Callable[[], None]], Callable[[], None]]:
+        """Register the function loading a component, as a decorator
+
+        Args:
+            name: name of the component
+            required: whether the app can't answer without the component, else it falls back to a degraded version
+                of it until it is loaded
+
+        Returns:
+            the decorator
+        """
+
+        def register(load: Callable[[], None]) -> Callable[[], None]:
+            self._loaders[name] = load
+            if required:
+                self._required.add(name)
+            return load
+
+        return register
+
+    def mark_loaded(self, name: str):
+        """Mark a component as loaded without loading it, e.g. because it was replaced
+
+        Args:
+            name: name of the component
+        """
+        self.timings[name] = 0.0
+        self.errors.pop(name, None)
+        self.failed.discard(name)
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    @property
+    def has_failed(self) -> bool:
+        """Whether a required component failed to load with a non transient error, so the app will never be ready"""
+        return not self.is_ready and len(self._required & self.failed) > 0
+
+    def start(self):
+        """Start loading the components not loaded yet in the background, unless it is already running"""
+        with self._lock:
+            if self.is_ready or (self._thread is not None and self._thread.is_alive()):
+                return
+
+            self._stopped.clear()
+            self._started_at = time.perf_counter()
+            self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop retrying the failed components, the ones being loaded still finish"""
+        self._stopped.set()
+
+    def _load(self, name: str):
+        start = time.perf_counter()
+        try:
+            self._loaders[name]()
+        except Exception as e:
+            self.errors[name] = str(e) or type(e).__name__
+            if not is_transient_error(e):
+                self.failed.add(name)
+            logger.exception(f"Failed to load {name}")
+            return
+
+        self.timings[name] = time.perf_counter() - start
+        self.errors.pop(name, None)
+        logger.info(f"Loaded {name} in {self.timings[name]:.2f}s")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            pending = [name for name in self._loaders if name not in self.timings and name not in self.failed]
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="warmup") as executor:
+                list(executor.map(self._load, pending))
+
+            if not self.is_ready and self._required <= set(self.timings):
+                self._ready.set()
+                logger.info(f"Ready in {time.perf_counter() - self._started_at:.2f}s")  # type: ignore
+
+            for name in self.failed - self._required:
+                logger.warning(f"Failed to load {name}, running without it: {self.errors[name]}")
+            if self.has_failed:
+                failed = ", ".join(sorted(self._required & self.failed))
+                logger.error(f"Failed to load {failed}, the app won't be ready until it is fixed and restarted")
+                return
+
+            retried = [name for name in self._loaders if name not in self.timings and name not in self.failed]
+            if len(retried) == 0:
+                return
+
+            logger.warning(f"Failed to load {', '.join(retried)}, retrying in {self.retry_interval:g}s")
+            self._stopped.wait(self.retry_interval)
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait until the app is ready
+
+        Args:
+            timeout: maximum number of seconds to wait
+
+        Returns:
+            whether the app is ready
+        """
+        # polled rather than waiting for the event in a thread, which would hold a thread per waiting request
+        deadline = time.monotonic() + timeout
+        while not self.is_ready and not self.has_failed and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        return self.is_ready
+
+    def get_status(self) -> dict[str, Any]:
+        """Get the readiness of the app and the loading status of each component
+
+        Returns:
+            the status
+        """
+        components: dict[str, dict[str, Any]] = {}
+        for name in self._loaders:
+            if name in self.timings:
+                components[name] = {"status": "loaded", "seconds": round(self.timings[name], 3)}
+            elif name in self.failed:
+                components[name] = {"status": "failed", "error": self.errors[name]}
+            elif name in self.errors:
+                components[name] = {"status": "retrying", "error": self.errors[name]}
+            else:
+                components[name] = {"status": "loading"}
+            components[name]["required"] = name in self._required
+
+        status = "ready" if self.is_ready else "failed" if self.has_failed else "loading"
+        return {"status": status, "components": components}
+
+
+warmup = Warmup(max_workers=startup_settings.max_workers, retry_interval=startup_settings.retry_interval)
+
+
+async def require_ready():
+    """Wait for the app to be ready before handling a request, answering 503 if it isn't within the startup wait
+    timeout
+
+    Raises:
+        HTTPException: if the app isn't ready
+    """
+    if not await warmup.wait(startup_settings.wait_timeout):
+        if warmup.has_failed:
+            raise HTTPException(status_code=503, detail="The app failed to start")
+        raise HTTPException(status_code=503, detail="The app is starting", headers={"Retry-After": "5"})
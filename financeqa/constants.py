@@ -11,6 +11,17 @@ class OpenAIProvider(Enum):
     OPENAI_AZURE = "openai_azure"
 
 
+class ChromaDBMode(Enum):
+    HTTP = "http"
+    PERSISTENT = "persistent"
+    EPHEMERAL = "ephemeral"
+
+
+class EmbeddingBackend(Enum):
+    TORCH = "torch"
+    ONNX = "onnx"
+
+
 class TextExtractionType(Enum):
     PDF = "pdf"
     PDF_MARKDOWN = "pdf_markdown"
@@ -18,7 +29,25 @@ class TextExtractionType(Enum):
 
 DB_DOC_NAME_KEY = "db_document_name"
 DOC_ROOT = "./data/docs/pdf/"
+INDEX_MANIFEST_PATH = "./data/index_manifest.json"
+BM25_INDEX_PATH = "./data/bm25_index"
+ROUTING_INDEX_PATH = "./data/routing_index.npz"
+QUANTIZED_INDEX_PATH = "./data/quantized_index"
 COLLECTION_NAME = "financeqa-documents"
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+# int8 dynamically quantized exports of the embedding model, per instruction set (arm64, avx2, avx512, avx512_vnni)
+ONNX_QUANTIZED_MODEL_FILE = "onnx/model_qint8_{quantization}.onnx"
+# collection metadata storing the id of the embedding model the chunks were embedded with
+EMBEDDING_MODEL_METADATA_KEY = "embedding_model"
+GENERATOR_MODEL_NAME = "meta-llama/Meta-Llama-3-8B-Instruct"
 NODE_PARSER_CHUNK_SIZE = 512
 NODE_PARSER_CHUNK_OVERLAP = 10
 TOP_K = 9
+
+TICKER_TO_NAME_MAP = {
+    "AAPL": "Apple",
+    "AMZN": "Amazon",
+    "INTC": "Intel",
+    "MSFT": "Microsoft",
+    "NVDA": "Nvidia",
+}
@@ -2,6 +2,7 @@ import chromadb
 from chromadb.config import Settings
 from chromadb.api.client import Client
 
+from financeqa.constants import ChromaDBMode
 from financeqa.settings import chroma_db_settings
 
 
@@ -11,12 +12,37 @@ class ChromaDBClient:
     def __new__(cls, *args, **kwargs):
         """Create a new instance of the ChromaDB client, applying the singleton pattern"""
         if cls._instance is None:
-            cls._instance = super(ChromaDBClient, cls).__new__(cls)
-            cls._instance._initialize_client()
+            # only kept once initialized, so that a failed initialization is retried by the next call
+            instance = super(ChromaDBClient, cls).__new__(cls)
+            instance._initialize_client()
+            cls._instance = instance
         return cls._instance
 
     def _initialize_client(self):
-        """Initialize the ChromaDB client"""
+        """Initialize the ChromaDB client, either connecting to a Chroma server or running Chroma in-process
+
+        Raises:
+            ValueError: If the settings of the configured mode are missing
+        """
+        mode = chroma_db_settings.db_mode
+
+        if mode == ChromaDBMode.PERSISTENT:
+            self.client = chromadb.PersistentClient(
+                path=chroma_db_settings.db_local_path, settings=Settings(anonymized_telemetry=False)
+            )
+            return
+
+        if mode == ChromaDBMode.EPHEMERAL:
+            self.client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+            return
+
+        if (
+            chroma_db_settings.db_host is None
+            or chroma_db_settings.db_port is None
+            or chroma_db_settings.db_token is None
+        ):
+            raise ValueError("CHROMA_DB_HOST, CHROMA_DB_PORT and CHROMA_DB_TOKEN are required in http mode")
+
         self.client = chromadb.HttpClient(
             host=chroma_db_settings.db_host,
             port=chroma_db_settings.db_port,
@@ -0,0 +1,199 @@
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# maximum number of keys looked up per query, below the default limit of variables of SQLite
+LOOKUP_BATCH_SIZE = 500
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str | Path, max_entries: int = 200_000, flush_interval: float = 30.0):
+        """Persistent, size bounded embedding cache.
+
+        The embeddings are stored in a SQLite database keyed on the hash of the model and the text, so the cache can
+        be shared by all the processes (populate_db, the uvicorn workers...) using the same directory: a lookup can
+        only return the embedding stored for its own key. When the cache is full the least recently used entries
+        are evicted.
+
+        Args:
+            cache_dir: directory to store the cache in
+            max_entries: maximum number of embeddings to store
+            flush_interval: minimum number of seconds between two writes of the last use of the entries to disk
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # last use of the entries hit since the last flush, written in batches to not write on every lookup
+        self._last_used: dict[bytes, float] = {}
+        self._last_flush = time.monotonic()
+
+        # writers of other processes are waited for rather than failing with "database is locked"
+        self._db = sqlite3.connect(str(self._db_path), timeout=60.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, embedding BLOB, last_used REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+        atexit.register(self.flush)
+
+    @property
+    def _db_path(self) -> Path:
+        return self.cache_dir / "embeddings.sqlite"
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self)}/{self.max_entries} entries, {self.hits} hits, {self.misses} misses "
+            f"({self.hit_rate:.1%} hit rate), {self.evictions} evictions"
+        )
+
+    def get_many(self, keys: list[bytes]) -> list[Optional[np.ndarray]]:
+        """Look up the embeddings of the given keys
+
+        Args:
+            keys: keys to look up
+
+        Returns:
+            the embeddings, None for the keys that are not in the cache
+        """
+        found: dict[bytes, np.ndarray] = {}
+        now = time.time()
+
+        with self._lock:
+            for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[start : start + LOOKUP_BATCH_SIZE]
+                rows = self._db.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch
+                )
+                for key, embedding in rows:
+                    found[key] = np.frombuffer(embedding, dtype=np.float32).copy()
+
+            for key in keys:
+                if key in found:
+                    self.hits += 1
+                    self._last_used[key] = now
+                else:
+                    self.misses += 1
+
+        if time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, keys: list[bytes], embeddings: list[list[float]]):
+        """Store the embeddings of the given keys, evicting the least recently used entries if the cache is full
+
+        Args:
+            keys: keys of the embeddings
+            embeddings: the embeddings
+        """
+        if len(keys) == 0:
+            return
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        now = time.time()
+        rows = [(key, vector.tobytes(), now) for key, vector in zip(keys, vectors, strict=True)][: self.max_entries]
+
+        with self._lock:
+            # the insertion and the eviction are a single transaction, exclusive across processes
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)", rows
+                )
+
+                num_evicted = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+                if num_evicted > 0:
+                    self._db.execute(
+                        "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (num_evicted,),
+                    )
+                    self.evictions += num_evicted
+
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def flush(self):
+        """Write the last use of the entries hit since the last flush to disk"""
+        with self._lock:
+            if len(self._last_used) > 0:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    self._db.executemany(
+                        "UPDATE embeddings SET last_used = MAX(last_used, ?) WHERE key = ?",
+                        [(last_used, key) for key, last_used in self._last_used.items()],
+                    )
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+                self._last_used.clear()
+
+            self._last_flush = time.monotonic()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        """Embeddings that are looked up in the cache before being computed by the underlying model
+
+        Args:
+            embeddings: the underlying embedding model
+            cache: the embedding cache
+            model_name: name of the underlying model, part of the cache key
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def _key(self, text: str, kind: str) -> bytes:
+        # queries and documents are embedded differently by some models, so they don't share entries
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{text}".encode("utf-8")).digest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text, "document") for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if len(missing) > 0:
+            vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            self.cache.put_many([keys[i] for i in missing], vectors)
+
+            for i, vector in zip(missing, vectors, strict=True):
+                cached[i] = np.asarray(vector, dtype=np.float32)
+
+        return [vector.tolist() for vector in cached]  # type: ignore
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._key(text, "query")
+        cached = self.cache.get_many([key])[0]
+
+        if cached is not None:
+            return cached.tolist()
+
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many([key], [vector])
+
+        return vector
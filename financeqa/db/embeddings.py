@@ -0,0 +1,73 @@
+from typing import Any, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from financeqa.constants import EMBEDDING_MODEL_NAME, ONNX_QUANTIZED_MODEL_FILE, EmbeddingBackend
+from financeqa.db.embedding_cache import CachedEmbeddings, EmbeddingCache
+from financeqa.settings import embedding_settings, startup_settings
+
+
+def get_embedding_model_id(backend: EmbeddingBackend, onnx_quantization: Optional[str] = None) -> str:
+    """Get the id of the embedding model run by a backend, which differs from the model name if its embeddings may
+    differ from those of the PyTorch model
+
+    Args:
+        backend: the backend
+        onnx_quantization: instruction set of the int8 quantized ONNX model, full precision if None
+
+    Returns:
+        the id of the model
+    """
+    if backend == EmbeddingBackend.TORCH:
+        return EMBEDDING_MODEL_NAME
+
+    return f"{EMBEDDING_MODEL_NAME}:{backend.value}" + (f"-qint8-{onnx_quantization}" if onnx_quantization else "")
+
+
+def build_embeddings(
+    encode_kwargs: Optional[dict[str, Any]] = None,
+    backend: Optional[EmbeddingBackend] = None,
+    onnx_quantization: Optional[str] = None,
+) -> Embeddings:
+    """Build the embedding model used for both the documents and the queries, wrapped in the persistent embedding
+    cache if a cache directory is configured
+
+    Args:
+        encode_kwargs: additional arguments passed to the model when encoding
+        backend: backend running the model, PyTorch or onnxruntime, the configured one if None
+        onnx_quantization: instruction set of the int8 quantized ONNX model, the configured one if None and the
+            backend isn't given either
+
+    Returns:
+        the embedding model
+    """
+    # imported here, so that importing the app doesn't import torch
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    if backend is None:
+        backend = embedding_settings.backend
+        onnx_quantization = embedding_settings.onnx_quantization or None
+
+    model_kwargs: dict[str, Any] = {}
+    if backend == EmbeddingBackend.ONNX:
+        # the exports published with the model, `onnx/model.onnx` being exported on the fly if it is missing
+        model_kwargs["backend"] = "onnx"
+        model_kwargs["model_kwargs"] = {"provider": "CPUExecutionProvider"}
+        if onnx_quantization:
+            model_kwargs["model_kwargs"]["file_name"] = ONNX_QUANTIZED_MODEL_FILE.format(quantization=onnx_quantization)
+    elif torch.cuda.is_available():
+        model_kwargs["device"] = "cuda"
+
+    embeddings = HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        cache_folder=startup_settings.model_cache_dir or None,
+        model_kwargs=model_kwargs,
+        encode_kwargs=encode_kwargs or {},
+    )
+
+    if not embedding_settings.cache_dir:
+        return embeddings
+
+    cache = EmbeddingCache(embedding_settings.cache_dir, max_entries=embedding_settings.cache_max_entries)
+    return CachedEmbeddings(embeddings, cache, model_name=get_embedding_model_id(backend, onnx_quantization))
@@ -0,0 +1,226 @@
+import threading
+import time
+from typing import Any, Optional
+
+from chromadb.api.client import Client
+from chromadb.api.models.Collection import Collection
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from financeqa.constants import COLLECTION_NAME, DB_DOC_NAME_KEY
+
+PARTITION_FIELDS = ("year", "quarter", "ticker")
+PARTITION_PREFIX = f"{COLLECTION_NAME}-"
+
+
+def get_partition_name(metadata: dict[str, Any]) -> str:
+    """Get the name of the collection holding the chunks of a single document
+
+    Args:
+        metadata: metadata containing the year, quarter and ticker of the document
+
+    Returns:
+        the collection name
+    """
+    return f"{PARTITION_PREFIX}{metadata['ticker']}-{metadata['year']}-{metadata['quarter']}"
+
+
+def get_partition_filter_values(search_filter: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    """Get the year, quarter and ticker of a filter that selects exactly one document
+
+    Args:
+        search_filter: the Chroma filter, as generated by `generate_separated_kwargs`
+
+    Returns:
+        the year, quarter and ticker, None if the filter does not select exactly one document
+    """
+    if search_filter is None:
+        return None
+
+    if set(search_filter) == {"$and"}:
+        conditions = search_filter["$and"]
+    else:
+        conditions = [{field: value} for field, value in search_filter.items()]
+
+    values = {}
+    for condition in conditions:
+        if len(condition) != 1:
+            return None
+
+        field, value = next(iter(condition.items()))
+        if isinstance(value, dict):
+            if list(value) != ["$eq"]:
+                return None
+            value = value["$eq"]
+
+        values[field] = value
+
+    if set(values) != set(PARTITION_FIELDS):
+        return None
+
+    return values
+
+
+def list_partitions(client: Client) -> set[str]:
+    """List the names of the per document collections
+
+    Args:
+        client: ChromaDB client
+
+    Returns:
+        the collection names
+    """
+    # depending on the chromadb version, list_collections returns the names or the collections
+    names = [getattr(collection, "name", collection) for collection in client.list_collections()]
+    return {name for name in names if name.startswith(PARTITION_PREFIX)}  # type: ignore
+
+
+class PartitionRouter:
+    def __init__(
+        self, client: Client, embeddings: Embeddings, global_vector_store: VectorStore, refresh_interval: float = 60.0
+    ):
+        """Routes searches that select a single document to the collection holding only that document.
+
+        Filtered HNSW search degrades when the filter is very selective, searching the (small) collection of the
+        document avoids that. Searches that don't select a single document, or whose document has no collection,
+        go to the global collection.
+
+        Args:
+            client: ChromaDB client
+            embeddings: embedding model
+            global_vector_store: vector store of the global collection
+            refresh_interval: number of seconds after which the list of partitions is refreshed
+        """
+        self.client = client
+        self.embeddings = embeddings
+        self.global_vector_store = global_vector_store
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._partitions: set[str] = set()
+        self._vector_stores: dict[str, VectorStore] = {}
+        self._last_refresh = float("-inf")
+
+    def _get_partitions(self) -> set[str]:
+        with self._lock:
+            if time.monotonic() - self._last_refresh > self.refresh_interval:
+                self._partitions = list_partitions(self.client)
+                self._vector_stores = {name: vs for name, vs in self._vector_stores.items() if name in self._partitions}
+                self._last_refresh = time.monotonic()
+
+            return self._partitions
+
+    def route(self, search_kwargs: dict[str, Any]) -> tuple[VectorStore, dict[str, Any]]:
+        """Get the vector store to search and the search kwargs to use on it
+
+        Args:
+            search_kwargs: search kwargs, optionally containing a filter
+
+        Returns:
+            the vector store and the search kwargs, without the filter if it is implied by the vector store
+        """
+        values = get_partition_filter_values(search_kwargs.get("filter"))
+        if values is None:
+            return self.global_vector_store, search_kwargs
+
+        name = get_partition_name(values)
+        if name not in self._get_partitions():
+            return self.global_vector_store, search_kwargs
+
+        with self._lock:
+            if name not in self._vector_stores:
+                self._vector_stores[name] = Chroma(
+                    collection_name=name, embedding_function=self.embeddings, client=self.client
+                )
+            vector_store = self._vector_stores[name]
+
+        return vector_store, {key: value for key, value in search_kwargs.items() if key != "filter"}
+
+
+class PartitionedCollection:
+    def __init__(self, client: Client, collection: Collection, partitioned: bool = True):
+        """Writes chunks to the global collection and, if partitioned, also to the collection of their document
+
+        Args:
+            client: ChromaDB client
+            collection: the global collection
+            partitioned: whether to also write the chunks to the per document collections
+        """
+        self.client = client
+        self.collection = collection
+        self.partitioned = partitioned
+        self._partitions: dict[str, Collection] = {}
+
+    def _get_partition(self, name: str) -> Collection:
+        if name not in self._partitions:
+            self._partitions[name] = self.client.get_or_create_collection(name, metadata=self.collection.metadata)
+
+        return self._partitions[name]
+
+    def _group_by_partition(self, metadatas: list[dict]) -> dict[str, list[int]]:
+        groups: dict[str, list[int]] = {}
+        for i, metadata in enumerate(metadatas):
+            groups.setdefault(get_partition_name(metadata), []).append(i)
+
+        return groups
+
+    def upsert(self, ids: list[str], embeddings: list[list[float]], metadatas: list[dict], documents: list[str]):
+        """Upsert the chunks
+
+        Args:
+            ids: ids of the chunks
+            embeddings: embeddings of the chunks
+            metadatas: metadata of the chunks
+            documents: text of the chunks
+        """
+        self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)  # type: ignore
+
+        if not self.partitioned:
+            return
+
+        for name, indices in self._group_by_partition(metadatas).items():
+            self._get_partition(name).upsert(
+                ids=[ids[i] for i in indices],
+                embeddings=[embeddings[i] for i in indices],  # type: ignore
+                metadatas=[metadatas[i] for i in indices],
+                documents=[documents[i] for i in indices],
+            )
+
+    def update(self, ids: list[str], metadatas: list[dict]):
+        """Update the metadata of the chunks
+
+        Args:
+            ids: ids of the chunks
+            metadatas: new metadata of the chunks
+        """
+        self.collection.update(ids=ids, metadatas=metadatas)  # type: ignore
+
+        if not self.partitioned:
+            return
+
+        for name, indices in self._group_by_partition(metadatas).items():
+            self._get_partition(name).update(ids=[ids[i] for i in indices], metadatas=[metadatas[i] for i in indices])
+
+    def delete_document(self, doc_metadata: dict[str, Any], page_numbers: Optional[list[int]] = None):
+        """Delete the chunks of a document
+
+        Args:
+            doc_metadata: metadata of the document, containing its name, year, quarter and ticker
+            page_numbers: only delete the chunks of these pages, all of them if None
+        """
+        where: dict[str, Any] = {DB_DOC_NAME_KEY: {"$eq": doc_metadata[DB_DOC_NAME_KEY]}}
+        if page_numbers is not None:
+            where = {"$and": [where, {"page_number": {"$in": page_numbers}}]}
+
+        self.collection.delete(where=where)
+
+        name = get_partition_name(doc_metadata)
+        if name not in list_partitions(self.client):
+            return
+
+        if page_numbers is None:
+            self.client.delete_collection(name)
+            self._partitions.pop(name, None)
+        else:
+            self._get_partition(name).delete(where=where)
@@ -1,10 +1,43 @@
-import torch
+import logging
+from pathlib import Path
+
+from chromadb.api.client import Client
 from langchain_chroma import Chroma
 from langchain_core.vectorstores import VectorStore
-from langchain_huggingface import HuggingFaceEmbeddings
 
-from financeqa.constants import COLLECTION_NAME
+from financeqa.constants import COLLECTION_NAME, EMBEDDING_MODEL_METADATA_KEY
 from financeqa.db.db import get_db_client
+from financeqa.db.embeddings import build_embeddings, get_embedding_model_id
+from financeqa.db.partitions import PartitionRouter
+from financeqa.retrieval.quantized_index import QuantizedVectorIndex, StaleIndexError
+from financeqa.settings import answer_cache_settings, embedding_settings, retrieval_settings
+
+logger = logging.getLogger(__name__)
+
+
+def check_embedding_model(client: Client):
+    """Check that the queries are embedded with the model the stored chunks were embedded with
+
+    Args:
+        client: ChromaDB client
+
+    Raises:
+        ValueError: if the chunks were embedded with another model, or another backend of the model
+    """
+    # depending on the chromadb version, list_collections returns the names or the collections
+    names = [getattr(collection, "name", collection) for collection in client.list_collections()]
+    if COLLECTION_NAME not in names:
+        return
+
+    model_id = get_embedding_model_id(embedding_settings.backend, embedding_settings.onnx_quantization or None)
+    indexed_model_id = (client.get_collection(COLLECTION_NAME).metadata or {}).get(EMBEDDING_MODEL_METADATA_KEY)
+    if indexed_model_id is None:
+        logger.warning(f"Unknown embedding model of {COLLECTION_NAME}, assuming {model_id}")
+    elif indexed_model_id != model_id:
+        raise ValueError(
+            f"The chunks were embedded with {indexed_model_id} but the queries would be embedded with {model_id}, "
+            "set EMBEDDING_BACKEND and EMBEDDING_ONNX_QUANTIZATION like populate_db or re-index the documents"
+        )
 
 
 class VectorStoreClient:
@@ -13,24 +46,39 @@ class VectorStoreClient:
     def __new__(cls, *args, **kwargs):
         """Create a new instance of the VectorStoreClient, applying the singleton pattern"""
         if cls._instance is None:
-            cls._instance = super(VectorStoreClient, cls).__new__(cls)
-            cls._instance._initialize_client()
+            # only kept once initialized, so that a failed initialization is retried by the next call
+            instance = super(VectorStoreClient, cls).__new__(cls)
+            instance._initialize_client()
+            cls._instance = instance
         return cls._instance
 
     def _initialize_client(self):
         """Initialize the VectorStoreClient"""
-        model_name = "sentence-transformers/all-mpnet-base-v2"
-        model_kwargs = {}
-        if torch.cuda.is_available():
-            model_kwargs["device"] = "cuda"
-
-        embeddings = HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
-
         db = get_db_client()
+        check_embedding_model(db)
+
+        embeddings = build_embeddings()
         vector_store = Chroma(collection_name=COLLECTION_NAME, embedding_function=embeddings, client=db)
 
         self.client = vector_store
 
+        # the searches of the global collection are served by the quantized index instead of the Chroma server
+        global_vector_store = vector_store
+        if retrieval_settings.quantized_index:
+            if Path(retrieval_settings.quantized_index_path).exists():
+                try:
+                    global_vector_store = QuantizedVectorIndex.load(
+                        retrieval_settings.quantized_index_path,
+                        manifest_path=answer_cache_settings.manifest_path,
+                        rescore_factor=retrieval_settings.quantized_rescore_factor,
+                    )
+                except StaleIndexError as e:
+                    logger.warning(f"{str(e)}, searching Chroma until it is rebuilt by populate_db")
+            else:
+                logger.warning(f"No quantized index at {retrieval_settings.quantized_index_path}, searching Chroma")
+
+        self.router = PartitionRouter(db, embeddings, global_vector_store)  # type: ignore
+
     def get_client(self) -> VectorStore:  # noqa: F821
         """Get the VectorStoreClient
 
@@ -39,6 +87,14 @@ class VectorStoreClient:
         """
         return self.client
 
+    def get_router(self) -> PartitionRouter:
+        """Get the router sending searches to the per document collections
+
+        Returns:
+            the partition router
+        """
+        return self.router
+
 
 def get_vs() -> VectorStore:  # noqa: F821
     """Get the vector store client
@@ -47,3 +103,12 @@ def get_vs() -> VectorStore:  # noqa: F821
         vector store client
     """
     return VectorStoreClient().get_client()
+
+
+def get_partition_router() -> PartitionRouter:
+    """Get the router sending searches to the per document collections
+
+    Returns:
+        partition router
+    """
+    return VectorStoreClient().get_router()
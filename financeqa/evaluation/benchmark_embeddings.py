@@ -0,0 +1,127 @@
+import time
+
+import click
+import numpy as np
+import pandas as pd
+from langchain_core.embeddings import Embeddings
+
+from financeqa.constants import COLLECTION_NAME, TOP_K, EmbeddingBackend
+from financeqa.db.db import get_db_client
+from financeqa.db.embedding_cache import CachedEmbeddings
+from financeqa.db.embeddings import build_embeddings, get_embedding_model_id
+
+
+def normalize(embeddings: list[list[float]]) -> np.ndarray:
+    """Normalize embeddings to unit length
+
+    Args:
+        embeddings: the embeddings
+
+    Returns:
+        the normalized embeddings
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def embed(embeddings: Embeddings, chunks: list[str], queries: list[str]) -> tuple[np.ndarray, np.ndarray, float, float]:
+    """Embed the chunks in batches and the queries one by one, as the indexer and the app do
+
+    Args:
+        embeddings: the embedding model
+        chunks: the chunks
+        queries: the queries
+
+    Returns:
+        the normalized chunk and query embeddings, the number of chunks embedded per second and the p50 latency of a
+        query in seconds
+    """
+    # the first call initializes the inference session
+    embeddings.embed_documents(chunks[:8])
+
+    start = time.perf_counter()
+    chunk_embeddings = embeddings.embed_documents(chunks)
+    chunks_per_second = len(chunks) / (time.perf_counter() - start)
+
+    query_embeddings = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        query_embeddings.append(embeddings.embed_query(query))
+        latencies.append(time.perf_counter() - start)
+
+    return normalize(chunk_embeddings), normalize(query_embeddings), chunks_per_second, float(np.median(latencies))
+
+
+@click.command()
+@click.option("--num_chunks", type=int, default=1024, help="number of chunks of the collection embedded")
+@click.option(
+    "--test_cases_json_path",
+    type=str,
+    default="financeqa/evaluation/test_cases/single_document_testcases.json",
+    help="test cases whose questions are embedded as the queries",
+)
+@click.option("--batch_size", type=int, default=64, help="number of chunks per embedding batch")
+@click.option(
+    "--onnx_quantizations",
+    type=str,
+    default="avx2",
+    help="comma separated instruction sets of the int8 quantized ONNX models to benchmark",
+)
+@click.option("--min_cosine", type=float, default=0.99, help="minimum cosine similarity to the PyTorch embeddings")
+def main(num_chunks: int, test_cases_json_path: str, batch_size: int, onnx_quantizations: str, min_cosine: float):
+    """Check the parity of the ONNX embedding backends with the PyTorch one, i.e. the cosine similarity of their
+    embeddings and the overlap of the TOP_K chunks retrieved for the queries, and benchmark their throughput.
+
+    Fails if the embeddings of a backend are less similar than `min_cosine` to the PyTorch ones.
+    """
+    result = get_db_client().get_collection(COLLECTION_NAME).get(limit=num_chunks, include=["documents"])
+    chunks = result["documents"]
+    queries = pd.read_json(test_cases_json_path)["question"].tolist()
+    if len(chunks) < TOP_K or len(queries) == 0:
+        raise click.UsageError("Populate the vector store and provide test cases first")
+
+    backends = [(EmbeddingBackend.TORCH, None), (EmbeddingBackend.ONNX, None)]
+    backends += [
+        (EmbeddingBackend.ONNX, quantization) for quantization in onnx_quantizations.split(",") if quantization
+    ]
+
+    reference = None
+    failed = []
+    print(f"{len(chunks)} chunks, {len(queries)} queries")
+    for backend, quantization in backends:
+        embeddings = build_embeddings(
+            encode_kwargs={"batch_size": batch_size}, backend=backend, onnx_quantization=quantization
+        )
+        # the cache would hide the cost of the model
+        if isinstance(embeddings, CachedEmbeddings):
+            embeddings = embeddings.embeddings
+
+        chunk_embeddings, query_embeddings, chunks_per_second, query_latency = embed(embeddings, chunks, queries)
+        # chunks retrieved for each query
+        retrieved = np.argsort(-(query_embeddings @ chunk_embeddings.T), axis=1)[:, :TOP_K]
+
+        name = get_embedding_model_id(backend, quantization)
+        print(f"{name}: {chunks_per_second:.1f} chunks/s, query latency p50 {query_latency * 1000:.1f}ms")
+        if reference is None:
+            reference = (chunk_embeddings, query_embeddings, retrieved)
+            continue
+
+        cosines = np.concatenate(
+            [
+                np.sum(chunk_embeddings * reference[0], axis=1),
+                np.sum(query_embeddings * reference[1], axis=1),
+            ]
+        )
+        overlap = np.mean([len(set(a) & set(b)) / TOP_K for a, b in zip(retrieved, reference[2], strict=True)])
+        print(f"  cosine to PyTorch: mean {cosines.mean():.5f}, min {cosines.min():.5f}")
+        print(f"  overlap of the top {TOP_K} chunks with PyTorch's: {overlap:.3f}")
+        if cosines.min() < min_cosine:
+            failed.append(name)
+
+    if len(failed) > 0:
+        raise click.ClickException(f"Embeddings less similar than {min_cosine} to PyTorch: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
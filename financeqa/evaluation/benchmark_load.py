@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+from typing import Any, Optional, Type
+
+import click
+import httpx
+import numpy as np
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.app.schema import ReferencedDoc, ReferencedResponse
+from financeqa.retrieval.metadata_filtering import MetadataExtractor, Response
+
+
+class StandInEmbeddings:
+    def __init__(self, latency: float):
+        """Embedding model that blocks for `latency` seconds, like a CPU bound sentence transformer"""
+        self.latency = latency
+
+    def embed_query(self, text: str) -> list[float]:
+        time.sleep(self.latency)
+        return [0.0] * 768
+
+
+class StandInVectorStore:
+    def __init__(self, latency: float):
+        """Vector store whose searches block for `latency` seconds, like a Chroma round trip"""
+        self.latency = latency
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, filter: Optional[dict] = None
+    ) -> list[LangChainDocument]:
+        time.sleep(self.latency)
+        metadata = {"db_document_name": "2023 Q3 AAPL", "year": 2023, "quarter": "Q3", "ticker": "AAPL"}
+        return [
+            LangChainDocument(page_content="Revenue was $89.5 billion.", metadata={**metadata, "page_number": i})
+            for i in range(k)
+        ]
+
+
+class StandInRouter:
+    def __init__(self, embedding_latency: float, search_latency: float):
+        """Partition router sending every search to the same stand-in vector store"""
+        self.embeddings = StandInEmbeddings(embedding_latency)
+        self.vector_store = StandInVectorStore(search_latency)
+
+    def route(self, search_kwargs: dict[str, Any]) -> tuple[StandInVectorStore, dict[str, Any]]:
+        return self.vector_store, search_kwargs
+
+
+class StandInInferenceClient:
+    def __init__(self, latency: float, num_docs: int):
+        """Inference client that answers after `latency` seconds without blocking the event loop"""
+        self.latency = latency
+        self.num_docs = num_docs
+
+    async def get_completions(
+        self, messages: list[dict[str, str]], *, response_pydantic_type: Optional[Type] = None, **kwargs
+    ):
+        await asyncio.sleep(self.latency)
+
+        if response_pydantic_type is Response:
+            return Response(
+                list_of_docs=[MetadataExtractor(year=2023, quarter="Q3", ticker="AAPL") for _ in range(self.num_docs)]
+            )
+
+        return ReferencedResponse(
+            response="Revenue was $89.5 billion.",
+            references=[ReferencedDoc(year=2023, quarter="Q3", company="AAPL", page=0)],
+        )
+
+
+async def run_user(client: httpx.AsyncClient, num_requests: int, latencies: list[float], errors: list[int]):
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        response = await client.post("/query", json=[{"message": "What was the revenue of Apple in Q3 2023?"}])
+        latencies.append(time.perf_counter() - start)
+
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+
+async def run_load_test(num_users: int, num_requests: int) -> tuple[list[float], list[int], float]:
+    from financeqa.app.main import app
+
+    latencies: list[float] = []
+    errors: list[int] = []
+
+    transport = httpx.ASGITransport(app=app)
+    headers = {"Authorization": os.environ["FINANCEQA_API_KEY"]}
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", headers=headers) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(run_user(client, num_requests, latencies, errors) for _ in range(num_users)))
+        elapsed = time.perf_counter() - start
+
+    return latencies, errors, elapsed
+
+
+@click.command()
+@click.option("--num_users", type=int, default=50, help="number of concurrent users")
+@click.option("--num_requests", type=int, default=10, help="number of requests sent by each user")
+@click.option("--num_docs", type=int, default=3, help="number of documents extracted from each query")
+@click.option("--llm_latency", type=float, default=0.5, help="seconds per (non blocking) LLM call")
+@click.option("--embedding_latency", type=float, default=0.02, help="seconds per (blocking) query embedding")
+@click.option("--search_latency", type=float, default=0.03, help="seconds per (blocking) vector search")
+def main(
+    num_users: int,
+    num_requests: int,
+    num_docs: int,
+    llm_latency: float,
+    embedding_latency: float,
+    search_latency: float,
+):
+    """Load test the /query endpoint, with the LLM, the embedding model and the vector store replaced by local
+    stand-ins with the given latencies, and report the latency percentiles.
+    """
+    os.environ.setdefault("FINANCEQA_API_KEY", "load-test")
+    os.environ.setdefault("CHROMA_DB_MODE", "ephemeral")
+
+    from financeqa.app.routers.chat import chat
+    from financeqa.generate.coalescing import CoalescingInferenceClient
+    from financeqa.retrieval.concurrent_search import ConcurrentSearcher
+    from financeqa.settings import inference_settings, retrieval_settings
+
+    generator = StandInInferenceClient(llm_latency, num_docs)
+    chat.generator = CoalescingInferenceClient(generator) if inference_settings.coalesce else generator  # type: ignore
+    chat.searcher = ConcurrentSearcher(
+        StandInRouter(embedding_latency, search_latency),  # type: ignore
+        max_concurrency=retrieval_settings.max_concurrency,
+        timeout=retrieval_settings.search_timeout,
+    )
+
+    # the stand-ins replace the components loaded at startup, the transport doesn't run the lifespan of the app
+    chat.warmup.mark_loaded("searcher")
+    chat.warmup.mark_loaded("generator")
+    chat.warmup.start()
+
+    latencies, errors, elapsed = asyncio.run(run_load_test(num_users, num_requests))
+
+    # two sequential LLM calls, the query embedding and the (concurrent) searches
+    ideal_latency = 2 * llm_latency + embedding_latency + search_latency
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"{len(latencies)} requests from {num_users} concurrent users in {elapsed:.1f}s")
+    print(f"throughput: {len(latencies) / elapsed:.1f} requests/s, errors: {len(errors)}")
+    print(f"latency p50: {p50 * 1000:.0f}ms, p99: {p99 * 1000:.0f}ms")
+    print(f"single request lower bound: ~{ideal_latency * 1000:.0f}ms")
+    if isinstance(chat.generator, CoalescingInferenceClient):
+        print(f"LLM calls: {chat.generator}")
+
+
+if __name__ == "__main__":
+    main()
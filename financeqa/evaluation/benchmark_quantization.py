@@ -0,0 +1,127 @@
+import time
+from pathlib import Path
+from typing import Optional
+
+import click
+import numpy as np
+
+from financeqa.constants import DB_DOC_NAME_KEY, TOP_K
+from financeqa.retrieval.quantized_index import QuantizedVectorIndex
+
+
+def build_synthetic_chunks(num_chunks: int, dim: int, num_docs: int, seed: int = 0) -> list[tuple]:
+    """Build chunks whose embeddings are clustered by document, like the chunks of the filings
+
+    Args:
+        num_chunks: number of chunks
+        dim: dimension of the embeddings
+        num_docs: number of documents, i.e. clusters
+        seed: seed of the random generator
+
+    Returns:
+        the id, text, metadata and embedding of each chunk
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_docs, dim)).astype(np.float32)
+    docs = rng.integers(0, num_docs, num_chunks)
+    embeddings = centers[docs] + 1.5 * rng.standard_normal((num_chunks, dim)).astype(np.float32)
+
+    return [
+        (f"{i:08d}", f"chunk {i}", {DB_DOC_NAME_KEY: f"doc {doc}", "page_number": 0}, embedding)
+        for i, (doc, embedding) in enumerate(zip(docs, embeddings, strict=True))
+    ]
+
+
+def evaluate(
+    index: QuantizedVectorIndex, vectors: np.ndarray, queries: np.ndarray, k: int
+) -> tuple[float, float, float]:
+    """Evaluate the index against an exact full precision search
+
+    Args:
+        index: the index
+        vectors: normalized full precision embeddings of the chunks
+        queries: normalized query embeddings
+        k: number of chunks searched per query
+
+    Returns:
+        the recall@k, and the p50 and p99 latencies in seconds
+    """
+    latencies = []
+    num_found = 0
+    for query in queries:
+        exact = np.argpartition(-(vectors @ query), k - 1)[:k]
+
+        start = time.perf_counter()
+        results = index.search(query.tolist(), k=k)
+        latencies.append(time.perf_counter() - start)
+
+        num_found += len(set(exact.tolist()) & {i for i, _ in results})
+
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return num_found / (k * len(queries)), float(p50), float(p99)
+
+
+@click.command()
+@click.option(
+    "--index_path", type=str, default=None, help="Quantized index built by populate_db, synthetic chunks if not set"
+)
+@click.option("--num_chunks", type=int, default=100_000, help="number of synthetic chunks")
+@click.option("--dim", type=int, default=768, help="dimension of the synthetic embeddings")
+@click.option("--num_docs", type=int, default=60, help="number of synthetic documents")
+@click.option("--num_queries", type=int, default=200, help="number of queries")
+@click.option("--k", type=int, default=TOP_K, help="number of chunks searched per query")
+@click.option("--rescore_factors", type=str, default="1,2,4,8", help="comma separated rescore factors to evaluate")
+def main(
+    index_path: Optional[str],
+    num_chunks: int,
+    dim: int,
+    num_docs: int,
+    num_queries: int,
+    k: int,
+    rescore_factors: str,
+):
+    """Benchmark the int8 quantized index against an exact search of the full precision embeddings: memory footprint,
+    recall@k and query latency, without and with full precision rescoring.
+
+    The queries are stored embeddings with added noise, so that their nearest neighbours aren't trivially themselves.
+    """
+    if index_path is not None:
+        index = QuantizedVectorIndex.load(Path(index_path))
+        if index.vectors is None:
+            raise click.UsageError("The index was saved without its full precision embeddings")
+        vectors = np.asarray(index.vectors, dtype=np.float32)
+    else:
+        start = time.perf_counter()
+        index = QuantizedVectorIndex.build(build_synthetic_chunks(num_chunks, dim, num_docs))
+        vectors = np.asarray(index.vectors)
+        print(f"built the index of {len(index)} synthetic chunks in {time.perf_counter() - start:.1f}s")
+
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.integers(0, len(vectors), num_queries)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape).astype(np.float32) / np.sqrt(vectors.shape[1])
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    codes_bytes = index.codes.nbytes + index.scales.nbytes + index.offsets.nbytes
+    print(f"{len(index)} chunks of dimension {vectors.shape[1]}")
+    print(f"float32 embeddings: {vectors.nbytes / 2**20:.1f}MiB, int8 codes: {codes_bytes / 2**20:.1f}MiB")
+    # the chunks are held in RAM whatever the embeddings, the app shares them with the BM25 index
+    print(f"chunks: {index.chunks_footprint / 2**20:.1f}MiB, index in RAM: {index.memory_footprint / 2**20:.1f}MiB")
+
+    start = time.perf_counter()
+    for query in queries:
+        np.argpartition(-(vectors @ query), k - 1)[:k]
+    print(f"exact float32 search: {(time.perf_counter() - start) / num_queries * 1000:.2f}ms/query")
+
+    full_precision = index.vectors
+    for rescore_factor in [0] + [int(factor) for factor in rescore_factors.split(",")]:
+        # a rescore factor of 0 means searching the codes only
+        index.vectors = full_precision if rescore_factor > 0 else None
+        index.rescore_factor = max(rescore_factor, 1)
+
+        recall, p50, p99 = evaluate(index, vectors, queries, k)
+        name = f"rescoring {rescore_factor}*k" if rescore_factor > 0 else "no rescoring"
+        print(f"int8, {name}: recall@{k} {recall:.3f}, latency p50 {p50 * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,24 @@
 import asyncio
+from pathlib import Path
 
 import click
 import pandas as pd
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
 from tqdm import tqdm
 
 from financeqa.app.schema import ReferencedDoc
-from financeqa.constants import DOC_ROOT, TOP_K
+from financeqa.constants import DOC_ROOT, ROUTING_INDEX_PATH, TOP_K
+from financeqa.db.embeddings import build_embeddings
 from financeqa.db.vector_store import get_vs
 from financeqa.generate.hf_inference import HFChatCompletion
-from financeqa.retrieval.metadata_filtering import extract_search_kwargs, generate_combined_search_kwargs
-from financeqa.settings import hf_settings
+from financeqa.retrieval.document_routing import DocumentRouter, DocumentRoutingIndex
+from financeqa.retrieval.metadata_filtering import (
+    RuleBasedMetadataExtractor,
+    extract_search_kwargs,
+    generate_combined_search_kwargs,
+)
+from financeqa.settings import hf_settings, retrieval_settings
 from financeqa.utils import get_document_ids
 
 
@@ -90,6 +98,48 @@ def evaluate_metadatafiltering_retriever(test_cases_df: pd.DataFrame, vs: Vector
     return {"score": score, "num_relevant_docs": num_relevant_docs}
 
 
+def evaluate_document_routing(
+    test_cases_df: pd.DataFrame, router: DocumentRouter, embeddings: Embeddings
+) -> dict[str, float]:
+    """Evaluate the routing of the questions without any company or period to the documents they are about
+
+    Args:
+        test_cases_df: the test cases
+        router: the document router
+        embeddings: the embedding model of the queries
+
+    Returns:
+        the number of questions without metadata, the fraction of them that is routed, and the fraction of the routed
+        ones routed to (at least one of) the documents of their answer
+    """
+    rule_based_extractor = RuleBasedMetadataExtractor(get_document_ids(doc_root=DOC_ROOT))
+
+    num_questions = 0
+    num_routed = 0
+    num_correct = 0
+    for _, row in test_cases_df.iterrows():
+        question = row["question"]
+        if rule_based_extractor.mentions_metadata(question):
+            continue
+
+        num_questions += 1
+        routed = router.route(embeddings.embed_query(question))
+        if len(routed) == 0:
+            continue
+
+        num_routed += 1
+        answers = {
+            (answer.year, answer.quarter, answer.company) for answer in map(ReferencedDoc.model_validate, row["answer"])
+        }
+        num_correct += 1 if len(answers & set(routed)) > 0 else 0
+
+    return {
+        "num_questions": num_questions,
+        "routed": num_routed / max(num_questions, 1),
+        "routing_accuracy": num_correct / max(num_routed, 1),
+    }
+
+
 @click.command()
 @click.option(
     "--test_cases_json_path",
@@ -97,8 +147,29 @@ def evaluate_metadatafiltering_retriever(test_cases_df: pd.DataFrame, vs: Vector
     default="financeqa/evaluation/test_cases/single_document_testcases.json",
     help="path to the json containing the testcases",
 )
-def main(test_cases_json_path: str):
+@click.option("--routing_index_path", type=str, default=ROUTING_INDEX_PATH)
+@click.option(
+    "--routing_min_margins",
+    type=str,
+    default="0,0.02,0.05,0.1",
+    help="comma separated minimum margins of the document router to evaluate",
+)
+def main(test_cases_json_path: str, routing_index_path: str, routing_min_margins: str):
     test_cases_df = pd.read_json(test_cases_json_path)
+
+    if Path(routing_index_path).exists():
+        routing_index = DocumentRoutingIndex.load(routing_index_path)
+        embeddings = build_embeddings()
+        for min_margin in map(float, routing_min_margins.split(",")):
+            router = DocumentRouter(
+                routing_index,
+                top_k=retrieval_settings.routing_top_k,
+                min_score=retrieval_settings.routing_min_score,
+                min_margin=min_margin,
+            )
+            metrics = evaluate_document_routing(test_cases_df, router, embeddings)
+            print(f"Metrics for document routing, margin {min_margin}:", metrics)
+
     vs = get_vs()
 
     metrics = evaluate_simple_retriever(test_cases_df, vs)
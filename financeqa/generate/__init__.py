@@ -1,5 +1,12 @@
 from .base_inference_client import BaseInferenceClient
+from .coalescing import CoalescingInferenceClient
 from .hf_inference import HFChatCompletion
 from .openai_inference import OpenAIChatCompletion, build_openai_chat_completion
 
-__all__ = ["BaseInferenceClient", "HFChatCompletion", "OpenAIChatCompletion", "build_openai_chat_completion"]
+__all__ = [
+    "BaseInferenceClient",
+    "CoalescingInferenceClient",
+    "HFChatCompletion",
+    "OpenAIChatCompletion",
+    "build_openai_chat_completion",
+]
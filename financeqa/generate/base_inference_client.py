@@ -1,4 +1,4 @@
-from typing import Protocol, TypeVar
+from typing import AsyncIterator, Protocol, TypeVar
 
 from pydantic import BaseModel
 
@@ -19,3 +19,16 @@ class BaseInferenceClient(Protocol):
             kwargs: Additional arguments to pass to the inference API
         """
         pass
+
+    def stream_completions(
+        self,
+        messages: list[dict[str, str]],
+        **kwargs,
+    ) -> AsyncIterator[str]:
+        """Stream completions from an inference API, as the tokens are generated
+
+        Args:
+            messages: List of message dictionaries containing the conversation history
+            kwargs: Additional arguments to pass to the inference API
+        """
+        ...
@@ -0,0 +1,110 @@
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Any, AsyncIterator
+
+from pydantic import BaseModel
+
+from financeqa.generate.base_inference_client import BaseInferenceClient
+
+
+def get_call_key(messages: list[dict[str, str]], kwargs: dict[str, Any]) -> str:
+    """Get a key identifying a completion call, i.e. its messages and arguments (model, temperature, response type...)
+
+    Args:
+        messages: the messages
+        kwargs: the other arguments of the call
+
+    Returns:
+        the key
+    """
+
+    def encode(value: Any) -> Any:
+        if isinstance(value, type):
+            return f"{value.__module__}.{value.__qualname__}"
+        if isinstance(value, BaseModel):
+            return value.model_dump(mode="json")
+        return str(value)
+
+    call = json.dumps({"messages": messages, "kwargs": kwargs}, sort_keys=True, default=encode)
+    return hashlib.sha256(call.encode("utf-8")).hexdigest()
+
+
+class CoalescingInferenceClient:
+    def __init__(self, client: BaseInferenceClient):
+        """Inference client coalescing the concurrent identical completion calls into a single upstream call.
+
+        The first call with given messages and arguments is sent upstream, the identical calls made while it is in
+        flight wait for its result (or its error) instead. Nothing is cached once it completed. A caller being
+        cancelled doesn't cancel the upstream call of the others.
+
+        Streamed completions are not coalesced.
+
+        Args:
+            client: the upstream inference client
+        """
+        self.client = client
+
+        self.num_calls = 0
+        self.num_upstream_calls = 0
+
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @property
+    def num_coalesced(self) -> int:
+        return self.num_calls - self.num_upstream_calls
+
+    def __str__(self) -> str:
+        return (
+            f"{self.num_calls} calls, {self.num_upstream_calls} upstream, {self.num_coalesced} coalesced, "
+            f"{len(self._in_flight)} in flight"
+        )
+
+    async def get_completions(self, messages: list[dict[str, str]], **kwargs):
+        """Get completions from the upstream client, sharing the result of an identical call in flight
+
+        Args:
+            messages: List of message dictionaries containing the conversation history
+            kwargs: Additional arguments to pass to the upstream client
+
+        Returns:
+            the completion of the upstream client
+        """
+        key = get_call_key(messages, kwargs)
+        loop = asyncio.get_running_loop()
+
+        with self._lock:
+            self.num_calls += 1
+            future = self._in_flight.get(key)
+
+            # futures can't be awaited from another event loop
+            if future is None or future.get_loop() is not loop:
+                self.num_upstream_calls += 1
+                future = asyncio.ensure_future(self.client.get_completions(messages, **kwargs))
+                self._in_flight[key] = future
+                future.add_done_callback(lambda done: self._remove(key, done))
+
+        return await asyncio.shield(future)
+
+    def _remove(self, key: str, future: asyncio.Future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+        # retrieve the exception, so that it isn't reported as never retrieved if all the callers were cancelled
+        if not future.cancelled():
+            future.exception()
+
+    def stream_completions(self, messages: list[dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """Stream completions from the upstream client
+
+        Args:
+            messages: List of message dictionaries containing the conversation history
+            kwargs: Additional arguments to pass to the upstream client
+
+        Returns:
+            the text of the response, as it is generated
+        """
+        return self.client.stream_completions(messages, **kwargs)
@@ -1,6 +1,6 @@
-from typing import Optional, Type, TypeVar, Union
+from typing import AsyncIterator, Optional, Type, TypeVar, Union
 
-from openai import AzureOpenAI, NotGiven, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, NotGiven
 from openai.types.chat import (
     ChatCompletionMessageParam,
     ChatCompletionSystemMessageParam,
@@ -9,12 +9,13 @@ from openai.types.chat import (
 from pydantic import BaseModel
 
 from financeqa.constants import MessageType, OpenAIProvider
+from financeqa.generate.transport import get_http_client
 
 T = TypeVar("T", bound=BaseModel)
 
 
 class OpenAIChatCompletion:
-    def __init__(self, client: OpenAI):
+    def __init__(self, client: AsyncOpenAI):
         self.client = client
 
     def _transform_messages_to_oai_format(self, messages: list[dict[str, str]]) -> list[ChatCompletionMessageParam]:
@@ -54,6 +55,7 @@ class OpenAIChatCompletion:
         temperature: float = 0.7,
         max_tokens: int = 1024,
         response_pydantic_type: Optional[Type[T]] = None,
+        timeout: Optional[float] = None,
     ) -> Union[str, T]:
         """Get completions from OpenAI's chat API
 
@@ -63,6 +65,7 @@ class OpenAIChatCompletion:
             temperature: Controls randomness in the response
             max_tokens: Maximum number of tokens in the response
             response_pydantic_type: Pydantic model class to validate and parse the response
+            timeout: Number of seconds after which the request is given up on, the transport default if None
 
         Raises:
             ValueError: If an error occurs while getting the completion
@@ -73,12 +76,13 @@ class OpenAIChatCompletion:
         oai_messages = self._transform_messages_to_oai_format(messages)
 
         try:
-            response = self.client.beta.chat.completions.parse(
+            response = await self.client.beta.chat.completions.parse(
                 model=model_name,
                 messages=oai_messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 response_format=response_pydantic_type if response_pydantic_type is not None else NotGiven(),
+                timeout=timeout if timeout is not None else NotGiven(),
             )
 
             raw_text = response.choices[0].message.content
@@ -93,10 +97,54 @@ class OpenAIChatCompletion:
         except Exception as e:
             raise ValueError(f"Error getting completion from {model_name}: {str(e)}") from e
 
+    async def stream_completions(
+        self,
+        messages: list[dict[str, str]],
+        *,
+        model_name: str,
+        temperature: float = 0.7,
+        max_tokens: int = 1024,
+        timeout: Optional[float] = None,
+    ) -> AsyncIterator[str]:
+        """Stream completions from OpenAI's chat API
+
+        Args:
+            messages: List of message dictionaries containing the conversation history
+            model_name: Name of the model to use for completion
+            temperature: Controls randomness in the response
+            max_tokens: Maximum number of tokens in the response
+            timeout: Number of seconds after which the request is given up on, the transport default if None
+
+        Raises:
+            ValueError: If an error occurs while streaming the completion
+
+        Yields:
+            The text of the response, as it is generated
+        """
+        oai_messages = self._transform_messages_to_oai_format(messages)
+
+        try:
+            stream = await self.client.chat.completions.create(
+                model=model_name,
+                messages=oai_messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                timeout=timeout if timeout is not None else NotGiven(),
+            )
+
+            async for chunk in stream:
+                if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            raise ValueError(f"Error streaming completion from {model_name}: {str(e)}") from e
+
 
 def build_openai_chat_completion(provider: OpenAIProvider) -> OpenAIChatCompletion:
     """Build OpenAI chat completion object
 
+    The clients share the pooled HTTP transport of `get_http_client`, which retries the failed requests itself.
+
     Args:
         provider: OpenAI provider to use
 
@@ -107,17 +155,21 @@ def build_openai_chat_completion(provider: OpenAIProvider) -> OpenAIChatCompleti
     def handle_openai():
         from financeqa.settings import openai_settings
 
-        client = OpenAI(api_key=openai_settings.api_key.get_secret_value())
+        client = AsyncOpenAI(
+            api_key=openai_settings.api_key.get_secret_value(), http_client=get_http_client(), max_retries=0
+        )
 
         return client
 
     def handle_openai_azure():
         from financeqa.settings import openai_azure_settings
 
-        client = AzureOpenAI(
+        client = AsyncAzureOpenAI(
             azure_endpoint=openai_azure_settings.endpoint,
             api_key=openai_azure_settings.api_key.get_secret_value(),
             api_version=openai_azure_settings.api_version,
+            http_client=get_http_client(),
+            max_retries=0,
         )
 
         return client
@@ -0,0 +1,242 @@
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import weakref
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """Token bucket rate limiter, shared by all the concurrent callers, whatever their thread or event loop.
+
+        Callers reserve their token up front, so they are served in the order they called `acquire`.
+
+        Args:
+            rate: number of tokens added per second
+            capacity: maximum number of tokens, i.e. the burst size, `rate` if None
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Reserve tokens
+
+        Args:
+            tokens: number of tokens to reserve
+
+        Returns:
+            number of seconds to wait before the reserved tokens are available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+            # the balance goes negative while callers are waiting for their tokens
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    async def acquire(self, tokens: float = 1.0):
+        """Wait until tokens are available
+
+        Args:
+            tokens: number of tokens to acquire
+        """
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """Get the number of seconds the server asks to wait before retrying
+
+    Args:
+        response: the response
+
+    Returns:
+        the number of seconds, None if the response doesn't say
+    """
+    for header in ("retry-after-ms", "retry-after"):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+
+        try:
+            seconds = float(value)
+            return seconds / 1000 if header == "retry-after-ms" else seconds
+        except ValueError:
+            # `Retry-After` may also be an HTTP date
+            date = email.utils.parsedate_tz(value) if header == "retry-after" else None
+            if date is not None:
+                return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+    return None
+
+
+class RetryTransport(httpx.AsyncBaseTransport):
+    def __init__(
+        self,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        keepalive_expiry: float = 30.0,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        rate_limiter: Optional[TokenBucket] = None,
+    ):
+        """HTTP transport of the inference clients, with connection pooling, keep-alive, retries and rate limiting.
+
+        Requests failing with a 429 or 5xx status, or a connection error, are retried with exponential backoff and
+        full jitter, unless the server says how long to wait (`Retry-After`). Every attempt first acquires a token of
+        the rate limiter.
+
+        The connection pool is bound to the event loop it was opened in, so a pool is kept per event loop, e.g. for
+        scripts calling `asyncio.run` several times.
+
+        Args:
+            transport: transport sending the requests, e.g. a mock server, a pooled transport per event loop if None
+            max_connections: maximum number of connections per pool
+            max_keepalive_connections: maximum number of idle connections kept alive per pool
+            keepalive_expiry: number of seconds after which an idle connection is closed
+            max_retries: maximum number of retries of a request
+            backoff_base: number of seconds to wait before the first retry, doubled for every retry
+            backoff_max: maximum number of seconds to wait before a retry
+            rate_limiter: rate limiter of the requests, unlimited if None
+        """
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+
+        self._transport = transport
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._transports: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport] = (
+            weakref.WeakKeyDictionary()
+        )
+
+        self.num_requests = 0
+        self.num_retries = 0
+
+    def _get_transport(self) -> httpx.AsyncBaseTransport:
+        if self._transport is not None:
+            return self._transport
+
+        loop = asyncio.get_running_loop()
+        transport = self._transports.get(loop)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(limits=self._limits)
+            self._transports[loop] = transport
+
+        return transport
+
+    def get_backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """Get the number of seconds to wait before retrying a request
+
+        Args:
+            attempt: number of the failed attempt, starting at 0
+            response: response of the failed attempt, None if it failed to connect
+
+        Returns:
+            the number of seconds
+        """
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+
+        # full jitter, so that the callers failing together don't retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        transport = self._get_transport()
+        self.num_requests += 1
+
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire()
+
+            try:
+                response = await transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = self.get_backoff(attempt)
+                logger.warning(f"Request to {request.url} failed ({str(e)}), retrying in {backoff:.2f}s")
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                    return response
+                backoff = self.get_backoff(attempt, response)
+                await response.aclose()
+                logger.warning(
+                    f"Request to {request.url} got status {response.status_code}, retrying in {backoff:.2f}s"
+                )
+
+            attempt += 1
+            self.num_retries += 1
+            await asyncio.sleep(backoff)
+
+    async def aclose(self):
+        if self._transport is not None:
+            await self._transport.aclose()
+
+        loop = asyncio.get_running_loop()
+        transport = self._transports.pop(loop, None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the HTTP client shared by all the inference clients, configured by the inference settings
+
+    Returns:
+        the HTTP client
+    """
+    global _http_client
+
+    with _http_client_lock:
+        if _http_client is None:
+            from financeqa.settings import inference_settings
+
+            rate_limiter = (
+                TokenBucket(inference_settings.rate_limit, inference_settings.rate_limit_burst)
+                if inference_settings.rate_limit is not None
+                else None
+            )
+            transport = RetryTransport(
+                max_connections=inference_settings.max_connections,
+                max_keepalive_connections=inference_settings.max_keepalive_connections,
+                keepalive_expiry=inference_settings.keepalive_expiry,
+                max_retries=inference_settings.max_retries,
+                backoff_base=inference_settings.backoff_base,
+                backoff_max=inference_settings.backoff_max,
+                rate_limiter=rate_limiter,
+            )
+            _http_client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(inference_settings.timeout, connect=inference_settings.connect_timeout),
+                follow_redirects=True,
+            )
+
+        return _http_client
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import re
+from collections import defaultdict
+from typing import Iterable, Iterator, Optional
+
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.constants import DB_DOC_NAME_KEY
+
+DUPLICATES_METADATA_KEY = "duplicates"
+
+# figures keep their sign, i.e. a minus or accounting parentheses, and their unit, so that a loss isn't a gain
+_TOKEN_RE = re.compile(r"\(?-?\$?\d+(?:[.,]\d+)*%?\)?|\w+")
+_NUMBER_RE = re.compile(r"^\(?-?\$?\d+(?:[.,]\d+)*%?\)?$")
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(tokens: list[str], shingle_size: int = 3) -> int:
+    """Compute the 64 bit SimHash of the word shingles of a text
+
+    Args:
+        tokens: tokens of the text
+        shingle_size: number of tokens per shingle
+
+    Returns:
+        the SimHash fingerprint
+    """
+    shingles = [" ".join(tokens[i : i + shingle_size]) for i in range(max(1, len(tokens) - shingle_size + 1))]
+
+    weights = [0] * 64
+    for shingle in shingles:
+        shingle_hash = _hash64(shingle)
+        for bit in range(64):
+            weights[bit] += 1 if shingle_hash >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class DeduplicationStats:
+    def __init__(self):
+        self.num_chunks = 0
+        self.num_exact_duplicates = 0
+        self.num_near_duplicates = 0
+        self.num_chars_saved = 0
+
+    @property
+    def num_duplicates(self) -> int:
+        return self.num_exact_duplicates + self.num_near_duplicates
+
+    def __str__(self) -> str:
+        return (
+            f"{self.num_duplicates}/{self.num_chunks} chunks deduplicated ({self.num_exact_duplicates} exact, "
+            f"{self.num_near_duplicates} near duplicates), {self.num_chars_saved} characters saved"
+        )
+
+
+class ChunkDeduplicator:
+    def __init__(
+        self,
+        scope_key: str = DB_DOC_NAME_KEY,
+        max_distance: int = 7,
+        min_tokens: int = 8,
+    ):
+        """Detects exact and near duplicate chunks, so that they are stored only once.
+
+        Near duplicates are detected by comparing the SimHash of the word shingles of the chunks. Since in financial
+        filings chunks with the same wording but different figures are not duplicates at all, chunks are only
+        considered near duplicates if they contain exactly the same numbers.
+
+        Chunks are only deduplicated within a document: the kept chunk has the metadata of its own document, so a
+        duplicate from another document would be missed by the searches filtered on that document.
+
+        Args:
+            scope_key: metadata key within which chunks are deduplicated, e.g. the document
+            max_distance: maximum Hamming distance between the SimHashes of two near duplicate chunks
+            min_tokens: chunks with fewer tokens are only deduplicated if they are exact duplicates
+        """
+        self.scope_key = scope_key
+        self.max_distance = max_distance
+        self.min_tokens = min_tokens
+        self.stats = DeduplicationStats()
+
+        # SimHashes are split in max_distance + 1 bands, two near duplicates share at least one of them
+        self._num_bands = max_distance + 1
+        self._band_bits = 64 // self._num_bands
+
+        self._exact: dict[tuple, str] = {}
+        self._bands: dict[tuple, list[tuple[int, str]]] = defaultdict(list)
+        self._kept: dict[str, dict] = {}
+        self._duplicates: dict[str, list[dict]] = defaultdict(list)
+
+    def _bands_of(self, fingerprint: int) -> list[int]:
+        mask = (1 << self._band_bits) - 1
+        return [fingerprint >> (i * self._band_bits) & mask for i in range(self._num_bands)]
+
+    def find_duplicate(self, chunk_id: str, chunk: LangChainDocument) -> Optional[str]:
+        """Check whether the chunk duplicates a previously seen chunk, registering it if it doesn't
+
+        Args:
+            chunk_id: id of the chunk
+            chunk: the chunk
+
+        Returns:
+            the id of the chunk it duplicates, None if it is not a duplicate
+        """
+        scope = chunk.metadata.get(self.scope_key)
+        tokens = _TOKEN_RE.findall(chunk.page_content.lower())
+        self.stats.num_chunks += 1
+
+        exact_key = (scope, hashlib.sha256(" ".join(tokens).encode("utf-8")).digest())
+        if exact_key in self._exact:
+            self.stats.num_exact_duplicates += 1
+            return self._exact[exact_key]
+
+        self._exact[exact_key] = chunk_id
+        if len(tokens) < self.min_tokens:
+            return None
+
+        numbers = _hash64(" ".join(token for token in tokens if _NUMBER_RE.match(token)))
+        fingerprint = simhash(tokens)
+
+        band_keys = [(scope, numbers, i, band) for i, band in enumerate(self._bands_of(fingerprint))]
+        for band_key in band_keys:
+            for candidate_fingerprint, candidate_id in self._bands[band_key]:
+                if (fingerprint ^ candidate_fingerprint).bit_count() <= self.max_distance:
+                    self.stats.num_near_duplicates += 1
+                    return candidate_id
+
+        for band_key in band_keys:
+            self._bands[band_key].append((fingerprint, chunk_id))
+
+        return None
+
+    def filter(self, chunks: Iterable[tuple[str, LangChainDocument]]) -> Iterator[tuple[str, LangChainDocument]]:
+        """Drop the duplicate chunks, recording where they come from
+
+        Args:
+            chunks: the chunk ids and the chunks
+
+        Yields:
+            the chunk ids and the chunks that are not duplicates
+        """
+        for chunk_id, chunk in chunks:
+            duplicate_of = self.find_duplicate(chunk_id, chunk)
+
+            if duplicate_of is None:
+                self._kept[chunk_id] = chunk.metadata
+                yield chunk_id, chunk
+                continue
+
+            self.stats.num_chars_saved += len(chunk.page_content)
+            self._duplicates[duplicate_of].append(
+                {key: chunk.metadata[key] for key in (DB_DOC_NAME_KEY, "page_number", "info_type")}
+            )
+
+    def get_provenance_updates(self) -> tuple[list[str], list[dict]]:
+        """Get the metadata of the kept chunks that have duplicates, extended with where their duplicates come from.
+
+        Chroma only supports scalar metadata values, the provenance is therefore stored as a JSON string.
+
+        Returns:
+            the ids of the kept chunks and their updated metadata
+        """
+        ids = list(self._duplicates)
+        metadatas = [
+            {**self._kept[chunk_id], DUPLICATES_METADATA_KEY: json.dumps(self._duplicates[chunk_id])}
+            for chunk_id in ids
+        ]
+
+        return ids, metadatas
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+from pydantic import BaseModel
+
+if TYPE_CHECKING:
+    # only for the annotations, so that the app reading the manifest doesn't load PyMuPDF
+    from fitz import Page
+
+
+class DocumentEntry(BaseModel):
+    file_hash: str
+    pages: dict[int, str] = {}
+
+
+class IndexManifest(BaseModel):
+    """Content hashes of everything that is currently stored in the vector store"""
+
+    config_hash: str = ""
+    documents: dict[str, DocumentEntry] = {}
+
+    @classmethod
+    def load(cls, path: str | Path) -> "IndexManifest":
+        """Load the manifest from disk, returning an empty manifest if it does not exist
+
+        Args:
+            path: path to the manifest json
+
+        Returns:
+            the manifest
+        """
+        path = Path(path)
+        if not path.exists():
+            return cls()
+
+        return cls.model_validate_json(path.read_text())
+
+    def save(self, path: str | Path):
+        """Atomically write the manifest to disk
+
+        Args:
+            path: path to the manifest json
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        tmp_path.write_text(self.model_dump_json(indent=2))
+        os.replace(tmp_path, path)
+
+    def get_digest(self) -> str:
+        """Compute the hash of the manifest, it changes whenever a document is (re-)indexed or removed
+
+        Returns:
+            hex digest of the manifest
+        """
+        return hashlib.sha256(self.model_dump_json().encode("utf-8")).hexdigest()
+
+
+def hash_file(path: str | Path, chunk_size: int = 1 << 20) -> str:
+    """Compute the sha256 of a file without loading it in memory at once
+
+    Args:
+        path: path to the file
+        chunk_size: number of bytes to read at once
+
+    Returns:
+        hex digest of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def hash_page(page: "Page", extractors: Iterable[Callable[["Page"], Any]]) -> str:
+    """Compute the hash of a page, i.e. its raw content stream plus the output of the given extractors.
+
+    Extractors that only depend on the page content (e.g. text extraction) do not have to be passed, the ones
+    that depend on external data (e.g. precomputed image summaries) do.
+
+    Args:
+        page: PDF page
+        extractors: extractors whose output should be part of the hash
+
+    Returns:
+        hex digest of the page
+    """
+    sha = hashlib.sha256()
+    sha.update(page.read_contents())  # type: ignore
+
+    for extractor in extractors:
+        info = extractor(page)
+        sha.update(b"\0")
+        sha.update(str(info).encode("utf-8"))
+
+    return sha.hexdigest()
+
+
+def hash_config(config: dict[str, Any]) -> str:
+    """Compute the hash of the indexing configuration, if it changes the whole index has to be rebuilt
+
+    Args:
+        config: json serializable indexing configuration
+
+    Returns:
+        hex digest of the configuration
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
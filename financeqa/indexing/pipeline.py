@@ -0,0 +1,227 @@
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, TypeVar
+
+from langchain_core.documents import Document as LangChainDocument
+from langchain_core.embeddings import Embeddings
+
+from financeqa.constants import DB_DOC_NAME_KEY
+from financeqa.db.partitions import PartitionedCollection
+
+T = TypeVar("T")
+
+
+def get_chunk_id(metadata: dict, chunk_index: int) -> str:
+    """Get a deterministic id for a chunk, so that re-indexing the same chunk overwrites it instead of duplicating it
+
+    Args:
+        metadata: metadata of the document the chunk belongs to
+        chunk_index: index of the chunk within the document
+
+    Returns:
+        the chunk id
+    """
+    key = f"{metadata[DB_DOC_NAME_KEY]}/{metadata['page_number']}/{metadata['info_type']}/{chunk_index}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+
+def iter_chunks(
+    documents: Iterable[LangChainDocument], text_splitter: Callable[[str], list[str]]
+) -> Iterator[tuple[str, LangChainDocument]]:
+    """Split the documents into chunks, lazily
+
+    Args:
+        documents: documents to split
+        text_splitter: function splitting a text into chunks
+
+    Yields:
+        the chunk ids and the chunks
+    """
+    for document in documents:
+        for i, chunk in enumerate(text_splitter(document.page_content)):
+            yield get_chunk_id(document.metadata, i), LangChainDocument(page_content=chunk, metadata=document.metadata)
+
+
+def bounded_prefetch(iterable: Iterable[T], max_items: int) -> Iterator[T]:
+    """Consume the iterable in a background thread, keeping at most `max_items` items in flight.
+
+    This lets the producer (e.g. extraction) run concurrently with the consumer (e.g. embedding), while the
+    producer blocks as soon as it is `max_items` ahead, so memory stays bounded.
+
+    Args:
+        iterable: iterable to consume
+        max_items: maximum number of items produced but not yet consumed
+
+    Yields:
+        the items of the iterable, in order
+    """
+    items: queue.Queue = queue.Queue(maxsize=max_items)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    break
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            # release the resources held by the producer (e.g. the extraction process pool) when stopped early
+            if hasattr(iterator, "close"):
+                iterator.close()  # type: ignore
+            put(done)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while (item := items.get()) is not done:
+            yield item
+    finally:
+        # unblock the producer if the consumer stops early
+        stop.set()
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+class ThroughputStats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.num_chunks = 0
+        self.num_embedded = 0
+        self.embedding_seconds = 0.0
+        self.upsert_seconds = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        """Number of chunks indexed per second of wall time, i.e. the end to end throughput"""
+        elapsed = time.perf_counter() - self.start_time
+        return self.num_chunks / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def embeddings_per_second(self) -> float:
+        """Number of chunks embedded per second spent in the embedding model"""
+        return self.num_embedded / self.embedding_seconds if self.embedding_seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.num_chunks} chunks, {self.chunks_per_second:.1f} chunks/s, "
+            f"{self.embeddings_per_second:.1f} embeddings/s, "
+            f"embedding {self.embedding_seconds:.1f}s, upserting {self.upsert_seconds:.1f}s"
+        )
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        collection: PartitionedCollection,
+        *,
+        batch_size: int = 64,
+        sort_window: int = 16,
+        upsert_batch_size: int = 1024,
+        length_function: Callable[[str], int] = len,
+    ):
+        """Accumulates chunks across documents, embeds them in fixed size batches and upserts them in bulk
+
+        Args:
+            embeddings: embedding model
+            collection: collection to upsert the chunks into
+            batch_size: number of chunks per embedding batch
+            sort_window: number of batches that are buffered and sorted by length before embedding, so that each
+                batch contains chunks of similar length and little padding is wasted
+            upsert_batch_size: number of chunks per upsert request
+            length_function: function measuring the length of a chunk
+        """
+        self.embeddings = embeddings
+        self.collection = collection
+        self.batch_size = batch_size
+        self.sort_window = sort_window
+        self.upsert_batch_size = upsert_batch_size
+        self.length_function = length_function
+        self.stats = ThroughputStats()
+
+        self._pending: list[tuple[str, LangChainDocument]] = []
+        self._ids: list[str] = []
+        self._embeddings: list[list[float]] = []
+        self._metadatas: list[dict] = []
+        self._documents: list[str] = []
+
+    def add(self, chunk_id: str, chunk: LangChainDocument):
+        """Add a chunk to the batcher, embedding and upserting the buffered chunks when enough are accumulated
+
+        Args:
+            chunk_id: id of the chunk
+            chunk: the chunk
+        """
+        self._pending.append((chunk_id, chunk))
+
+        if len(self._pending) >= self.batch_size * self.sort_window:
+            self._embed_pending()
+
+    def add_chunks(self, chunks: Iterable[tuple[str, LangChainDocument]]):
+        """Add all the chunks to the batcher
+
+        Args:
+            chunks: the chunk ids and the chunks
+        """
+        for chunk_id, chunk in chunks:
+            self.add(chunk_id, chunk)
+
+    def flush(self):
+        """Embed and upsert all the buffered chunks"""
+        self._embed_pending()
+        self._upsert()
+
+    def _embed_pending(self):
+        pending = sorted(self._pending, key=lambda item: self.length_function(item[1].page_content))
+        self._pending = []
+
+        for i in range(0, len(pending), self.batch_size):
+            batch = pending[i : i + self.batch_size]
+
+            start = time.perf_counter()
+            vectors = self.embeddings.embed_documents([chunk.page_content for _, chunk in batch])
+            self.stats.embedding_seconds += time.perf_counter() - start
+            self.stats.num_embedded += len(batch)
+
+            for (chunk_id, chunk), vector in zip(batch, vectors, strict=True):
+                self._ids.append(chunk_id)
+                self._embeddings.append(vector)
+                self._metadatas.append(chunk.metadata)
+                self._documents.append(chunk.page_content)
+
+            if len(self._ids) >= self.upsert_batch_size:
+                self._upsert()
+
+    def _upsert(self):
+        while len(self._ids) > 0:
+            n = self.upsert_batch_size
+
+            start = time.perf_counter()
+            self.collection.upsert(
+                ids=self._ids[:n],
+                embeddings=self._embeddings[:n],  # type: ignore
+                metadatas=self._metadatas[:n],
+                documents=self._documents[:n],
+            )
+            self.stats.upsert_seconds += time.perf_counter() - start
+            self.stats.num_chunks += len(self._ids[:n])
+
+            del self._ids[:n], self._embeddings[:n], self._metadatas[:n], self._documents[:n]
@@ -1,70 +1,89 @@
-import functools
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any, Callable
+from typing import Any, Callable, Iterable, Iterator, Optional
 
 import click
 import fitz
-import pandas as pd
-import torch
 from fitz import Document, Page
-from langchain_chroma import Chroma
 from langchain_core.documents import Document as LangChainDocument
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from tqdm import tqdm
 
 from financeqa.constants import (
+    BM25_INDEX_PATH,
     COLLECTION_NAME,
     DB_DOC_NAME_KEY,
+    EMBEDDING_MODEL_METADATA_KEY,
+    INDEX_MANIFEST_PATH,
     NODE_PARSER_CHUNK_OVERLAP,
     NODE_PARSER_CHUNK_SIZE,
+    QUANTIZED_INDEX_PATH,
+    ROUTING_INDEX_PATH,
+    TICKER_TO_NAME_MAP,
+    EmbeddingBackend,
     TextExtractionType,
 )
 from financeqa.db.db import get_db_client
+from financeqa.db.embedding_cache import CachedEmbeddings
+from financeqa.db.embeddings import build_embeddings, get_embedding_model_id
+from financeqa.db.partitions import PartitionedCollection, list_partitions
+from financeqa.indexing.deduplication import ChunkDeduplicator
+from financeqa.indexing.manifest import DocumentEntry, IndexManifest, hash_config, hash_file, hash_page
+from financeqa.indexing.pipeline import EmbeddingBatcher, bounded_prefetch, iter_chunks
+from financeqa.indexing.summary_index import PrecomputedFeatureIndex
 from financeqa.preprocessing.text.text_extraction import build_text_extractor
+from financeqa.retrieval.bm25_index import BM25Index
+from financeqa.retrieval.document_routing import DocumentRoutingIndex
+from financeqa.retrieval.quantized_index import QuantizedVectorIndex
+from financeqa.settings import embedding_settings, retrieval_settings
 
-ticker_to_name_map = {
-    "AAPL": "Apple",
-    "AMZN": "Amazon",
-    "INTC": "Intel",
-    "MSFT": "Microsoft",
-    "NVDA": "Nvidia",
-}
+PRECOMPUTED_FEATURE_KEYS = ("image", "table")
 
 
-def get_precomputed_feature(page: Page, df: pd.DataFrame):
-    document_name = Path(page.parent.name).stem
-    image_name = str(Path(document_name) / f"{page.number}")
+def get_document_metadata(doc_name: str) -> dict[str, Any]:
+    """Get the metadata of a document from its name, i.e. `<year> <quarter> <ticker>`
 
-    matching_rows = df[df["image_name"].str.startswith(image_name)]
-    summary = matching_rows["summary"].str.cat(sep="\n")
+    Args:
+        doc_name: name of the document
+
+    Returns:
+        the metadata of the document
+    """
+    year, quarter, ticker = doc_name.split()
+    company_name = TICKER_TO_NAME_MAP[ticker]
 
-    return summary
+    return {
+        DB_DOC_NAME_KEY: doc_name,
+        "year": int(year),
+        "quarter": quarter,
+        "ticker": ticker,
+        "company": company_name,
+    }
 
 
-def extract_from_document(doc: Document, extractors: dict[str, Callable[[Page], Any]]) -> list[LangChainDocument]:
+def extract_from_document(
+    doc: Document,
+    extractors: dict[str, Callable[[Page], Any]],
+    page_numbers: Optional[Iterable[int]] = None,
+) -> list[LangChainDocument]:
     """Extract information from a PDF document using the provided extractors.
 
     Args:
         doc: PDF document to extract from
         extractors: dictionary of extractors to use
+        page_numbers: only extract these pages, all pages if None
 
     Returns:
         list of LangChainDocuments containing the extracted information
     """
     result = []
-    doc_name = Path(doc.name).stem
-    year, quarter, ticker = doc_name.split()
-    company_name = ticker_to_name_map[ticker]
-    metadata = {
-        DB_DOC_NAME_KEY: Path(doc.name).stem,
-        "year": int(year),
-        "quarter": quarter,
-        "ticker": ticker,
-        "company": company_name,
-    }
+    metadata = get_document_metadata(Path(doc.name).stem)
 
-    for i, page in enumerate(doc.pages()):
+    pages = doc.pages() if page_numbers is None else (doc[page_number] for page_number in sorted(page_numbers))
+    for page in pages:
         metadata["page_number"] = int(page.number)
 
         for key, extractor_func in extractors.items():
@@ -77,46 +96,310 @@ def extract_from_document(doc: Document, extractors: dict[str, Callable[[Page],
     return result
 
 
+def extract_page_range(
+    doc_path: str, page_numbers: list[int], extractors: dict[str, Callable[[Page], Any]]
+) -> list[LangChainDocument]:
+    """Open a PDF document and extract information from the given pages
+
+    Args:
+        doc_path: path to the PDF document
+        page_numbers: pages to extract
+        extractors: dictionary of extractors to use
+
+    Returns:
+        list of LangChainDocuments containing the extracted information
+    """
+    with fitz.open(doc_path) as doc:
+        return extract_from_document(doc, extractors, page_numbers=page_numbers)
+
+
+_worker_extractors: dict[str, Callable[[Page], Any]] = {}
+
+
+def _init_extraction_worker(extractors: dict[str, Callable[[Page], Any]]):
+    global _worker_extractors
+    _worker_extractors = extractors
+
+
+def _extract_page_range_in_worker(doc_path: str, page_numbers: list[int]) -> list[LangChainDocument]:
+    return extract_page_range(doc_path, page_numbers, _worker_extractors)
+
+
+def extract_documents(
+    tasks: list[tuple[Path, list[int]]],
+    extractors: dict[str, Callable[[Page], Any]],
+    *,
+    workers: int = 1,
+    pages_per_task: int = 8,
+) -> Iterator[LangChainDocument]:
+    """Extract information from the given pages of the PDF documents, optionally fanning out over a process pool.
+
+    The documents are split in page ranges that are extracted by the workers, the results are yielded in order
+    while the workers keep extracting the next page ranges.
+
+    Args:
+        tasks: list of PDF document paths and the pages to extract from each of them
+        extractors: dictionary of extractors to use
+        workers: number of worker processes, extraction happens in the current process if 1
+        pages_per_task: number of pages extracted by a worker at once
+
+    Yields:
+        LangChainDocuments containing the extracted information
+    """
+    page_ranges = [
+        (str(doc_path), page_numbers[i : i + pages_per_task])
+        for doc_path, page_numbers in tasks
+        for i in range(0, len(page_numbers), pages_per_task)
+    ]
+
+    if workers <= 1:
+        for doc_path, page_numbers in page_ranges:
+            yield from extract_page_range(doc_path, page_numbers, extractors)
+        return
+
+    # spawn instead of fork, the parent process already holds the (multi-threaded) embedding model
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_extraction_worker,
+        initargs=(extractors,),
+    ) as executor:
+        # bound the number of page ranges in flight so extraction cannot run arbitrarily far ahead of embedding
+        futures = deque()
+        for doc_path, page_numbers in page_ranges:
+            futures.append(executor.submit(_extract_page_range_in_worker, doc_path, page_numbers))
+
+            if len(futures) >= 2 * workers:
+                yield from futures.popleft().result()
+
+        while len(futures) > 0:
+            yield from futures.popleft().result()
+
+
+def get_stale_pages(doc: Document, entry: Optional[DocumentEntry], page_hashes: dict[int, str]) -> set[int]:
+    """Get the pages of a document that are new, changed or removed compared to the manifest entry
+
+    Args:
+        doc: PDF document
+        entry: manifest entry of the previously indexed version of the document, None if it was never indexed
+        page_hashes: hashes of the current pages of the document
+
+    Returns:
+        the page numbers whose chunks have to be (re)computed or deleted
+    """
+    if entry is None:
+        return set(range(doc.page_count))
+
+    changed = {
+        page_number for page_number, page_hash in page_hashes.items() if entry.pages.get(page_number) != page_hash
+    }
+    removed = set(entry.pages) - set(page_hashes)
+
+    return changed | removed
+
+
 def process_documents(
     input_dir: str,
     extractors: dict[str, Callable[[Page], Any]],
+    *,
+    incremental: bool = False,
+    manifest_path: str = INDEX_MANIFEST_PATH,
+    embedding_batch_size: int = 64,
+    embedding_backend: Optional[EmbeddingBackend] = None,
+    onnx_quantization: Optional[str] = None,
+    upsert_batch_size: int = 1024,
+    workers: int = 1,
+    pages_per_task: int = 8,
+    max_in_flight_chunks: int = 4096,
+    dedup: str = "none",
+    partition: bool = False,
+    bm25_index_path: Optional[str] = BM25_INDEX_PATH,
+    routing_index_path: Optional[str] = ROUTING_INDEX_PATH,
+    quantized_index_path: Optional[str] = None,
 ):
+    """Extract, chunk and embed the PDF documents and store them in the vector store
+
+    Extraction, chunking, embedding and upserting are chained as a streaming pipeline: extraction and chunking run
+    in a background thread at most `max_in_flight_chunks` chunks ahead of the embedding, chunks are accumulated
+    across documents, embedded in fixed size batches and upserted in bulk. Peak memory is thus proportional to the
+    batch sizes, not to the size of the documents.
+
+    Args:
+        input_dir: directory containing the PDF documents
+        extractors: dictionary of extractors to use
+        incremental: only re-index the new or changed documents (and pages) according to the manifest
+        manifest_path: path of the manifest with the content hashes of the indexed documents
+        embedding_batch_size: number of chunks per embedding batch
+        embedding_backend: backend running the embedding model, the configured one if None
+        onnx_quantization: instruction set of the int8 quantized ONNX embedding model, full precision if None
+        upsert_batch_size: number of chunks per upsert request to the vector store
+        workers: number of processes extracting the documents in parallel
+        pages_per_task: number of pages extracted by a worker at once
+        max_in_flight_chunks: maximum number of chunks extracted but not yet embedded
+        dedup: store exact and near duplicate chunks only once per "document", or "none"
+        partition: also store the chunks of each document in a separate collection, searched instead of the global
+            collection by the queries that filter on exactly that document
+        bm25_index_path: directory to store the BM25 index of all the stored chunks in, not built if None
+        routing_index_path: path to store the centroid embeddings of all the stored documents in, not built if None
+        quantized_index_path: directory to store the int8 quantized index of all the stored chunks in, not built if
+            None
+    """
     docs_root = Path(input_dir)
     docs_paths = list(docs_root.glob("*.pdf"))
     db = get_db_client()
 
-    print("Deleting existing collection and documents")
-    try:
-        db.delete_collection(COLLECTION_NAME)
-    except Exception as e:
-        pass
+    if embedding_backend is None:
+        embedding_backend, onnx_quantization = embedding_settings.backend, embedding_settings.onnx_quantization or None
+
+    embedding_model_id = get_embedding_model_id(embedding_backend, onnx_quantization)
+    config_hash = hash_config(
+        {
+            "extractors": {key: type(extractor).__name__ for key, extractor in extractors.items()},
+            "chunk_size": NODE_PARSER_CHUNK_SIZE,
+            "chunk_overlap": NODE_PARSER_CHUNK_OVERLAP,
+            # the quantized models embed slightly differently, so switching to or from one rebuilds the index
+            "embedding_model": embedding_model_id,
+            "dedup": dedup,
+            "partition": partition,
+        }
+    )
+
+    manifest = IndexManifest.load(manifest_path) if incremental else IndexManifest()
+
+    if manifest.config_hash != config_hash:
+        print("Deleting existing collection and documents")
+        for name in list_partitions(db) | {COLLECTION_NAME}:
+            try:
+                db.delete_collection(name)
+            except Exception:
+                pass
 
-    model_name = "sentence-transformers/all-mpnet-base-v2"
-    model_kwargs = {}
-    if torch.cuda.is_available():
-        model_kwargs["device"] = "cuda"
-    embeddings = HuggingFaceEmbeddings(model_name=model_name, model_kwargs=model_kwargs)
+        manifest = IndexManifest(config_hash=config_hash)
+        manifest.save(manifest_path)
+
+    # the app checks that it embeds the queries with the model the chunks were embedded with
+    collection_metadata = {"hnsw:space": "cosine", EMBEDDING_MODEL_METADATA_KEY: embedding_model_id}
+    collection = PartitionedCollection(
+        db, db.get_or_create_collection(COLLECTION_NAME, metadata=collection_metadata), partitioned=partition
+    )
+
+    removed_doc_names = set(manifest.documents) - {doc_path.stem for doc_path in docs_paths}
+    for doc_name in removed_doc_names:
+        print(f"Deleting removed document {doc_name}")
+        collection.delete_document(get_document_metadata(doc_name))
+        del manifest.documents[doc_name]
+        manifest.save(manifest_path)
+
+    embeddings = build_embeddings(
+        encode_kwargs={"batch_size": embedding_batch_size},
+        backend=embedding_backend,
+        onnx_quantization=onnx_quantization,
+    )
+    batcher = EmbeddingBatcher(
+        embeddings, collection, batch_size=embedding_batch_size, upsert_batch_size=upsert_batch_size
+    )
 
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=NODE_PARSER_CHUNK_SIZE, chunk_overlap=NODE_PARSER_CHUNK_OVERLAP
     )
+    fingerprint_extractors = [extractors[key] for key in PRECOMPUTED_FEATURE_KEYS if key in extractors]
+
+    num_skipped = 0
+    indexed_entries = {}
+    extraction_tasks = []
+    for doc_path in tqdm(docs_paths, desc="Hashing"):
+        doc_name = doc_path.stem
+        entry = manifest.documents.get(doc_name)
+        file_hash = hash_file(doc_path)
+
+        # the precomputed features can change without the PDF changing, so their pages still have to be hashed
+        if entry is not None and entry.file_hash == file_hash and not fingerprint_extractors:
+            num_skipped += 1
+            continue
+
+        with fitz.open(doc_path) as doc:
+            page_hashes = {page.number: hash_page(page, fingerprint_extractors) for page in doc.pages()}
+            stale_pages = get_stale_pages(doc, entry, page_hashes)
+
+        if dedup != "none" and len(stale_pages) > 0:
+            # the duplicates of a page can be kept on any other page of the document, so re-index it completely
+            stale_pages |= set(page_hashes) | set(entry.pages if entry is not None else [])
+
+        if len(stale_pages) == 0:
+            num_skipped += 1
+            if entry.file_hash != file_hash:  # type: ignore
+                manifest.documents[doc_name] = DocumentEntry(file_hash=file_hash, pages=page_hashes)
+                manifest.save(manifest_path)
+            continue
+
+        if entry is not None:
+            collection.delete_document(get_document_metadata(doc_name), page_numbers=sorted(stale_pages))
+
+        extraction_tasks.append((doc_path, sorted(stale_pages & set(page_hashes))))
+
+        # only committed to the manifest once the chunks are upserted, re-running after a crash is idempotent
+        indexed_entries[doc_name] = DocumentEntry(file_hash=file_hash, pages=page_hashes)
+
+    langchain_documents = extract_documents(
+        extraction_tasks, extractors, workers=workers, pages_per_task=pages_per_task
+    )
+    chunks = iter_chunks(tqdm(langchain_documents, desc="Extracting"), text_splitter.split_text)
+
+    deduplicator = None
+    if dedup != "none":
+        deduplicator = ChunkDeduplicator(scope_key=DB_DOC_NAME_KEY)
+        chunks = deduplicator.filter(chunks)
+
+    batcher.add_chunks(bounded_prefetch(chunks, max_items=max_in_flight_chunks))
+    batcher.flush()
+
+    if deduplicator is not None:
+        ids, metadatas = deduplicator.get_provenance_updates()
+        for i in range(0, len(ids), upsert_batch_size):
+            collection.update(ids=ids[i : i + upsert_batch_size], metadatas=metadatas[i : i + upsert_batch_size])
+
+    manifest.documents.update(indexed_entries)
+    manifest.save(manifest_path)
+
+    if bm25_index_path is not None:
+        # rebuilt from the collection, so that it also contains the chunks of the unchanged documents
+        start = time.perf_counter()
+        lexical_index = BM25Index.from_collection(collection.collection)
+        lexical_index.save(bm25_index_path)
+        print(
+            f"BM25 index: {len(lexical_index)} chunks, {len(lexical_index.vocabulary)} terms, "
+            f"built in {time.perf_counter() - start:.1f}s"
+        )
 
-    for doc_path in tqdm(docs_paths):
-        doc = fitz.open(doc_path)
-        langchain_documents = extract_from_document(doc, extractors)
-
-        chunked_docs = []
-        for document in langchain_documents:
-            chunks = text_splitter.split_text(document.page_content)
-            chunked_docs.extend([LangChainDocument(page_content=chunk, metadata=document.metadata) for chunk in chunks])
-
-        Chroma.from_documents(
-            chunked_docs,
-            embeddings,
-            collection_name=COLLECTION_NAME,
-            client=db,
-            collection_metadata={"hnsw:space": "cosine"},
+    if routing_index_path is not None:
+        start = time.perf_counter()
+        routing_index = DocumentRoutingIndex.from_collection(collection.collection)
+        routing_index.save(routing_index_path)
+        print(f"Routing index: {len(routing_index)} documents, built in {time.perf_counter() - start:.1f}s")
+
+    if quantized_index_path is not None:
+        start = time.perf_counter()
+        # the app refuses the index once the documents are re-indexed without rebuilding it
+        quantized_index = QuantizedVectorIndex.from_collection(
+            collection.collection, manifest_digest=manifest.get_digest()
         )
+        quantized_index.save(quantized_index_path)
+        print(
+            f"Quantized index: {len(quantized_index)} chunks, {quantized_index.codes.nbytes / 2**20:.1f}MiB of codes, "
+            f"built in {time.perf_counter() - start:.1f}s"
+        )
+
+    print(f"Indexed {len(docs_paths) - num_skipped} documents, {num_skipped} unchanged documents were skipped")
+    print(f"Throughput: {batcher.stats}")
+
+    if deduplicator is not None:
+        dedup_stats = deduplicator.stats
+        seconds_saved = dedup_stats.num_duplicates / max(batcher.stats.embeddings_per_second, 1e-9)
+        print(f"Deduplication: {dedup_stats}, ~{seconds_saved:.1f}s of embedding saved")
+
+    if isinstance(embeddings, CachedEmbeddings):
+        embeddings.cache.flush()
+        print(f"Embedding cache: {embeddings.cache}")
 
 
 @click.command()
@@ -143,6 +426,55 @@ def process_documents(
     default=False,
     help="Generate hypothetical questions and embed alongside the document",
 )
+@click.option(
+    "--incremental",
+    type=bool,
+    default=False,
+    help="Only re-index new or changed documents, according to the content hashes in the manifest",
+)
+@click.option("--manifest_path", type=str, default=INDEX_MANIFEST_PATH)
+@click.option("--embedding_batch_size", type=int, default=64, help="Number of chunks per embedding batch")
+@click.option(
+    "--embedding_backend",
+    type=click.Choice([backend.value for backend in EmbeddingBackend]),
+    default=embedding_settings.backend.value,
+    help="Run the embedding model with PyTorch or onnxruntime",
+)
+@click.option(
+    "--onnx_quantization",
+    type=click.Choice(["arm64", "avx2", "avx512", "avx512_vnni"]),
+    default=embedding_settings.onnx_quantization or None,
+    help="Instruction set of the int8 quantized ONNX embedding model, full precision if not set",
+)
+@click.option("--upsert_batch_size", type=int, default=1024, help="Number of chunks per upsert to the vector store")
+@click.option("--workers", type=int, default=1, help="Number of processes extracting the documents in parallel")
+@click.option("--pages_per_task", type=int, default=8, help="Number of pages extracted by a worker at once")
+@click.option(
+    "--max_in_flight_chunks", type=int, default=4096, help="Maximum number of chunks extracted but not yet embedded"
+)
+@click.option(
+    "--dedup",
+    type=click.Choice(["none", "document"]),
+    default="none",
+    help="Store exact and near duplicate chunks (e.g. boilerplate) only once per document",
+)
+@click.option(
+    "--partition",
+    type=bool,
+    default=False,
+    help="Also store every document in its own collection, used by the queries that filter on that document",
+)
+@click.option("--bm25_index", type=bool, default=True, help="Build the BM25 index used by the hybrid search")
+@click.option("--bm25_index_path", type=str, default=BM25_INDEX_PATH)
+@click.option("--routing_index", type=bool, default=True, help="Build the index routing the queries to the documents")
+@click.option("--routing_index_path", type=str, default=ROUTING_INDEX_PATH)
+@click.option(
+    "--quantized_index",
+    type=bool,
+    default=retrieval_settings.quantized_index,
+    help="Build the int8 quantized index serving the dense searches without the Chroma server's memory",
+)
+@click.option("--quantized_index_path", type=str, default=QUANTIZED_INDEX_PATH)
 def main(
     input_dir: str,
     extract_text: bool,
@@ -153,6 +485,23 @@ def main(
     text_extraction_type: str,
     summarize: bool,
     generate_hypothetical_questions: bool,
+    incremental: bool,
+    manifest_path: str,
+    embedding_batch_size: int,
+    embedding_backend: str,
+    onnx_quantization: Optional[str],
+    upsert_batch_size: int,
+    workers: int,
+    pages_per_task: int,
+    max_in_flight_chunks: int,
+    dedup: str,
+    partition: bool,
+    bm25_index: bool,
+    bm25_index_path: str,
+    routing_index: bool,
+    routing_index_path: str,
+    quantized_index: bool,
+    quantized_index_path: str,
 ):
     if generate_hypothetical_questions:
         raise NotImplementedError("Hypothetical question generation is not yet implemented")
@@ -166,20 +515,32 @@ def main(
         extractors["text"] = text_extractor
 
     if extract_images:
-        images_df = pd.read_csv(images_csv_path)
-        extractor_func = functools.partial(get_precomputed_feature, df=images_df)
-        extractors["image"] = extractor_func
+        extractors["image"] = PrecomputedFeatureIndex.from_csv(images_csv_path)
 
     if extract_tables:
-        tables_df = pd.read_csv(tables_csv_path)
-
         # ideally this step should be done in the preprocessing step, due to lack of time, we are doing it here
-        tables_df = tables_df[~tables_df["summary"].str.startswith("Error: No table found in the image.").fillna(True)]
-
-        extractor_func = functools.partial(get_precomputed_feature, df=tables_df)
-        extractors["table"] = extractor_func
+        extractors["table"] = PrecomputedFeatureIndex.from_csv(
+            tables_csv_path, exclude_prefix="Error: No table found in the image."
+        )
 
-    process_documents(input_dir, extractors)
+    process_documents(
+        input_dir,
+        extractors,
+        incremental=incremental,
+        manifest_path=manifest_path,
+        embedding_batch_size=embedding_batch_size,
+        embedding_backend=EmbeddingBackend(embedding_backend),
+        onnx_quantization=onnx_quantization,
+        upsert_batch_size=upsert_batch_size,
+        workers=workers,
+        pages_per_task=pages_per_task,
+        max_in_flight_chunks=max_in_flight_chunks,
+        dedup=dedup,
+        partition=partition,
+        bm25_index_path=bm25_index_path if bm25_index else None,
+        routing_index_path=routing_index_path if routing_index else None,
+        quantized_index_path=quantized_index_path if quantized_index else None,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+from fitz import Page
+
+logger = logging.getLogger(__name__)
+
+
+def parse_image_name(image_name: str) -> tuple[str, int]:
+    """Parse the name of an extracted image, i.e. `<document>/<page>.png` or `<document>/<page>_<index>.png`
+
+    Args:
+        image_name: name of the image, relative to the images directory
+
+    Returns:
+        the document name and the page number
+    """
+    path = Path(image_name)
+    page_number = path.stem.split("_")[0]
+
+    return str(path.parent), int(page_number)
+
+
+class PrecomputedFeatureIndex:
+    def __init__(self, summaries: dict[tuple[str, int], str]):
+        """Lookup of the precomputed (image or table) summaries of a page
+
+        Args:
+            summaries: mapping from (document name, page number) to the summaries of that page
+        """
+        self.summaries = summaries
+
+    def __call__(self, page: Page) -> str:
+        """Get the precomputed summaries of the page
+
+        Args:
+            page: PDF page
+
+        Returns:
+            the summaries of all the images of the page, joined by newlines
+        """
+        document_name = Path(page.parent.name).stem
+        return self.summaries.get((document_name, page.number), "")
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "PrecomputedFeatureIndex":
+        """Build the index from a dataframe with the `image_name` and `summary` columns
+
+        Args:
+            df: the summaries dataframe
+
+        Returns:
+            the index
+        """
+        df = df.dropna(subset=["summary"])
+        keys = df["image_name"].map(parse_image_name)
+
+        summaries = {}
+        for key, summary in zip(keys, df["summary"], strict=True):
+            summaries[key] = f"{summaries[key]}\n{summary}" if key in summaries else summary
+
+        return cls(summaries)
+
+    @classmethod
+    def from_csv(cls, csv_path: str, exclude_prefix: Optional[str] = None) -> "PrecomputedFeatureIndex":
+        """Load the index of a summaries CSV.
+
+        The index is persisted next to the CSV in Parquet format, which is used instead of the CSV as long as it is
+        up to date.
+
+        Args:
+            csv_path: path to the CSV with the `image_name` and `summary` columns
+            exclude_prefix: summaries starting with this prefix are left out of the index
+
+        Returns:
+            the index
+        """
+        path = Path(csv_path)
+        suffix = ".index.parquet"
+        if exclude_prefix is not None:
+            suffix = f".index-{hashlib.sha256(exclude_prefix.encode('utf-8')).hexdigest()[:8]}.parquet"
+        index_path = path.with_suffix(suffix)
+
+        if index_path.exists() and index_path.stat().st_mtime >= path.stat().st_mtime:
+            try:
+                index_df = pd.read_parquet(index_path)
+                return cls(
+                    {
+                        (document, int(page)): summary
+                        for document, page, summary in index_df.itertuples(index=False, name=None)
+                    }
+                )
+            except ImportError:
+                pass
+
+        df = pd.read_csv(csv_path)
+        if exclude_prefix is not None:
+            df = df[~df["summary"].str.startswith(exclude_prefix).fillna(True)]
+
+        index = cls.from_dataframe(df)
+
+        index_df = pd.DataFrame(
+            [(document, page, summary) for (document, page), summary in index.summaries.items()],
+            columns=["document", "page", "summary"],
+        )
+        try:
+            index_df.to_parquet(index_path, index=False)
+        except ImportError:
+            logger.warning("No Parquet engine installed, the summaries index of %s is not persisted", csv_path)
+
+        return index
@@ -15,7 +15,32 @@ from financeqa.constants import MessageType, OpenAIProvider
 from financeqa.generate.openai_inference import OpenAIChatCompletion, build_openai_chat_completion
 
 
-def process_image(
+def encode_image(image_path: Path) -> str:
+    """Resize an image and encode it as a base64 data URL
+
+    Args:
+        image_path: path to the image
+
+    Returns:
+        the data URL of the resized image
+    """
+    with open(str(image_path), "rb") as f:
+        img = Image.open(f)
+        width, height = img.size
+
+        # Resize
+        new_size = (1024, int(1024 * height / width)) if width > height else (int(1024 * width / height), 1024)
+        img = img.resize(new_size)
+
+        # Convert to base64
+        buffered = io.BytesIO()
+        img.save(buffered, format="PNG")
+        image = base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+    return f"data:image/png;base64,{image}"
+
+
+async def process_image(
     image_path: Path,
     inference_client: OpenAIChatCompletion,
     message_generator: Callable[[str], list[dict[str, str]]],
@@ -36,26 +61,11 @@ def process_image(
         return None
 
     try:
-        with open(str(image_path), "rb") as f:
-            img = Image.open(f)
-            width, height = img.size
-
-            # Resize
-            new_size = (1024, int(1024 * height / width)) if width > height else (int(1024 * width / height), 1024)
-            img = img.resize(new_size)
-
-            # Convert to base64
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            image = base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-        image = f"data:image/png;base64,{image}"
+        # resizing is CPU bound, the completion request is awaited on the event loop
+        image = await asyncio.to_thread(encode_image, image_path)
         messages = message_generator(image)
 
-        async def run_get_completions():
-            return await inference_client.get_completions(messages, model_name="gpt-4o", max_tokens=4096)
-
-        summary = asyncio.run(run_get_completions())
+        summary = await inference_client.get_completions(messages, model_name="gpt-4o", max_tokens=4096)
         return summary
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
@@ -79,10 +89,7 @@ async def process_batch(
     Returns:
         list of the summaries
     """
-    tasks = [
-        asyncio.to_thread(process_image, image, inference_client, message_generator, processed_images)
-        for image in batch
-    ]
+    tasks = [process_image(image, inference_client, message_generator, processed_images) for image in batch]
 
     results = await asyncio.gather(*tasks)
     return results
@@ -169,6 +176,11 @@ def postprocess(summary, tag: str) -> str:
 @click.option("--csv_path", default="./data/image_summaries.csv")
 @click.option("--task_type", type=click.Choice(["table", "image"]), default="image")
 def main(input_dir: str, csv_path: str, task_type: str):
+    # a single event loop for all the batches, the async client can't be shared across event loops
+    asyncio.run(summarize_images(input_dir, csv_path, task_type))
+
+
+async def summarize_images(input_dir: str, csv_path: str, task_type: str):
     chat_completion_client = build_openai_chat_completion(OpenAIProvider.OPENAI_AZURE)
 
     message_generator = get_message_generator(task_type)
@@ -180,10 +192,10 @@ def main(input_dir: str, csv_path: str, task_type: str):
     df = pd.read_csv(csv_path) if os.path.exists(csv_path) else pd.DataFrame(columns=["image_name", "summary"])
     processed_images = set(str(tables_root / image_name) for image_name in df["image_name"].tolist())
 
-    batch_size = 2  # otherwise I get 429 rate limit errors
+    batch_size = 8  # 429 rate limit errors are retried with backoff by the shared transport
     for i in tqdm(range(0, len(tables_images), batch_size), desc="Processing Batches"):
         batch = tables_images[i : i + batch_size]
-        results = asyncio.run(process_batch(batch, chat_completion_client, message_generator, processed_images))
+        results = await process_batch(batch, chat_completion_client, message_generator, processed_images)
 
         df_entries = [(b, postprocess(r, tag)) for b, r in zip(batch, results) if r is not None]
         new_entries = pd.DataFrame(df_entries, columns=["image_name", "summary"])
@@ -0,0 +1,366 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from chromadb.api.models.Collection import Collection
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.constants import DB_DOC_NAME_KEY
+from financeqa.retrieval.reranking import tokenize
+
+# metadata shared by all the chunks of a document, filters on these fields are evaluated per document
+DOCUMENT_FIELDS = (DB_DOC_NAME_KEY, "year", "quarter", "ticker", "company")
+
+# chunks loaded by any index, by digest, so that the indexes built from the same collection share them in memory
+_loaded_chunks: dict[str, list[dict[str, Any]]] = {}
+_loaded_chunks_lock = threading.Lock()
+
+_COMPARISONS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+}
+
+
+def matches_filter(metadata: dict[str, Any], search_filter: dict[str, Any]) -> bool:
+    """Check whether metadata matches a Chroma `where` filter
+
+    Args:
+        metadata: the metadata
+        search_filter: the filter, e.g. as generated by `generate_separated_kwargs`
+
+    Returns:
+        whether the metadata matches the filter
+    """
+    for key, condition in search_filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, sub_filter) for sub_filter in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            if not all(_COMPARISONS[operator](value, operand) for operator, operand in condition.items()):
+                return False
+        elif metadata.get(key) != condition:
+            return False
+
+    return True
+
+
+def get_filter_fields(search_filter: dict[str, Any]) -> set[str]:
+    """Get the metadata fields a filter refers to
+
+    Args:
+        search_filter: the filter
+
+    Returns:
+        the field names
+    """
+    fields = set()
+    for key, condition in search_filter.items():
+        if key in ("$and", "$or"):
+            for sub_filter in condition:
+                fields |= get_filter_fields(sub_filter)
+        else:
+            fields.add(key)
+
+    return fields
+
+
+def save_chunks(path: str | Path, chunks: list[dict[str, Any]]):
+    """Write the chunks of an index to disk, with their digest
+
+    Args:
+        path: directory of the index
+        chunks: the id, text and metadata of each chunk
+    """
+    path = Path(path)
+    sha = hashlib.sha256()
+    with open(path / "chunks.jsonl", "w") as f:
+        for chunk in chunks:
+            line = json.dumps(chunk) + "\n"
+            sha.update(line.encode("utf-8"))
+            f.write(line)
+
+    (path / "chunks.sha256").write_text(sha.hexdigest())
+
+
+def load_chunks(path: str | Path) -> list[dict[str, Any]]:
+    """Load the chunks of an index from disk, reusing the ones already loaded by another index if they are the same
+
+    Args:
+        path: directory of the index
+
+    Returns:
+        the id, text and metadata of each chunk
+    """
+    path = Path(path)
+    digest_path = path / "chunks.sha256"
+    digest = digest_path.read_text() if digest_path.exists() else None
+
+    with _loaded_chunks_lock:
+        if digest in _loaded_chunks:
+            return _loaded_chunks[digest]
+
+        with open(path / "chunks.jsonl") as f:
+            chunks = [json.loads(line) for line in f]
+        if digest is not None:
+            _loaded_chunks[digest] = chunks
+
+        return chunks
+
+
+class BM25Index:
+    def __init__(
+        self,
+        vocabulary: list[str],
+        term_offsets: np.ndarray,
+        postings_chunks: np.ndarray,
+        postings_tfs: np.ndarray,
+        chunk_lengths: np.ndarray,
+        chunk_documents: np.ndarray,
+        chunks: list[dict[str, Any]],
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        """In-process BM25 index of the chunks, stored as an inverted index in compressed sparse row format.
+
+        Use `build` or `load` to create one.
+
+        Args:
+            vocabulary: the terms
+            term_offsets: start of the postings of each term, plus the total number of postings
+            postings_chunks: chunk of each posting
+            postings_tfs: frequency of the term in the chunk of each posting
+            chunk_lengths: number of tokens of each chunk
+            chunk_documents: index of the document of each chunk
+            chunks: the id, text and metadata of each chunk
+            k1: term frequency saturation
+            b: chunk length normalization
+        """
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.term_offsets = term_offsets
+        self.postings_chunks = postings_chunks
+        self.postings_tfs = postings_tfs
+        self.chunk_lengths = chunk_lengths
+        self.chunk_documents = chunk_documents
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+
+        self._average_length = float(chunk_lengths.mean()) if len(chunk_lengths) > 0 else 1.0
+        self._documents: list[dict[str, Any]] = [{} for _ in range(int(chunk_documents.max(initial=-1)) + 1)]
+        for chunk, document in zip(chunks, chunk_documents, strict=True):
+            self._documents[document] = {key: chunk["metadata"].get(key) for key in DOCUMENT_FIELDS}
+
+        self._lock = threading.Lock()
+        self._masks: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @classmethod
+    def build(cls, chunks: Iterable[tuple[str, str, dict[str, Any]]]) -> "BM25Index":
+        """Build the index
+
+        Args:
+            chunks: the id, text and metadata of each chunk
+
+        Returns:
+            the index
+        """
+        postings: dict[str, list[tuple[int, int]]] = {}
+        stored_chunks = []
+        chunk_lengths = []
+        chunk_documents = []
+        document_indices: dict[str, int] = {}
+
+        for i, (chunk_id, text, metadata) in enumerate(chunks):
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((i, tf))
+
+            stored_chunks.append({"id": chunk_id, "text": text, "metadata": metadata})
+            chunk_lengths.append(len(tokens))
+            chunk_documents.append(document_indices.setdefault(metadata[DB_DOC_NAME_KEY], len(document_indices)))
+
+        vocabulary = sorted(postings)
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(postings[term]) for term in vocabulary])
+
+        postings_chunks = np.empty(term_offsets[-1], dtype=np.int32)
+        postings_tfs = np.empty(term_offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(vocabulary):
+            term_postings = np.asarray(postings[term], dtype=np.int64).reshape(-1, 2)
+            postings_chunks[term_offsets[i] : term_offsets[i + 1]] = term_postings[:, 0]
+            postings_tfs[term_offsets[i] : term_offsets[i + 1]] = np.minimum(term_postings[:, 1], 2**16 - 1)
+
+        return cls(
+            vocabulary,
+            term_offsets,
+            postings_chunks,
+            postings_tfs,
+            np.asarray(chunk_lengths, dtype=np.int32),
+            np.asarray(chunk_documents, dtype=np.int32),
+            stored_chunks,
+        )
+
+    @classmethod
+    def from_collection(cls, collection: Collection, batch_size: int = 1024) -> "BM25Index":
+        """Build the index of all the chunks stored in a collection
+
+        Args:
+            collection: the collection
+            batch_size: number of chunks fetched at once
+
+        Returns:
+            the index
+        """
+
+        def iter_collection():
+            offset = 0
+            while True:
+                result = collection.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+                if len(result["ids"]) == 0:
+                    return
+
+                yield from zip(result["ids"], result["documents"], result["metadatas"], strict=True)  # type: ignore
+                offset += len(result["ids"])
+
+        # chunks are sorted so that the index doesn't depend on the storage order of the collection
+        return cls.build(sorted(iter_collection(), key=lambda chunk: chunk[0]))
+
+    def save(self, path: str | Path):
+        """Write the index to disk, replacing the previous version
+
+        Args:
+            path: directory to store the index in
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        np.savez(
+            tmp_path / "postings.npz",
+            term_offsets=self.term_offsets,
+            postings_chunks=self.postings_chunks,
+            postings_tfs=self.postings_tfs,
+            chunk_lengths=self.chunk_lengths,
+            chunk_documents=self.chunk_documents,
+        )
+        (tmp_path / "vocabulary.json").write_text(json.dumps(list(self.vocabulary)))
+        save_chunks(tmp_path, self.chunks)
+
+        old_path = path.with_name(f"{path.name}.old")
+        if path.exists():
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "BM25Index":
+        """Load the index from disk
+
+        Args:
+            path: directory the index is stored in
+
+        Returns:
+            the index
+        """
+        path = Path(path)
+        with np.load(path / "postings.npz") as data:
+            arrays = {key: data[key] for key in data.files}
+
+        vocabulary = json.loads((path / "vocabulary.json").read_text())
+        chunks = load_chunks(path)
+
+        return cls(
+            vocabulary,
+            arrays["term_offsets"],
+            arrays["postings_chunks"],
+            arrays["postings_tfs"],
+            arrays["chunk_lengths"],
+            arrays["chunk_documents"],
+            chunks,
+        )
+
+    def _get_mask(self, search_filter: dict[str, Any]) -> np.ndarray:
+        key = json.dumps(search_filter, sort_keys=True)
+
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+
+        if get_filter_fields(search_filter) <= set(DOCUMENT_FIELDS):
+            document_mask = np.array([matches_filter(document, search_filter) for document in self._documents])
+            mask = document_mask[self.chunk_documents] if len(document_mask) > 0 else np.zeros(0, dtype=bool)
+        else:
+            mask = np.array([matches_filter(chunk["metadata"], search_filter) for chunk in self.chunks], dtype=bool)
+
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > 256:
+                self._masks.popitem(last=False)
+
+        return mask
+
+    def search(self, query: str, k: int = 4, filter: Optional[dict[str, Any]] = None) -> list[LangChainDocument]:
+        """Search the chunks that best match the query
+
+        Args:
+            query: the query
+            k: number of chunks to return
+            filter: Chroma `where` filter on the metadata of the chunks
+
+        Returns:
+            the best matching chunks, best first
+        """
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        num_chunks = len(self.chunks)
+
+        for term in set(tokenize(query)):
+            term_index = self.vocabulary.get(term)
+            if term_index is None:
+                continue
+
+            start, end = self.term_offsets[term_index], self.term_offsets[term_index + 1]
+            chunk_indices = self.postings_chunks[start:end]
+            tfs = self.postings_tfs[start:end].astype(np.float32)
+            lengths = self.chunk_lengths[chunk_indices]
+
+            document_frequency = end - start
+            idf = math.log(1 + (num_chunks - document_frequency + 0.5) / (document_frequency + 0.5))
+            scores[chunk_indices] += (
+                idf * tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * lengths / self._average_length))
+            )
+
+        if filter:
+            scores[~self._get_mask(filter)] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [
+            LangChainDocument(
+                id=self.chunks[i]["id"], page_content=self.chunks[i]["text"], metadata=self.chunks[i]["metadata"]
+            )
+            for i in candidates
+        ]
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.db.partitions import PartitionRouter
+from financeqa.retrieval.bm25_index import BM25Index
+from financeqa.retrieval.reranking import reciprocal_rank_fusion
+
+logger = logging.getLogger(__name__)
+
+
+class SearchTimeoutError(Exception):
+    """Raised when all the searches of a query timed out, or when they waited too long for a thread"""
+
+
+class ConcurrentSearcher:
+    def __init__(
+        self,
+        router: PartitionRouter,
+        max_concurrency: int = 8,
+        timeout: float = 10.0,
+        queue_timeout: Optional[float] = None,
+        lexical_index: Optional[BM25Index] = None,
+    ):
+        """Runs the searches of a query concurrently, each on the collection selected by the partition router.
+
+        The query is embedded once and the embedding is reused by all the searches. The (blocking) Chroma searches
+        run on a dedicated thread pool, so they don't block the event loop and at most `max_concurrency` of them
+        run at the same time.
+
+        If a lexical index is given, each search is hybrid: the lexical search with the same filter runs in parallel
+        with the dense search, and their results are fused with reciprocal rank fusion.
+
+        Args:
+            router: router selecting the collection to search for each search kwargs
+            max_concurrency: maximum number of searches running at the same time
+            timeout: number of seconds after which a running search is given up on, not counting the time it waited
+                for a thread
+            queue_timeout: number of seconds after which a query whose embedding or searches are still waiting for a
+                thread is given up on, `timeout` if None
+            lexical_index: BM25 index of the chunks, dense search only if None
+        """
+        self.router = router
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout if queue_timeout is not None else timeout
+        self.lexical_index = lexical_index
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="search")
+        self._embeddings_in_flight: dict[str, asyncio.Future] = {}
+
+    def _search(self, embedding: list[float], search_kwargs: dict[str, Any]) -> list[LangChainDocument]:
+        vector_store, search_kwargs = self.router.route(search_kwargs)
+        return vector_store.similarity_search_by_vector(embedding, **search_kwargs)
+
+    def _lexical_search(self, query: str, search_kwargs: dict[str, Any]) -> list[LangChainDocument]:
+        return self.lexical_index.search(query, k=search_kwargs["k"], filter=search_kwargs.get("filter"))
+
+    async def _run_with_timeout(
+        self, function: Callable[..., list[LangChainDocument]], *args, deadline: float
+    ) -> list[LangChainDocument]:
+        # the timeout starts when a thread picks the search up, so that searches queued under load don't time out
+        # before they even started, while the deadline of the query bounds the time spent in the queue
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+        given_up = threading.Event()
+
+        def run() -> list[LangChainDocument]:
+            if given_up.is_set():
+                return []
+            loop.call_soon_threadsafe(lambda: started.done() or started.set_result(None))
+            return function(*args)
+
+        future = loop.run_in_executor(self._executor, run)
+        try:
+            await asyncio.wait(
+                [started, future], timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not started.done() and not future.done():
+                raise SearchTimeoutError(f"The search waited for a thread for more than {self.queue_timeout}s")
+
+            return await asyncio.wait_for(future, timeout=self.timeout)
+        finally:
+            # a search given up on while still queued is skipped
+            given_up.set()
+            started.cancel()
+
+    async def _hybrid_search(
+        self,
+        query: str,
+        embedding: list[float],
+        search_kwargs: dict[str, Any],
+        deadline: float,
+        dense_only: bool = False,
+    ) -> list[LangChainDocument]:
+        dense_search = self._run_with_timeout(self._search, embedding, search_kwargs, deadline=deadline)
+        if self.lexical_index is None or dense_only:
+            return await dense_search
+
+        lexical_search = self._run_with_timeout(self._lexical_search, query, search_kwargs, deadline=deadline)
+        dense_documents, lexical_documents = await asyncio.gather(dense_search, lexical_search)
+
+        return reciprocal_rank_fusion([dense_documents, lexical_documents], k=search_kwargs["k"])
+
+    async def _search_with_timeout(
+        self,
+        query: str,
+        embedding: list[float],
+        search_kwargs: dict[str, Any],
+        deadline: float,
+        dense_only: bool = False,
+    ) -> Optional[list[LangChainDocument]]:
+        try:
+            return await self._hybrid_search(query, embedding, search_kwargs, deadline, dense_only=dense_only)
+        except asyncio.TimeoutError:
+            # the other searches may still answer the query, so a slow one doesn't fail the whole request
+            logger.warning(f"Search timed out after {self.timeout}s for search kwargs: {search_kwargs}")
+            return None
+
+    async def embed_query(self, query: str) -> list[float]:
+        """Embed the query on the search thread pool, sharing the embedding of the same query in flight
+
+        Args:
+            query: the query
+
+        Returns:
+            the query embedding
+        """
+        loop = asyncio.get_running_loop()
+
+        # e.g. the answer cache lookup and the speculative search of a request both embed its query
+        future = self._embeddings_in_flight.get(query)
+        if future is None or future.get_loop() is not loop:
+            future = loop.run_in_executor(self._executor, self.router.embeddings.embed_query, query)
+            self._embeddings_in_flight[query] = future
+            future.add_done_callback(lambda done: self._remove_embedding(query, done))
+
+        return await asyncio.shield(future)
+
+    def _remove_embedding(self, query: str, future: asyncio.Future):
+        if self._embeddings_in_flight.get(query) is future:
+            del self._embeddings_in_flight[query]
+
+    async def search(
+        self, query: str, search_kwargs_list: list[dict[str, Any]], dense_only: bool = False
+    ) -> list[list[LangChainDocument]]:
+        """Search the query once per search kwargs, concurrently
+
+        Args:
+            query: the query
+            search_kwargs_list: search kwargs of each search, i.e. `k` and optionally a `filter`
+            dense_only: skip the lexical search, even if there is a lexical index
+
+        Returns:
+            the documents found by each search, in the order of the search kwargs, none for the searches that timed out
+
+        Raises:
+            SearchTimeoutError: if all the searches timed out, or if the query waited for threads for more than the
+                queue timeout
+        """
+        deadline = asyncio.get_running_loop().time() + self.queue_timeout
+        try:
+            embedding = await asyncio.wait_for(self.embed_query(query), timeout=self.queue_timeout)
+        except asyncio.TimeoutError as e:
+            raise SearchTimeoutError(f"The query wasn't embedded within {self.queue_timeout}s") from e
+
+        results = await asyncio.gather(
+            *(
+                self._search_with_timeout(query, embedding, search_kwargs, deadline, dense_only=dense_only)
+                for search_kwargs in search_kwargs_list
+            )
+        )
+        if len(results) > 0 and all(documents is None for documents in results):
+            raise SearchTimeoutError(f"All the {len(results)} searches timed out after {self.timeout}s")
+
+        return [documents if documents is not None else [] for documents in results]
+
+    async def fuse_lexical_search(
+        self, query: str, dense_documents: list[LangChainDocument], search_kwargs: dict[str, Any]
+    ) -> list[LangChainDocument]:
+        """Complete the results of a dense search obtained otherwise (e.g. by post-filtering the candidates of a
+        broader search) into the results of the hybrid search
+
+        Args:
+            query: the query
+            dense_documents: the results of the dense search
+            search_kwargs: `k` and optionally the `filter` of the search
+
+        Returns:
+            the results of the hybrid search, the dense results if there is no lexical index
+
+        Raises:
+            SearchTimeoutError: if the lexical search waited for a thread for more than the queue timeout
+        """
+        if self.lexical_index is None:
+            return dense_documents
+
+        deadline = asyncio.get_running_loop().time() + self.queue_timeout
+        try:
+            lexical_documents = await self._run_with_timeout(
+                self._lexical_search, query, search_kwargs, deadline=deadline
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Lexical search timed out after {self.timeout}s for search kwargs: {search_kwargs}")
+            return dense_documents[: search_kwargs["k"]]
+
+        return reciprocal_rank_fusion([dense_documents, lexical_documents], k=search_kwargs["k"])
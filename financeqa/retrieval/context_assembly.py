@@ -0,0 +1,197 @@
+import logging
+import math
+from typing import Callable, Optional
+
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.constants import DB_DOC_NAME_KEY, NODE_PARSER_CHUNK_OVERLAP
+from financeqa.utils import format_doc_for_context
+
+logger = logging.getLogger(__name__)
+
+# separates the non-adjacent chunks of a page
+SEGMENT_SEPARATOR = "\n...\n"
+CONTEXT_SEPARATOR = "\n\n"
+
+
+def approximate_token_count(text: str) -> int:
+    """Approximate the number of tokens of a text, at about 4 characters per token
+
+    Args:
+        text: the text
+
+    Returns:
+        the approximate number of tokens
+    """
+    return math.ceil(len(text) / 4)
+
+
+def load_token_counter(
+    tokenizer_name: Optional[str], token: Optional[str] = None, cache_dir: Optional[str] = None
+) -> Callable[[str], int]:
+    """Load a function counting the tokens of a text with the tokenizer of the generator
+
+    Args:
+        tokenizer_name: name of the Hugging Face tokenizer, approximate counts if empty
+        token: Hugging Face token, for gated tokenizers
+        cache_dir: directory the tokenizer is downloaded to and loaded from, the Hugging Face cache if None
+
+    Returns:
+        the token counting function, approximate if the tokenizer can't be loaded
+    """
+    if tokenizer_name:
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, token=token, cache_dir=cache_dir)
+            return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+        except Exception as e:
+            logger.warning(f"Could not load the tokenizer {tokenizer_name}, approximating token counts: {str(e)}")
+
+    return approximate_token_count
+
+
+def stitch(
+    left: str, right: str, min_overlap: int = 4, max_overlap: int = 2 * NODE_PARSER_CHUNK_OVERLAP
+) -> Optional[str]:
+    """Stitch two adjacent chunks, i.e. chunks where the end of the left one overlaps the start of the right one
+
+    Args:
+        left: the left chunk
+        right: the right chunk
+        min_overlap: minimum number of overlapping characters
+        max_overlap: maximum number of overlapping characters
+
+    Returns:
+        the stitched chunks, None if they don't overlap
+    """
+    for size in range(min(len(left), len(right), max_overlap), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+
+    return None
+
+
+def merge_segments(segments: list[str], text: str) -> list[str]:
+    """Add a chunk to the segments of a page, deduplicating and stitching overlapping chunks
+
+    Args:
+        segments: the non-overlapping segments of the page
+        text: the chunk
+
+    Returns:
+        the new segments
+    """
+    if any(text in segment for segment in segments):
+        return segments
+
+    # the segments contained in the chunk are replaced by it
+    segments = [segment for segment in segments if segment not in text]
+    for i, segment in enumerate(segments):
+        stitched = stitch(segment, text) or stitch(text, segment)
+        if stitched is not None:
+            # the stitched segment may now overlap another one
+            return merge_segments(segments[:i] + segments[i + 1 :], stitched)
+
+    return segments + [text]
+
+
+class ContextAssembler:
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+        max_tokens: int = 3072,
+        min_truncated_tokens: int = 64,
+    ):
+        """Assembles the context of the prompt from the retrieved chunks, within a token budget.
+
+        The chunks of the same page are deduplicated and the adjacent ones are stitched together, then the pages are
+        packed in the order of their best ranked chunk until the budget is spent. A page that doesn't fit is truncated
+        if at least `min_truncated_tokens` tokens are left, and skipped otherwise, in which case the next pages may
+        still fit.
+
+        Args:
+            count_tokens: function counting the tokens of a text with the tokenizer of the generator
+            max_tokens: maximum number of tokens of the context
+            min_truncated_tokens: minimum number of tokens left in the budget for a page to be truncated into it
+        """
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.min_truncated_tokens = min_truncated_tokens
+
+    def merge(self, docs: list[LangChainDocument]) -> list[LangChainDocument]:
+        """Merge the chunks of each page, deduplicating and stitching the overlapping ones
+
+        Args:
+            docs: the chunks, best first
+
+        Returns:
+            a document per page, in the order of their best chunk
+        """
+        pages: dict[tuple, tuple[dict, list[str]]] = {}
+        for doc in docs:
+            key = (doc.metadata[DB_DOC_NAME_KEY], doc.metadata["page_number"])
+            metadata, segments = pages.get(key, (doc.metadata, []))
+            pages[key] = (metadata, merge_segments(segments, doc.page_content))
+
+        return [
+            LangChainDocument(page_content=SEGMENT_SEPARATOR.join(segments), metadata=metadata)
+            for metadata, segments in pages.values()
+        ]
+
+    def _truncate(self, doc: LangChainDocument, max_tokens: int) -> Optional[str]:
+        words = doc.page_content.split(" ")
+
+        def format_prefix(num_words: int) -> str:
+            return format_doc_for_context(
+                LangChainDocument(page_content=" ".join(words[:num_words]) + " ...", metadata=doc.metadata)
+            )
+
+        # largest number of words whose formatted prefix fits
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(format_prefix(middle)) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+
+        return format_prefix(low) if low > 0 else None
+
+    def assemble(self, docs: list[LangChainDocument]) -> tuple[str, int]:
+        """Assemble the context from the retrieved chunks
+
+        Args:
+            docs: the chunks, best first
+
+        Returns:
+            the context and its number of tokens
+        """
+        separator_tokens = self.count_tokens(CONTEXT_SEPARATOR)
+        parts: list[str] = []
+        budget = self.max_tokens
+
+        for doc in self.merge(docs):
+            available = budget - (separator_tokens if len(parts) > 0 else 0)
+            part: Optional[str] = format_doc_for_context(doc)
+            num_tokens = self.count_tokens(part)
+
+            if num_tokens > available:
+                part = self._truncate(doc, available) if available >= self.min_truncated_tokens else None
+                if part is None:
+                    continue
+                num_tokens = self.count_tokens(part)
+
+            parts.append(part)
+            budget = available - num_tokens
+
+        # the tokens of the joined parts may differ slightly from the sum of their tokens
+        context = CONTEXT_SEPARATOR.join(parts)
+        num_tokens = self.count_tokens(context)
+        while num_tokens > self.max_tokens and len(parts) > 0:
+            parts.pop()
+            context = CONTEXT_SEPARATOR.join(parts)
+            num_tokens = self.count_tokens(context)
+
+        logger.debug(f"Assembled {len(parts)} pages from {len(docs)} chunks into {num_tokens} context tokens")
+        return context, num_tokens
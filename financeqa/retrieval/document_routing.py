@@ -0,0 +1,208 @@
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from chromadb.api.models.Collection import Collection
+
+from financeqa.constants import DB_DOC_NAME_KEY
+
+
+class DocumentRoutingIndex:
+    def __init__(
+        self, doc_names: list[str], centroids: np.ndarray, years: np.ndarray, quarters: list[str], tickers: list[str]
+    ):
+        """Index of the centroid embedding of each document, to shortlist the documents a query is about with a single
+        matrix product.
+
+        Use `from_collection` or `load` to create one.
+
+        Args:
+            doc_names: names of the documents, i.e. `<year> <quarter> <ticker>`
+            centroids: normalized mean of the normalized embeddings of the chunks of each document
+            years: year of each document
+            quarters: quarter of each document
+            tickers: ticker of each document
+        """
+        self.doc_names = doc_names
+        self.centroids = centroids
+        self.years = years
+        self.quarters = quarters
+        self.tickers = tickers
+
+    def __len__(self) -> int:
+        return len(self.doc_names)
+
+    @classmethod
+    def from_collection(cls, collection: Collection, batch_size: int = 1024) -> "DocumentRoutingIndex":
+        """Build the index from the embeddings of all the chunks stored in a collection
+
+        Args:
+            collection: the collection
+            batch_size: number of chunks fetched at once
+
+        Returns:
+            the index
+        """
+        sums: dict[str, np.ndarray] = {}
+        metadata: dict[str, tuple[int, str, str]] = {}
+
+        offset = 0
+        while True:
+            result = collection.get(limit=batch_size, offset=offset, include=["embeddings", "metadatas"])
+            if len(result["ids"]) == 0:
+                break
+
+            embeddings = np.asarray(result["embeddings"], dtype=np.float32)
+            embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+            for embedding, chunk_metadata in zip(embeddings, result["metadatas"], strict=True):  # type: ignore
+                doc_name = chunk_metadata[DB_DOC_NAME_KEY]
+                sums[doc_name] = sums.get(doc_name, 0.0) + embedding
+                metadata[doc_name] = (chunk_metadata["year"], chunk_metadata["quarter"], chunk_metadata["ticker"])
+
+            offset += len(result["ids"])
+
+        doc_names = sorted(sums)
+        centroids = np.stack([sums[doc_name] for doc_name in doc_names]) if len(doc_names) > 0 else np.zeros((0, 0))
+        centroids = centroids.astype(np.float32)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        return cls(
+            doc_names,
+            centroids,
+            np.asarray([metadata[doc_name][0] for doc_name in doc_names], dtype=np.int32),
+            [str(metadata[doc_name][1]) for doc_name in doc_names],
+            [str(metadata[doc_name][2]) for doc_name in doc_names],
+        )
+
+    def save(self, path: str | Path):
+        """Write the index to disk, replacing the previous version
+
+        Args:
+            path: path of the `.npz` file
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.stem}.tmp.npz")
+
+        np.savez(
+            tmp_path,
+            doc_names=np.asarray(self.doc_names, dtype=str),
+            centroids=self.centroids,
+            years=self.years,
+            quarters=np.asarray(self.quarters, dtype=str),
+            tickers=np.asarray(self.tickers, dtype=str),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | Path) -> "DocumentRoutingIndex":
+        """Load the index from disk
+
+        Args:
+            path: path of the `.npz` file
+
+        Returns:
+            the index
+        """
+        with np.load(path) as data:
+            return cls(
+                data["doc_names"].tolist(),
+                data["centroids"],
+                data["years"],
+                data["quarters"].tolist(),
+                data["tickers"].tolist(),
+            )
+
+    def shortlist(
+        self, embedding: list[float], k: int, min_score: Optional[float] = None
+    ) -> list[tuple[int, str, str, float]]:
+        """Shortlist the documents whose centroid is the most similar to the query embedding
+
+        Args:
+            embedding: the query embedding
+            k: maximum number of documents to shortlist
+            min_score: minimum cosine similarity between the query and the centroids, no minimum if None
+
+        Returns:
+            the year, quarter, ticker and similarity of the shortlisted documents, most similar first
+        """
+        if len(self.doc_names) == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self.centroids @ (query / (np.linalg.norm(query) or 1.0))
+
+        indices = np.argsort(-scores, kind="stable")[:k]
+        if min_score is not None:
+            indices = indices[scores[indices] >= min_score]
+
+        return [(int(self.years[i]), self.quarters[i], self.tickers[i], float(scores[i])) for i in indices]
+
+
+class DocumentRouter:
+    def __init__(
+        self,
+        index: DocumentRoutingIndex,
+        top_k: int = 3,
+        min_score: float = 0.25,
+        min_margin: float = 0.05,
+        prompt_k: int = 20,
+    ):
+        """Shortlists the documents a query is about with the routing index, instead of or before asking the LLM.
+
+        The centroids of filings of the same type are close to each other, so a query is only routed when the
+        documents it is routed to stand out from the others.
+
+        Args:
+            index: the routing index
+            top_k: maximum number of documents a query without explicit metadata is routed to
+            min_score: minimum similarity between the query and the centroid of a document it is routed to
+            min_margin: minimum difference between the similarity of the least similar document a query is routed to
+                and that of the most similar document it isn't routed to
+            prompt_k: number of documents shortlisted in the prompt of the LLM
+        """
+        self.index = index
+        self.top_k = top_k
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.prompt_k = prompt_k
+
+    def route(self, embedding: list[float]) -> list[tuple[int, str, str]]:
+        """Get the documents a query without explicit metadata is about
+
+        Args:
+            embedding: the query embedding
+
+        Returns:
+            the year, quarter and ticker of the documents, most similar first, none if the router isn't confident
+        """
+        shortlist = self.index.shortlist(embedding, self.top_k + 1)
+        routed = [document for document in shortlist[: self.top_k] if document[3] >= self.min_score]
+        if len(routed) == 0:
+            return []
+
+        # the runner-up is the most similar document that isn't routed to
+        if len(shortlist) > len(routed) and routed[-1][3] - shortlist[len(routed)][3] < self.min_margin:
+            return []
+
+        return [(year, quarter, ticker) for year, quarter, ticker, _ in routed]
+
+    def get_candidate_doc_ids(self, doc_ids: list[str], embedding: list[float], tickers: set[str]) -> list[str]:
+        """Shorten the list of documents given to the LLM
+
+        Args:
+            doc_ids: ids of all the documents, i.e. `<year> <quarter> <ticker>`
+            embedding: the query embedding
+            tickers: tickers mentioned by the query, all their documents are kept
+
+        Returns:
+            the candidate document ids, in the order of `doc_ids`, all of them if none is shortlisted
+        """
+        shortlisted = {
+            f"{year} {quarter} {ticker}" for year, quarter, ticker, _ in self.index.shortlist(embedding, self.prompt_k)
+        }
+        candidates = [doc_id for doc_id in doc_ids if doc_id in shortlisted or doc_id.split()[-1] in tickers]
+
+        return candidates if len(candidates) > 0 else doc_ids
@@ -0,0 +1,158 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so that trivially different spellings of it share a cache entry
+
+    Args:
+        query: the query
+
+    Returns:
+        the lowercased query, with collapsed whitespace and without trailing punctuation
+    """
+    return _WHITESPACE_RE.sub(" ", query).strip().rstrip("?!. ").lower()
+
+
+def fingerprint_doc_ids(doc_ids: list[str]) -> str:
+    """Fingerprint a set of document ids, independently of their order
+
+    Args:
+        doc_ids: the document ids
+
+    Returns:
+        the fingerprint
+    """
+    return hashlib.sha256("\n".join(sorted(doc_ids)).encode("utf-8")).hexdigest()[:16]
+
+
+class ExtractionCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, db_path: Optional[str | Path] = None):
+        """LRU cache with TTL of the metadata extracted from the queries.
+
+        The entries are keyed on the normalized query and the fingerprint of the document ids, so they are
+        invalidated as soon as the set of documents changes. If `db_path` is set, the entries are also stored in a
+        SQLite database, shared by all the processes (e.g. the uvicorn workers) using the same path.
+
+        Args:
+            max_entries: maximum number of entries kept in memory
+            ttl: number of seconds after which an entry expires
+            db_path: path to the SQLite database, in memory only if empty
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self)}/{self.max_entries} entries, {self.hits} hits ({self.disk_hits} from disk), "
+            f"{self.misses} misses ({self.hit_rate:.1%} hit rate)"
+        )
+
+    @staticmethod
+    def get_key(query: str, doc_ids: list[str]) -> str:
+        """Get the cache key of a query
+
+        Args:
+            query: the query
+            doc_ids: the ids of the documents the query is matched against
+
+        Returns:
+            the cache key
+        """
+        return f"{fingerprint_doc_ids(doc_ids)}:{normalize_query(query)}"
+
+    def get(self, query: str, doc_ids: list[str]) -> Optional[str]:
+        """Look up the extracted metadata of a query
+
+        Args:
+            query: the query
+            doc_ids: the ids of the documents the query is matched against
+
+        Returns:
+            the extracted metadata as JSON, None if it is not cached or has expired
+        """
+        key = self.get_key(query, doc_ids)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self._entries.pop(key, None)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM extractions WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+
+                if row is not None:
+                    self._set(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, doc_ids: list[str], value: str):
+        """Store the extracted metadata of a query
+
+        Args:
+            query: the query
+            doc_ids: the ids of the documents the query is matched against
+            value: the extracted metadata as JSON
+        """
+        key = self.get_key(query, doc_ids)
+        expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._set(key, value, expires_at)
+
+            if self._db is not None:
+                self._db.execute("DELETE FROM extractions WHERE expires_at <= ?", (time.time(),))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO extractions (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, expires_at),
+                )
+
+    def _set(self, key: str, value: str, expires_at: float):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
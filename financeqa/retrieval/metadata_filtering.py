@@ -1,9 +1,12 @@
-from typing import Any
+import re
+from typing import Any, Optional
 
 from pydantic import BaseModel
 
-from financeqa.constants import MessageType
+from financeqa.constants import TICKER_TO_NAME_MAP, MessageType
 from financeqa.generate.base_inference_client import BaseInferenceClient
+from financeqa.retrieval.document_routing import DocumentRouter
+from financeqa.retrieval.extraction_cache import ExtractionCache
 
 
 class MetadataExtractor(BaseModel):
@@ -16,6 +19,138 @@ class Response(BaseModel):
     list_of_docs: list[MetadataExtractor]
 
 
+_ORDINAL_TO_QUARTER = {"first": "Q1", "second": "Q2", "third": "Q3", "fourth": "Q4"}
+
+# "Q3 2023", "third quarter of 2023", "2023 Q3"
+_QUARTER_YEAR_RE = re.compile(
+    r"\b(?:(?:Q(?P<q>[1-4])|(?P<ordinal>first|second|third|fourth)\s+quarter)[\s,]+(?:of\s+)?(?P<year>20\d{2})|"
+    r"(?P<year_first>20\d{2})\s+Q(?P<q_last>[1-4]))\b",
+    re.IGNORECASE,
+)
+_QUARTER_RE = re.compile(r"\b(?:Q[1-4]|(?:first|second|third|fourth)\s+quarter)\b", re.IGNORECASE)
+_YEAR_RE = re.compile(r"\b(?P<year>20\d{2})\b")
+# the documents are named after the quarters of the companies' reports, which don't consistently match their fiscal
+# calendars (e.g. Microsoft's fiscal Q1 2024 is "2023 Q3") or the calendar quarters of dates (e.g. "ended
+# October 30, 2022" is Nvidia's "2022 Q3"), so fiscal periods and dates are left to the LLM
+_FISCAL_RE = re.compile(r"\b(?:fiscal|FY)", re.IGNORECASE)
+_MONTH_RE = re.compile(
+    r"\b(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:tember)?|"
+    r"oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\b",
+    re.IGNORECASE,
+)
+
+
+class RuleBasedMetadataExtractor:
+    def __init__(self, doc_ids: list[str], ticker_to_name: dict[str, str] = TICKER_TO_NAME_MAP):
+        """Extracts the documents a query is about with regular expressions, without calling the LLM.
+
+        Only queries that unambiguously mention the companies (by ticker or name) and the periods (quarters and
+        years, or years) are handled, `extract` returns None for the others so that they fall back to the LLM.
+
+        Args:
+            doc_ids: ids of the documents, i.e. `<year> <quarter> <ticker>`
+            ticker_to_name: mapping from the tickers to the company names
+        """
+        self.documents: set[tuple[int, str, str]] = set()
+        for doc_id in doc_ids:
+            year, quarter, ticker = doc_id.split()
+            self.documents.add((int(year), quarter, ticker))
+
+        tickers = {ticker for _, _, ticker in self.documents}
+        self.name_to_ticker = {name.lower(): ticker for ticker, name in ticker_to_name.items() if ticker in tickers}
+
+        # a single alternation matches all the (case sensitive) tickers and (case insensitive) names in one pass
+        ticker_pattern = "|".join(sorted(map(re.escape, tickers), key=len, reverse=True))
+        name_pattern = "|".join(sorted(map(re.escape, self.name_to_ticker), key=len, reverse=True))
+        self._company_re = re.compile(rf"\b(?:(?P<ticker>{ticker_pattern})|(?i:(?P<name>{name_pattern})))\b")
+
+        self.num_extracted = 0
+        self.num_fallbacks = 0
+
+    def extract_tickers(self, query: str) -> set[str]:
+        """Extract the companies mentioned by their ticker or their name
+
+        Args:
+            query: the query
+
+        Returns:
+            the tickers of the companies
+        """
+        tickers = set()
+        for match in self._company_re.finditer(query):
+            if match.group("ticker"):
+                tickers.add(match.group("ticker"))
+            elif match.group("name"):
+                tickers.add(self.name_to_ticker[match.group("name").lower()])
+
+        return tickers
+
+    def _extract_periods(self, query: str) -> Optional[set[tuple[int, Optional[str]]]]:
+        periods: set[tuple[int, Optional[str]]] = set()
+
+        for match in _QUARTER_YEAR_RE.finditer(query):
+            if match.group("year_first") is not None:
+                periods.add((int(match.group("year_first")), f"Q{match.group('q_last')}"))
+            elif match.group("q") is not None:
+                periods.add((int(match.group("year")), f"Q{match.group('q')}"))
+            else:
+                periods.add((int(match.group("year")), _ORDINAL_TO_QUARTER[match.group("ordinal").lower()]))
+
+        if _FISCAL_RE.search(query):
+            return None
+
+        remainder = _QUARTER_YEAR_RE.sub(" ", query)
+        if _QUARTER_RE.search(remainder) or _MONTH_RE.search(remainder):
+            # a quarter without a year (e.g. "Q3 compared to Q2 2023") or a date
+            return None
+
+        # years without a quarter select all the documents of that year
+        periods.update((int(match.group("year")), None) for match in _YEAR_RE.finditer(remainder))
+
+        return periods
+
+    def mentions_metadata(self, query: str) -> bool:
+        """Check whether the query mentions a company or a period at all, even ambiguously
+
+        Args:
+            query: the query
+
+        Returns:
+            whether the query mentions a company, a quarter, a year, a fiscal period or a month
+        """
+        return len(self.extract_tickers(query)) > 0 or any(
+            regex.search(query) for regex in (_QUARTER_RE, _YEAR_RE, _FISCAL_RE, _MONTH_RE)
+        )
+
+    def extract(self, query: str) -> Optional[Response]:
+        """Extract the documents the query is about
+
+        Args:
+            query: the query
+
+        Returns:
+            the documents, None if the query is ambiguous
+        """
+        docs = []
+        if len(self.documents) > 0:
+            tickers = self.extract_tickers(query)
+            periods = self._extract_periods(query)
+
+            if len(tickers) > 0 and periods:
+                docs = [
+                    MetadataExtractor(year=year, quarter=quarter, ticker=ticker)
+                    for year, quarter, ticker in sorted(self.documents)
+                    if ticker in tickers and any(year == y and (q is None or quarter == q) for y, q in periods)
+                ]
+
+        if len(docs) == 0:
+            self.num_fallbacks += 1
+            return None
+
+        self.num_extracted += 1
+        return Response(list_of_docs=docs)
+
+
 def generate_combined_search_kwargs(response: Response) -> dict[str, Any]:
     """Generate search kwargs from the response
 
@@ -79,7 +214,15 @@ def generate_separated_kwargs(response: Response) -> list[dict[str, Any]]:
     return filter_conditions_list
 
 
-async def extract_search_kwargs(doc_ids: list, query: str, generator: BaseInferenceClient) -> Response:
+async def extract_search_kwargs(
+    doc_ids: list,
+    query: str,
+    generator: BaseInferenceClient,
+    cache: Optional[ExtractionCache] = None,
+    rule_based_extractor: Optional[RuleBasedMetadataExtractor] = None,
+    document_router: Optional[DocumentRouter] = None,
+    query_embedding: Optional[list[float]] = None,
+) -> Response:
     """
     Extract search kwargs to filter the vector store based on the user query
 
@@ -87,13 +230,43 @@ async def extract_search_kwargs(doc_ids: list, query: str, generator: BaseInfere
         doc_ids: list of document IDs
         query: user query
         generator: inference client
+        cache: cache of the previously extracted search kwargs, not cached if None
+        rule_based_extractor: extractor tried before the LLM, which is only called for the queries it can't handle
+        document_router: router shortlisting the documents by the similarity of their centroid to the query, used
+            instead of the LLM for the queries without any metadata it is confident about, and to shorten the list of
+            documents given to it
+        query_embedding: embedding of the query, required by the document router
 
     Returns:
         search kwargs to filter the vector store
     """
+    if rule_based_extractor is not None:
+        response = rule_based_extractor.extract(query)
+        if response is not None:
+            return response
+
+    candidate_doc_ids = doc_ids
+    if document_router is not None and query_embedding is not None and rule_based_extractor is not None:
+        # queries the router isn't confident about are still asked to the LLM
+        routed = document_router.route(query_embedding) if not rule_based_extractor.mentions_metadata(query) else []
+        if len(routed) > 0:
+            return Response(
+                list_of_docs=[
+                    MetadataExtractor(year=year, quarter=quarter, ticker=ticker) for year, quarter, ticker in routed
+                ]
+            )
+
+        tickers = rule_based_extractor.extract_tickers(query)
+        candidate_doc_ids = document_router.get_candidate_doc_ids(doc_ids, query_embedding, tickers)
+
+    if cache is not None:
+        cached = cache.get(query, doc_ids)
+        if cached is not None:
+            return Response.model_validate_json(cached)
+
     extract_template = f"""
 A user has questions regarding some documents. They have the following titles:
-{doc_ids}
+{candidate_doc_ids}
 The user's query is as follows: {query}
 
 For example:
@@ -135,4 +308,7 @@ Extract the document titles that are relevant to the query.
         response_pydantic_type=Response,
     )
 
+    if cache is not None:
+        cache.put(query, doc_ids, response.model_dump_json())
+
     return response
@@ -0,0 +1,316 @@
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+from chromadb.api.models.Collection import Collection
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.constants import DB_DOC_NAME_KEY
+from financeqa.indexing.manifest import IndexManifest
+from financeqa.retrieval.bm25_index import DOCUMENT_FIELDS, get_filter_fields, load_chunks, matches_filter, save_chunks
+
+
+class StaleIndexError(Exception):
+    """Raised when loading an index built before the last indexing of the documents"""
+
+
+class QuantizedVectorIndex:
+    def __init__(
+        self,
+        codes: np.ndarray,
+        scales: np.ndarray,
+        offsets: np.ndarray,
+        vectors: Optional[np.ndarray],
+        chunks: list[dict[str, Any]],
+        rescore_factor: int = 4,
+        block_size: int = 4096,
+        manifest_digest: Optional[str] = None,
+    ):
+        """In-process vector index of the chunks, with the embeddings quantized to int8 per dimension.
+
+        A search scores all the (filtered) chunks with the quantized embeddings, then rescores the
+        `rescore_factor * k` best ones with their full precision embeddings. These are memory mapped from disk, so
+        only the int8 codes (a quarter of the float32 embeddings) have to stay in RAM.
+
+        Use `build`, `from_collection` or `load` to create one.
+
+        Args:
+            codes: int8 code of each dimension of each normalized embedding
+            scales: quantization step of each dimension
+            offsets: value of each dimension encoded by the code -128
+            vectors: normalized full precision embeddings, no rescoring if None
+            chunks: the id, text and metadata of each chunk
+            rescore_factor: number of candidates rescored with full precision per returned chunk
+            block_size: number of chunks scored at once, bounding the memory used by a search
+            manifest_digest: digest of the index manifest the index was built with, if known
+        """
+        self.codes = codes
+        self.scales = scales
+        self.offsets = offsets
+        self.vectors = vectors
+        self.chunks = chunks
+        self.rescore_factor = rescore_factor
+        self.block_size = block_size
+        self.manifest_digest = manifest_digest
+
+        document_indices: dict[str, int] = {}
+        self._chunk_documents = np.asarray(
+            [
+                document_indices.setdefault(chunk["metadata"][DB_DOC_NAME_KEY], len(document_indices))
+                for chunk in chunks
+            ],
+            dtype=np.int32,
+        )
+        self._documents: list[dict[str, Any]] = [{} for _ in document_indices]
+        for chunk, document in zip(chunks, self._chunk_documents, strict=True):
+            self._documents[document] = {key: chunk["metadata"].get(key) for key in DOCUMENT_FIELDS}
+
+        self._lock = threading.Lock()
+        self._masks: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def chunks_footprint(self) -> int:
+        """Approximate number of bytes of the chunks held in RAM, i.e. the size of their text and metadata"""
+        return sum(len(chunk["text"].encode("utf-8")) + len(json.dumps(chunk["metadata"])) for chunk in self.chunks)
+
+    @property
+    def memory_footprint(self) -> int:
+        """Approximate number of bytes held in RAM, i.e. the codes, the chunks and the full precision embeddings
+        unless they are memory mapped"""
+        num_bytes = self.codes.nbytes + self.scales.nbytes + self.offsets.nbytes + self.chunks_footprint
+        if self.vectors is not None and not isinstance(self.vectors, np.memmap):
+            num_bytes += self.vectors.nbytes
+
+        return num_bytes
+
+    @classmethod
+    def build(
+        cls, chunks: Iterable[tuple[str, str, dict[str, Any], Any]], rescore: bool = True, **kwargs
+    ) -> "QuantizedVectorIndex":
+        """Build the index
+
+        Args:
+            chunks: the id, text, metadata and embedding of each chunk
+            rescore: keep the full precision embeddings to rescore the best candidates
+            kwargs: additional arguments of the index
+
+        Returns:
+            the index
+        """
+        stored_chunks = []
+        embeddings = []
+        for chunk_id, text, metadata, embedding in chunks:
+            stored_chunks.append({"id": chunk_id, "text": text, "metadata": metadata})
+            embeddings.append(embedding)
+
+        # an empty collection (e.g. all the documents were filtered out) gives an empty index
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(stored_chunks), -1 if stored_chunks else 0)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        # the range of each dimension is split in 256 steps
+        offsets = vectors.min(axis=0, initial=0.0)
+        scales = np.maximum((vectors.max(axis=0, initial=0.0) - offsets) / 255, 1e-12).astype(np.float32)
+        codes = (np.clip(np.rint((vectors - offsets) / scales), 0, 255) - 128).astype(np.int8)
+
+        return cls(codes, scales, offsets.astype(np.float32), vectors if rescore else None, stored_chunks, **kwargs)
+
+    @classmethod
+    def from_collection(cls, collection: Collection, batch_size: int = 1024, **kwargs) -> "QuantizedVectorIndex":
+        """Build the index of all the chunks stored in a collection
+
+        Args:
+            collection: the collection
+            batch_size: number of chunks fetched at once
+            kwargs: additional arguments of `build`
+
+        Returns:
+            the index
+        """
+
+        def iter_collection():
+            offset = 0
+            while True:
+                result = collection.get(
+                    limit=batch_size, offset=offset, include=["documents", "metadatas", "embeddings"]
+                )
+                if len(result["ids"]) == 0:
+                    return
+
+                yield from zip(
+                    result["ids"], result["documents"], result["metadatas"], result["embeddings"], strict=True  # type: ignore
+                )
+                offset += len(result["ids"])
+
+        return cls.build(sorted(iter_collection(), key=lambda chunk: chunk[0]), **kwargs)
+
+    def save(self, path: str | Path):
+        """Write the index to disk, replacing the previous version
+
+        Args:
+            path: directory to store the index in
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        np.savez(tmp_path / "codes.npz", codes=self.codes, scales=self.scales, offsets=self.offsets)
+        if self.vectors is not None:
+            # a plain .npy file, so that it can be memory mapped
+            np.save(tmp_path / "vectors.npy", np.asarray(self.vectors))
+        save_chunks(tmp_path, self.chunks)
+        if self.manifest_digest is not None:
+            (tmp_path / "manifest.sha256").write_text(self.manifest_digest)
+
+        old_path = path.with_name(f"{path.name}.old")
+        if path.exists():
+            os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str | Path, manifest_path: Optional[str | Path] = None, **kwargs) -> "QuantizedVectorIndex":
+        """Load the index from disk, memory mapping the full precision embeddings.
+
+        The chunks are shared with the BM25 index if it was built from the same collection and is already loaded.
+
+        Args:
+            path: directory the index is stored in
+            manifest_path: path of the index manifest, the index must have been built after its last update if set
+            kwargs: additional arguments of the index
+
+        Returns:
+            the index
+
+        Raises:
+            StaleIndexError: if documents were indexed since the index was built
+        """
+        path = Path(path)
+        digest_path = path / "manifest.sha256"
+        manifest_digest = digest_path.read_text() if digest_path.exists() else None
+        if manifest_path is not None and Path(manifest_path).exists():
+            # the index doesn't contain the chunks of the documents indexed since, nor the removal of the others
+            if manifest_digest != IndexManifest.load(manifest_path).get_digest():
+                raise StaleIndexError(f"The index at {path} was built before the last update of {manifest_path}")
+
+        with np.load(path / "codes.npz") as data:
+            arrays = {key: data[key] for key in data.files}
+
+        vectors_path = path / "vectors.npy"
+        vectors = np.load(vectors_path, mmap_mode="r") if vectors_path.exists() else None
+        chunks = load_chunks(path)
+
+        return cls(
+            arrays["codes"],
+            arrays["scales"],
+            arrays["offsets"],
+            vectors,
+            chunks,
+            manifest_digest=manifest_digest,
+            **kwargs,
+        )
+
+    def _get_mask(self, search_filter: dict[str, Any]) -> np.ndarray:
+        key = json.dumps(search_filter, sort_keys=True)
+
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+
+        if get_filter_fields(search_filter) <= set(DOCUMENT_FIELDS):
+            document_mask = np.array([matches_filter(document, search_filter) for document in self._documents])
+            mask = document_mask[self._chunk_documents] if len(document_mask) > 0 else np.zeros(0, dtype=bool)
+        else:
+            mask = np.array([matches_filter(chunk["metadata"], search_filter) for chunk in self.chunks], dtype=bool)
+
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > 256:
+                self._masks.popitem(last=False)
+
+        return mask
+
+    def _score(self, query: np.ndarray, indices: Optional[np.ndarray]) -> np.ndarray:
+        # q . x ~= q . offsets + (q * scales) . (codes + 128)
+        weights = query * self.scales
+        bias = float(query @ self.offsets) + 128 * float(weights.sum())
+
+        num_chunks = len(self.chunks) if indices is None else len(indices)
+        scores = np.empty(num_chunks, dtype=np.float32)
+        for start in range(0, num_chunks, self.block_size):
+            block = slice(start, start + self.block_size)
+            codes = self.codes[block] if indices is None else self.codes[indices[block]]
+            scores[block] = codes.astype(np.float32) @ weights + bias
+
+        return scores
+
+    def search(
+        self, embedding: list[float], k: int = 4, filter: Optional[dict[str, Any]] = None
+    ) -> list[tuple[int, float]]:
+        """Search the chunks most similar to the query embedding
+
+        Args:
+            embedding: the query embedding
+            k: number of chunks to return
+            filter: Chroma `where` filter on the metadata of the chunks
+
+        Returns:
+            the index and cosine similarity of the most similar chunks, most similar first
+        """
+        if len(self.chunks) == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+
+        indices = np.flatnonzero(self._get_mask(filter)) if filter else None
+        scores = self._score(query, indices)
+        if indices is None:
+            indices = np.arange(len(scores))
+
+        num_candidates = min(len(scores), k * self.rescore_factor if self.vectors is not None else k)
+        if num_candidates == 0:
+            return []
+
+        candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        candidate_indices = indices[candidates]
+        if self.vectors is not None:
+            # the memory mapped rows are read in order
+            order = np.argsort(candidate_indices)
+            candidate_indices = candidate_indices[order]
+            candidate_scores = np.asarray(self.vectors[candidate_indices], dtype=np.float32) @ query
+        else:
+            candidate_scores = scores[candidates]
+
+        best = np.argsort(-candidate_scores, kind="stable")[:k]
+        return [(int(candidate_indices[i]), float(candidate_scores[i])) for i in best]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, filter: Optional[dict[str, Any]] = None, **kwargs
+    ) -> list[LangChainDocument]:
+        """Search the chunks most similar to the query embedding, like the Chroma vector store
+
+        Args:
+            embedding: the query embedding
+            k: number of chunks to return
+            filter: Chroma `where` filter on the metadata of the chunks
+            kwargs: ignored, for compatibility with the vector store
+
+        Returns:
+            the most similar chunks, most similar first
+        """
+        return [
+            LangChainDocument(
+                id=self.chunks[i]["id"], page_content=self.chunks[i]["text"], metadata=self.chunks[i]["metadata"]
+            )
+            for i, _ in self.search(embedding, k=k, filter=filter)
+        ]
@@ -0,0 +1,198 @@
+import logging
+import math
+import re
+import time
+from collections import Counter
+from typing import Optional
+
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.constants import DB_DOC_NAME_KEY
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lowercase word tokens
+
+    Args:
+        text: the text
+
+    Returns:
+        the tokens
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+def bm25_scores(query: str, texts: list[str], k1: float = 1.2, b: float = 0.75) -> list[float]:
+    """Score the texts against the query with BM25, using the texts themselves as the corpus
+
+    Args:
+        query: the query
+        texts: the texts to score
+        k1: term frequency saturation
+        b: document length normalization
+
+    Returns:
+        the score of each text
+    """
+    docs = [Counter(tokenize(text)) for text in texts]
+    if len(docs) == 0:
+        return []
+
+    avg_length = sum(sum(doc.values()) for doc in docs) / len(docs) or 1.0
+    query_tokens = set(tokenize(query))
+    document_frequency = {token: sum(1 for doc in docs if token in doc) for token in query_tokens}
+
+    scores = []
+    for doc in docs:
+        length = sum(doc.values())
+        score = 0.0
+        for token in query_tokens:
+            tf = doc.get(token, 0)
+            if tf == 0:
+                continue
+
+            idf = math.log(1 + (len(docs) - document_frequency[token] + 0.5) / (document_frequency[token] + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+        scores.append(score)
+
+    return scores
+
+
+def get_document_key(doc: LangChainDocument) -> tuple:
+    """Get a key identifying a chunk, whichever search returned it
+
+    Args:
+        doc: the chunk
+
+    Returns:
+        the key
+    """
+    if doc.id is not None:
+        return (doc.id,)
+
+    return (doc.metadata.get(DB_DOC_NAME_KEY), doc.metadata.get("page_number"), doc.page_content)
+
+
+def reciprocal_rank_fusion(rankings: list[list[LangChainDocument]], k: int, rrf_k: int = 60) -> list[LangChainDocument]:
+    """Fuse rankings of chunks by summing the reciprocals of their ranks
+
+    Args:
+        rankings: the rankings, best first
+        k: number of chunks to return
+        rrf_k: constant dampening the weight of the top ranks
+
+    Returns:
+        the best chunks according to all the rankings, best first
+    """
+    scores: dict[tuple, float] = {}
+    docs: dict[tuple, LangChainDocument] = {}
+
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking):
+            key = get_document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+
+    return [docs[key] for key in sorted(scores, key=lambda key: -scores[key])[:k]]
+
+
+class Reranker:
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        budget_ms: float = 50.0,
+        batch_size: int = 16,
+        rrf_k: int = 60,
+        cache_dir: Optional[str] = None,
+    ):
+        """Re-ranks the candidates of the searches of a query, within a latency budget.
+
+        The candidates are first ranked by fusing their dense rank (within their search) and their BM25 rank (among
+        all the candidates) with reciprocal rank fusion. If a cross-encoder is configured, the candidates are then
+        scored by it in that order, batch per batch, until the budget is spent; the candidates it didn't get to are
+        ranked after the scored ones.
+
+        Args:
+            model_name: name of the sentence-transformers cross-encoder, lexical and dense fusion only if empty
+            budget_ms: number of milliseconds the cross-encoder may spend on a query
+            batch_size: number of candidates scored by the cross-encoder at once
+            rrf_k: constant of the reciprocal rank fusion, dampening the weight of the top ranks
+            cache_dir: directory the cross-encoder is downloaded to and loaded from, the Hugging Face cache if None
+        """
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.rrf_k = rrf_k
+
+        self.cross_encoder = None
+        if model_name:
+            from sentence_transformers import CrossEncoder
+
+            self.cross_encoder = CrossEncoder(model_name, device="cpu", cache_dir=cache_dir)
+
+    def _fuse(self, query: str, results: list[list[LangChainDocument]]) -> list[tuple[int, LangChainDocument]]:
+        candidates = [(i, rank, doc) for i, documents in enumerate(results) for rank, doc in enumerate(documents)]
+
+        lexical_scores = bm25_scores(query, [doc.page_content for _, _, doc in candidates])
+        lexical_ranks = {
+            j: rank for rank, j in enumerate(sorted(range(len(candidates)), key=lambda j: -lexical_scores[j]))
+        }
+
+        fused = [
+            1 / (self.rrf_k + dense_rank) + 1 / (self.rrf_k + lexical_ranks[j])
+            for j, (_, dense_rank, _) in enumerate(candidates)
+        ]
+        order = sorted(range(len(candidates)), key=lambda j: -fused[j])
+
+        return [(candidates[j][0], candidates[j][2]) for j in order]
+
+    def _cross_encode(
+        self, query: str, ranked: list[tuple[int, LangChainDocument]]
+    ) -> list[tuple[int, LangChainDocument]]:
+        start = time.perf_counter()
+        scores: list[float] = []
+
+        for i in range(0, len(ranked), self.batch_size):
+            if (time.perf_counter() - start) * 1000 >= self.budget_ms:
+                logger.debug(f"Re-ranking budget spent after scoring {len(scores)}/{len(ranked)} candidates")
+                break
+
+            batch = ranked[i : i + self.batch_size]
+            scores.extend(self.cross_encoder.predict([(query, doc.page_content) for _, doc in batch]))  # type: ignore
+
+        scored = sorted(range(len(scores)), key=lambda j: -scores[j])
+        return [ranked[j] for j in scored] + ranked[len(scores) :]
+
+    def rerank(self, query: str, results: list[list[LangChainDocument]], top_k: int) -> list[LangChainDocument]:
+        """Keep the best candidates of the searches of a query
+
+        Every search that found candidates keeps at least its best one, so that questions comparing several
+        documents get context about each of them.
+
+        Args:
+            query: the query
+            results: the candidates found by each search, in the order of their similarity
+            top_k: number of candidates to keep
+
+        Returns:
+            the kept candidates, best first
+        """
+        ranked = self._fuse(query, results)
+        if self.cross_encoder is not None:
+            ranked = self._cross_encode(query, ranked)
+
+        kept = ranked[:top_k]
+        for i, documents in enumerate(results):
+            if len(documents) == 0 or any(search == i for search, _ in kept):
+                continue
+
+            # replace the worst kept candidate of a search that keeps more than one
+            counts = Counter(search for search, _ in kept)
+            replaceable = [j for j, (search, _) in enumerate(kept) if counts[search] > 1]
+            if len(replaceable) > 0:
+                kept[replaceable[-1]] = next(candidate for candidate in ranked if candidate[0] == i)
+
+        return [doc for _, doc in kept]
@@ -3,6 +3,16 @@ from pydantic import Field, SecretStr
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import Optional
 
+from financeqa.constants import (
+    BM25_INDEX_PATH,
+    GENERATOR_MODEL_NAME,
+    INDEX_MANIFEST_PATH,
+    QUANTIZED_INDEX_PATH,
+    ROUTING_INDEX_PATH,
+    ChromaDBMode,
+    EmbeddingBackend,
+)
+
 env_file = find_dotenv()
 
 
@@ -23,14 +33,90 @@ class HuggingFaceSettings(BaseSettings):
     api_key: Optional[SecretStr] = Field(None, alias="HF_API_KEY")
 
 
+class InferenceSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
+    timeout: float = Field(60.0, alias="INFERENCE_TIMEOUT")
+    connect_timeout: float = Field(5.0, alias="INFERENCE_CONNECT_TIMEOUT")
+    max_connections: int = Field(32, alias="INFERENCE_MAX_CONNECTIONS")
+    max_keepalive_connections: int = Field(16, alias="INFERENCE_MAX_KEEPALIVE_CONNECTIONS")
+    keepalive_expiry: float = Field(30.0, alias="INFERENCE_KEEPALIVE_EXPIRY")
+    max_retries: int = Field(4, alias="INFERENCE_MAX_RETRIES")
+    backoff_base: float = Field(0.5, alias="INFERENCE_BACKOFF_BASE")
+    backoff_max: float = Field(20.0, alias="INFERENCE_BACKOFF_MAX")
+    rate_limit: Optional[float] = Field(None, alias="INFERENCE_RATE_LIMIT")
+    rate_limit_burst: Optional[float] = Field(None, alias="INFERENCE_RATE_LIMIT_BURST")
+    coalesce: bool = Field(True, alias="INFERENCE_COALESCE")
+
+
 class ChromaDBSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
-    db_host: str = Field(..., alias="CHROMA_DB_HOST")
-    db_port: int = Field(..., alias="CHROMA_DB_PORT")
-    db_token: SecretStr = Field(..., alias="CHROMA_DB_TOKEN")
+    db_mode: ChromaDBMode = Field(ChromaDBMode.HTTP, alias="CHROMA_DB_MODE")
+    db_host: Optional[str] = Field(None, alias="CHROMA_DB_HOST")
+    db_port: Optional[int] = Field(None, alias="CHROMA_DB_PORT")
+    db_token: Optional[SecretStr] = Field(None, alias="CHROMA_DB_TOKEN")
+    db_local_path: str = Field("./data/chroma", alias="CHROMA_DB_LOCAL_PATH")
+
+
+class EmbeddingSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
+    cache_dir: Optional[str] = Field(None, alias="EMBEDDING_CACHE_DIR")
+    cache_max_entries: int = Field(200_000, alias="EMBEDDING_CACHE_MAX_ENTRIES")
+    backend: EmbeddingBackend = Field(EmbeddingBackend.TORCH, alias="EMBEDDING_BACKEND")
+    onnx_quantization: Optional[str] = Field(None, alias="EMBEDDING_ONNX_QUANTIZATION")
+
+
+class RetrievalSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
+    max_concurrency: int = Field(8, alias="RETRIEVAL_MAX_CONCURRENCY")
+    search_timeout: float = Field(10.0, alias="RETRIEVAL_SEARCH_TIMEOUT")
+    search_queue_timeout: float = Field(10.0, alias="RETRIEVAL_SEARCH_QUEUE_TIMEOUT")
+    speculative_search: bool = Field(True, alias="SPECULATIVE_SEARCH")
+    speculative_k: int = Field(100, alias="SPECULATIVE_K")
+    extraction_cache_size: int = Field(1024, alias="EXTRACTION_CACHE_SIZE")
+    extraction_cache_ttl: float = Field(3600.0, alias="EXTRACTION_CACHE_TTL")
+    extraction_cache_path: Optional[str] = Field(None, alias="EXTRACTION_CACHE_PATH")
+    hybrid_search: bool = Field(True, alias="HYBRID_SEARCH")
+    bm25_index_path: str = Field(BM25_INDEX_PATH, alias="BM25_INDEX_PATH")
+    document_routing: bool = Field(False, alias="DOCUMENT_ROUTING")
+    routing_index_path: str = Field(ROUTING_INDEX_PATH, alias="ROUTING_INDEX_PATH")
+    routing_top_k: int = Field(3, alias="ROUTING_TOP_K")
+    routing_min_score: float = Field(0.25, alias="ROUTING_MIN_SCORE")
+    routing_min_margin: float = Field(0.05, alias="ROUTING_MIN_MARGIN")
+    routing_prompt_k: int = Field(20, alias="ROUTING_PROMPT_K")
+    quantized_index: bool = Field(False, alias="QUANTIZED_INDEX")
+    quantized_index_path: str = Field(QUANTIZED_INDEX_PATH, alias="QUANTIZED_INDEX_PATH")
+    quantized_rescore_factor: int = Field(4, alias="QUANTIZED_RESCORE_FACTOR")
+    rerank: bool = Field(True, alias="RERANK")
+    rerank_model: Optional[str] = Field(None, alias="RERANK_MODEL")
+    rerank_overfetch: int = Field(3, alias="RERANK_OVERFETCH")
+    rerank_budget_ms: float = Field(50.0, alias="RERANK_BUDGET_MS")
+    context_max_tokens: int = Field(3072, alias="CONTEXT_MAX_TOKENS")
+    context_tokenizer: Optional[str] = Field(GENERATOR_MODEL_NAME, alias="CONTEXT_TOKENIZER")
+
+
+class AnswerCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
+    enabled: bool = Field(False, alias="ANSWER_CACHE_ENABLED")
+    threshold: float = Field(0.95, alias="ANSWER_CACHE_THRESHOLD")
+    ttl: float = Field(3600.0, alias="ANSWER_CACHE_TTL")
+    max_entries_per_scope: int = Field(256, alias="ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE")
+    manifest_path: str = Field(INDEX_MANIFEST_PATH, alias="INDEX_MANIFEST_PATH")
+
+
+class StartupSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_file_encoding="utf-8", extra="ignore")
+    model_cache_dir: Optional[str] = Field(None, alias="MODEL_CACHE_DIR")
+    max_workers: int = Field(4, alias="STARTUP_MAX_WORKERS")
+    retry_interval: float = Field(10.0, alias="STARTUP_RETRY_INTERVAL")
+    wait_timeout: float = Field(30.0, alias="STARTUP_WAIT_TIMEOUT")
 
 
 openai_azure_settings = OpenAIAzureSettings()  # type: ignore
 hf_settings = HuggingFaceSettings()  # type: ignore
 openai_settings = OpenAISettings()  # type: ignore
+inference_settings = InferenceSettings()  # type: ignore
 chroma_db_settings = ChromaDBSettings()  # type: ignore
+embedding_settings = EmbeddingSettings()  # type: ignore
+retrieval_settings = RetrievalSettings()  # type: ignore
+answer_cache_settings = AnswerCacheSettings()  # type: ignore
+startup_settings = StartupSettings()  # type: ignore
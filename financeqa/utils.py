@@ -17,6 +17,18 @@ def get_document_ids(doc_root: str) -> list[str]:
     return [(doc_path).stem for doc_path in docs_paths]
 
 
+def format_doc_for_context(doc: LangChainDocument) -> str:
+    """Format a document for the context, followed by its reference
+
+    Args:
+        doc: the document
+
+    Returns:
+        the formatted document
+    """
+    return doc.page_content + f"\n Reference: {doc.metadata['db_document_name']}, page {doc.metadata['page_number']}"
+
+
 def format_docs_for_context(docs: list[LangChainDocument]) -> str:
     """Format the documents for the context
 
@@ -26,7 +38,4 @@ def format_docs_for_context(docs: list[LangChainDocument]) -> str:
     Returns:
         the formatted documents
     """
-    return "\n\n".join(
-        doc.page_content + f"\n Reference: {doc.metadata['db_document_name']}, page {doc.metadata['page_number']}"
-        for doc in docs
-    )
+    return "\n\n".join(format_doc_for_context(doc) for doc in docs)
@@ -1,14 +1,18 @@
 """Tests FastAPI endpoints."""
 
+import os
+import time
 from http import HTTPStatus
-from unittest.mock import AsyncMock, patch
+from unittest.mock import ANY, AsyncMock, patch
 
 from fastapi.testclient import TestClient
 from langchain_core.documents import Document as LangChainDocument
 
+from financeqa.app.answer_cache import SemanticAnswerCache
 from financeqa.app.main import app
 from financeqa.app.schema import ReferencedDoc, ReferencedResponse
 from financeqa.app.security import get_current_api_key
+from financeqa.indexing.manifest import DocumentEntry, IndexManifest
 
 app.dependency_overrides = {get_current_api_key: lambda: True}
 
@@ -20,15 +24,37 @@ def test_health() -> None:
         assert response.status_code == HTTPStatus.OK
 
 
-def test_query_endpoint_with_context_documents():
+def test_readiness() -> None:
+    """Tests that /health/ready reports the loading time of each component once the app is ready."""
+    from financeqa.app.startup import warmup
+
+    with TestClient(app) as client:
+        for _ in range(100):
+            response = client.get("/health/ready")
+            if response.status_code == HTTPStatus.OK:
+                break
+            time.sleep(0.1)
+
+        assert response.status_code == HTTPStatus.OK
+        assert response.json()["status"] == "ready"
+        assert set(response.json()["components"]) == set(warmup.timings)
+        assert all(component["status"] == "loaded" for component in response.json()["components"].values())
+
+
+def test_query_endpoint_with_context_documents(tmp_path):
     """Tests the /query endpoint with mocked context documents and completions."""
 
     with patch(
+        "financeqa.app.routers.chat.chat.answer_cache", SemanticAnswerCache(tmp_path / "index_manifest.json")
+    ), patch(
         "financeqa.app.routers.chat.chat.get_context_documents", new_callable=AsyncMock
     ) as mock_get_context_documents, patch(
         "financeqa.app.routers.chat.chat.HFChatCompletion.get_completions",
         new_callable=AsyncMock,
-    ) as mock_get_completions:
+    ) as mock_get_completions, patch(
+        "financeqa.app.routers.chat.chat.get_answer_cache_key", new_callable=AsyncMock
+    ) as mock_get_answer_cache_key:
+        mock_get_answer_cache_key.return_value = ([1.0, 0.0], ("2023 Q2 INTC",))
         mock_get_context_documents.return_value = [
             LangChainDocument(
                 page_content="Mocked document 1",
@@ -56,6 +82,93 @@ def test_query_endpoint_with_context_documents():
                 "references": [{"year": 2023, "quarter": "Q2", "company": "MSFT", "page": 2}],
             }
 
+            assert response.headers["X-Answer-Cache"] == "miss"
+            assert int(response.headers["X-Context-Tokens"]) > 0
+
             # assert mocks were called
-            mock_get_context_documents.assert_called_once_with("Test message")
+            mock_get_context_documents.assert_called_once_with("Test message", ANY)
             mock_get_completions.assert_called_once()
+
+
+def test_query_endpoint_with_cached_answer(tmp_path):
+    """Tests that the /query endpoint returns the cached answer to a similar question about the same documents."""
+    answer_cache = SemanticAnswerCache(tmp_path / "index_manifest.json")
+    cached_answer = ReferencedResponse(
+        response="Cached response",
+        references=[ReferencedDoc(year=2023, quarter="Q3", company="NVDA", page=7)],
+    )
+    answer_cache.put([0.0, 1.0], ("2023 Q3 NVDA",), cached_answer)
+
+    with patch("financeqa.app.routers.chat.chat.answer_cache", answer_cache), patch(
+        "financeqa.app.routers.chat.chat.get_context_documents", new_callable=AsyncMock
+    ) as mock_get_context_documents, patch(
+        "financeqa.app.routers.chat.chat.HFChatCompletion.get_completions",
+        new_callable=AsyncMock,
+    ) as mock_get_completions, patch(
+        "financeqa.app.routers.chat.chat.get_answer_cache_key", new_callable=AsyncMock
+    ) as mock_get_answer_cache_key:
+        mock_get_answer_cache_key.return_value = ([0.01, 1.0], ("2023 Q3 NVDA",))
+
+        with TestClient(app) as client:
+            payload = [{"message": "Test message"}]
+            response = client.post("/query", json=payload)
+
+            assert response.status_code == 200
+            assert response.headers["X-Answer-Cache"] == "hit"
+            assert response.json() == cached_answer.model_dump()
+
+            mock_get_context_documents.assert_not_called()
+            mock_get_completions.assert_not_called()
+
+
+def test_query_stream_endpoint():
+    """Tests that the /query/stream endpoint streams the answer of the generator, which can't stream it token by
+    token, and then the cited references."""
+
+    with patch(
+        "financeqa.app.routers.chat.chat.get_context_documents", new_callable=AsyncMock
+    ) as mock_get_context_documents, patch(
+        "financeqa.app.routers.chat.chat.HFChatCompletion.get_completions", new_callable=AsyncMock
+    ) as mock_get_completions, patch(
+        "financeqa.app.routers.chat.chat.get_answer_cache_key", new_callable=AsyncMock
+    ) as mock_get_answer_cache_key:
+        mock_get_answer_cache_key.return_value = ([1.0, 1.0], ("2023 Q2 MSFT",))
+        mock_get_completions.return_value = "Revenue was $10 (Reference: 2023 Q2 MSFT, page 2)."
+        metadata = {"db_document_name": "2023 Q2 MSFT", "year": 2023, "quarter": "Q2", "ticker": "MSFT"}
+        mock_get_context_documents.return_value = [
+            LangChainDocument(page_content="Mocked document 1", metadata={**metadata, "page_number": 1}),
+            LangChainDocument(page_content="Mocked document 2", metadata={**metadata, "page_number": 2}),
+        ]
+
+        with TestClient(app) as client:
+            payload = [{"message": "Test message"}]
+            response = client.post("/query/stream", json=payload)
+
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            assert response.text == (
+                'event: token\ndata: {"token": "Revenue was $10 (Reference: 2023 Q2 MSFT, page 2)."}\n\n'
+                'event: references\ndata: {"references": '
+                '[{"year": 2023, "quarter": "Q2", "company": "MSFT", "page": 2}]}\n\n'
+            )
+
+            mock_get_context_documents.assert_called_once_with("Test message", ANY)
+
+
+def test_unfiltered_answers_are_invalidated_on_reindex(tmp_path):
+    """Tests that the answers to questions about no document in particular are invalidated when any document is
+    re-indexed."""
+    manifest_path = tmp_path / "index_manifest.json"
+    manifest = IndexManifest(config_hash="config", documents={"2023 Q3 NVDA": DocumentEntry(file_hash="a", pages={})})
+    manifest.save(manifest_path)
+
+    answer_cache = SemanticAnswerCache(manifest_path)
+    answer_cache.put([1.0, 0.0], (), ReferencedResponse(response="Cached response", references=[]))
+    assert answer_cache.get([1.0, 0.0], ()) is not None
+
+    manifest.documents["2023 Q3 NVDA"] = DocumentEntry(file_hash="b", pages={})
+    manifest.save(manifest_path)
+    os.utime(manifest_path, (time.time() + 1, time.time() + 1))
+
+    assert answer_cache.get([1.0, 0.0], ()) is None
+    assert answer_cache.invalidations == 1
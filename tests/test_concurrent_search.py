@@ -0,0 +1,51 @@
+"""Tests the timeouts of the concurrent searches."""
+
+import asyncio
+import time
+
+import pytest
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.retrieval.concurrent_search import ConcurrentSearcher, SearchTimeoutError
+
+
+class SlowRouter:
+    def __init__(self, seconds: float):
+        """Partition router sending every search to a vector store taking `seconds` to answer"""
+        self.seconds = seconds
+        self.embeddings = self
+
+    def embed_query(self, query: str) -> list[float]:
+        return [0.0]
+
+    def route(self, search_kwargs):
+        return self, search_kwargs
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int, **kwargs) -> list[LangChainDocument]:
+        time.sleep(self.seconds)
+        return [LangChainDocument(page_content="chunk")]
+
+
+def test_queued_searches_do_not_time_out():
+    """Tests that the timeout doesn't count the time a search waits for a thread."""
+    searcher = ConcurrentSearcher(SlowRouter(0.2), max_concurrency=1, timeout=0.5, queue_timeout=5.0)
+
+    results = asyncio.run(searcher.search("query", [{"k": 1} for _ in range(4)]))
+
+    assert all(len(documents) == 1 for documents in results)
+
+
+def test_timed_out_searches_fail_the_query():
+    """Tests that the query fails if all its searches timed out."""
+    searcher = ConcurrentSearcher(SlowRouter(0.5), timeout=0.1)
+
+    with pytest.raises(SearchTimeoutError):
+        asyncio.run(searcher.search("query", [{"k": 1}, {"k": 1}]))
+
+
+def test_queued_searches_fail_the_query_after_the_queue_timeout():
+    """Tests that a query whose searches wait too long for a thread fails, even though none of them timed out."""
+    searcher = ConcurrentSearcher(SlowRouter(0.3), max_concurrency=1, timeout=1.0, queue_timeout=0.4)
+
+    with pytest.raises(SearchTimeoutError):
+        asyncio.run(searcher.search("query", [{"k": 1} for _ in range(4)]))
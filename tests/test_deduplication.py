@@ -0,0 +1,34 @@
+"""Tests the detection of duplicate chunks."""
+
+from langchain_core.documents import Document as LangChainDocument
+
+from financeqa.indexing.deduplication import ChunkDeduplicator
+
+
+def test_negative_figures_are_not_duplicates_of_positive_ones():
+    """Tests that a loss isn't deduplicated against the same wording reporting a gain, exactly or nearly."""
+    deduplicator = ChunkDeduplicator()
+    wording = "Operating income for the segment in the third quarter of fiscal 2023 was {} million, {} year over year"
+    metadata = {"db_document_name": "2023 Q3 AAPL"}
+
+    gain = LangChainDocument(page_content=wording.format("1,234", "5.2%"), metadata=metadata)
+    loss = LangChainDocument(page_content=wording.format("(1,234)", "-5.2%"), metadata=metadata)
+    repeated_loss = LangChainDocument(page_content=wording.format("(1,234)", "-5.2%"), metadata=metadata)
+
+    assert deduplicator.find_duplicate("gain", gain) is None
+    assert deduplicator.find_duplicate("loss", loss) is None
+    assert deduplicator.find_duplicate("repeated_loss", repeated_loss) == "loss"
+
+
+def test_chunks_of_other_documents_are_not_duplicates():
+    """Tests that the same chunk in two documents is kept in both, so that the searches filtered on either find it."""
+    deduplicator = ChunkDeduplicator()
+    text = "Forward-looking statements in this report are subject to risks and uncertainties that could cause results"
+
+    first = LangChainDocument(page_content=text, metadata={"db_document_name": "2023 Q2 AAPL"})
+    second = LangChainDocument(page_content=text, metadata={"db_document_name": "2023 Q3 AAPL"})
+    repeated = LangChainDocument(page_content=text, metadata={"db_document_name": "2023 Q3 AAPL"})
+
+    assert deduplicator.find_duplicate("first", first) is None
+    assert deduplicator.find_duplicate("second", second) is None
+    assert deduplicator.find_duplicate("repeated", repeated) == "second"
@@ -0,0 +1,55 @@
+"""Tests the embedding cache shared by several processes."""
+
+import hashlib
+import multiprocessing
+
+import numpy as np
+
+from financeqa.db.embedding_cache import EmbeddingCache
+
+
+def get_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def get_embedding(text: str) -> list[float]:
+    return np.random.default_rng(int.from_bytes(get_key(text)[:4], "little")).normal(size=8).tolist()
+
+
+def write_embeddings(cache_dir: str, prefix: str):
+    cache = EmbeddingCache(cache_dir, max_entries=1000)
+    for start in range(0, 200, 10):
+        texts = [f"{prefix} chunk {i}" for i in range(start, start + 10)]
+        cache.put_many([get_key(text) for text in texts], [get_embedding(text) for text in texts])
+    cache.flush()
+
+
+def test_processes_sharing_the_cache_get_their_own_embeddings(tmp_path):
+    """Tests that embeddings written concurrently by two processes are all looked up with the right vector."""
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=write_embeddings, args=(str(tmp_path), prefix)) for prefix in ("a", "b")]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    cache = EmbeddingCache(tmp_path, max_entries=1000)
+    texts = [f"{prefix} chunk {i}" for prefix in ("a", "b") for i in range(200)]
+    cached = cache.get_many([get_key(text) for text in texts])
+
+    assert len(cache) == len(texts)
+    for text, vector in zip(texts, cached, strict=True):
+        np.testing.assert_allclose(vector, get_embedding(text), rtol=1e-6)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    """Tests that the cache stays within its size by evicting the entries that weren't looked up."""
+    cache = EmbeddingCache(tmp_path, max_entries=2, flush_interval=0.0)
+    cache.put_many([get_key("a"), get_key("b")], [get_embedding("a"), get_embedding("b")])
+    cache.get_many([get_key("a")])
+    cache.put_many([get_key("c")], [get_embedding("c")])
+
+    assert len(cache) == 2
+    assert cache.get_many([get_key("b")]) == [None]
+    assert cache.evictions == 1
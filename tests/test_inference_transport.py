@@ -0,0 +1,100 @@
+"""Tests the HTTP transport and the call coalescing of the inference clients against a mock OpenAI-compatible server."""
+
+import asyncio
+import json
+
+import httpx
+from openai import AsyncOpenAI
+
+from financeqa.generate.coalescing import CoalescingInferenceClient
+from financeqa.generate.openai_inference import OpenAIChatCompletion
+from financeqa.generate.transport import RetryTransport, TokenBucket
+
+
+def mock_openai_server(statuses: list[int]) -> tuple[httpx.MockTransport, list[httpx.Request]]:
+    """Mock an OpenAI-compatible server answering with the given statuses, then with a completion."""
+    requests = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if len(requests) <= len(statuses):
+            return httpx.Response(statuses[len(requests) - 1], headers={"retry-after-ms": "1"}, json={"error": {}})
+
+        body = json.loads(request.content)
+        return httpx.Response(
+            200,
+            json={
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": 0,
+                "model": body["model"],
+                "choices": [
+                    {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Mocked"}}
+                ],
+            },
+        )
+
+    return httpx.MockTransport(handle), requests
+
+
+def build_client(transport: RetryTransport) -> OpenAIChatCompletion:
+    client = AsyncOpenAI(
+        api_key="test", base_url="http://mock/v1", http_client=httpx.AsyncClient(transport=transport), max_retries=0
+    )
+    return OpenAIChatCompletion(client)
+
+
+def test_retries_rate_limited_and_server_errors():
+    """Tests that 429 and 5xx responses are retried until the completion succeeds."""
+    server, requests = mock_openai_server([429, 503])
+    transport = RetryTransport(server, backoff_base=0.001)
+
+    answer = asyncio.run(
+        build_client(transport).get_completions([{"role": "user", "content": "Hi"}], model_name="mock")
+    )
+
+    assert answer == "Mocked"
+    assert len(requests) == 3
+    assert transport.num_retries == 2
+
+
+def test_gives_up_after_max_retries():
+    """Tests that the last failed response is returned once the retries are exhausted."""
+    server, requests = mock_openai_server([500, 500, 500])
+    transport = RetryTransport(server, max_retries=1, backoff_base=0.001)
+
+    try:
+        asyncio.run(build_client(transport).get_completions([{"role": "user", "content": "Hi"}], model_name="mock"))
+        raise AssertionError("expected the completion to fail")
+    except ValueError as e:
+        assert "500" in str(e)
+
+    assert len(requests) == 2
+
+
+def test_token_bucket_is_shared_by_concurrent_callers():
+    """Tests that concurrent callers are spaced by the rate of the token bucket once the burst is spent."""
+    bucket = TokenBucket(rate=100.0, capacity=2.0)
+    delays = [bucket.reserve() for _ in range(4)]
+
+    assert delays[:2] == [0.0, 0.0]
+    assert 0.005 < delays[2] < delays[3] <= 0.02
+
+
+def test_coalesces_identical_in_flight_calls():
+    """Tests that concurrent identical calls share one upstream call, while calls with other arguments don't."""
+    server, requests = mock_openai_server([])
+    client = CoalescingInferenceClient(build_client(RetryTransport(server)))
+    messages = [{"role": "user", "content": "Hi"}]
+
+    async def run():
+        return await asyncio.gather(
+            *(client.get_completions(messages, model_name="mock") for _ in range(5)),
+            client.get_completions(messages, model_name="mock", temperature=0.0),
+        )
+
+    answers = asyncio.run(run())
+
+    assert answers == ["Mocked"] * 6
+    assert len(requests) == 2
+    assert (client.num_calls, client.num_upstream_calls, client.num_coalesced) == (6, 2, 4)
@@ -0,0 +1,52 @@
+"""Tests the loading of the quantized index next to the BM25 index."""
+
+import numpy as np
+import pytest
+
+from financeqa.indexing.manifest import DocumentEntry, IndexManifest
+from financeqa.retrieval.bm25_index import BM25Index
+from financeqa.retrieval.quantized_index import QuantizedVectorIndex, StaleIndexError
+
+
+def build_chunks(num_chunks: int = 20) -> list[tuple]:
+    rng = np.random.default_rng(0)
+    metadata = {"db_document_name": "2023 Q3 AAPL", "year": 2023, "quarter": "Q3", "ticker": "AAPL"}
+    return [(f"{i:04d}", f"revenue of chunk {i}", dict(metadata), rng.normal(size=8)) for i in range(num_chunks)]
+
+
+def test_indexes_share_their_chunks(tmp_path):
+    """Tests that the quantized and BM25 indexes of the same chunks hold them once in memory."""
+    chunks = build_chunks()
+    BM25Index.build([chunk[:3] for chunk in chunks]).save(tmp_path / "bm25_index")
+    QuantizedVectorIndex.build(chunks).save(tmp_path / "quantized_index")
+
+    lexical_index = BM25Index.load(tmp_path / "bm25_index")
+    dense_index = QuantizedVectorIndex.load(tmp_path / "quantized_index")
+
+    assert dense_index.chunks is lexical_index.chunks
+    assert dense_index.memory_footprint > dense_index.codes.nbytes + dense_index.chunks_footprint > 0
+
+
+def test_stale_index_is_refused(tmp_path):
+    """Tests that the quantized index isn't loaded once documents were indexed since it was built."""
+    manifest_path = tmp_path / "index_manifest.json"
+    manifest = IndexManifest(config_hash="config")
+    manifest.save(manifest_path)
+    QuantizedVectorIndex.build(build_chunks(), manifest_digest=manifest.get_digest()).save(tmp_path / "index")
+
+    assert len(QuantizedVectorIndex.load(tmp_path / "index", manifest_path=manifest_path)) == 20
+
+    manifest.documents["2023 Q4 AAPL"] = DocumentEntry(file_hash="hash")
+    manifest.save(manifest_path)
+
+    with pytest.raises(StaleIndexError):
+        QuantizedVectorIndex.load(tmp_path / "index", manifest_path=manifest_path)
+
+
+def test_empty_index(tmp_path):
+    """Tests that the index of an empty collection is saved, loaded and searched."""
+    QuantizedVectorIndex.build([]).save(tmp_path / "index")
+    index = QuantizedVectorIndex.load(tmp_path / "index")
+
+    assert len(index) == 0
+    assert index.similarity_search_by_vector([1.0, 0.0], k=4, filter={"quarter": "Q3"}) == []
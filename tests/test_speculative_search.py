@@ -0,0 +1,54 @@
+"""Tests that the post-filtered speculative search gives the results of the filtered search."""
+
+import asyncio
+
+import numpy as np
+
+from financeqa.app.routers.chat.chat import filter_speculative_candidates
+from financeqa.retrieval.bm25_index import BM25Index
+from financeqa.retrieval.concurrent_search import ConcurrentSearcher
+from financeqa.retrieval.quantized_index import QuantizedVectorIndex
+
+
+class ExactRouter:
+    def __init__(self, vector_store: QuantizedVectorIndex, query_embedding: list[float]):
+        """Partition router sending every search to an exact in-memory vector store"""
+        self.vector_store = vector_store
+        self.embeddings = self
+        self.query_embedding = query_embedding
+
+    def embed_query(self, query: str) -> list[float]:
+        return self.query_embedding
+
+    def route(self, search_kwargs):
+        return self.vector_store, search_kwargs
+
+
+def test_speculative_candidates_give_the_filtered_hybrid_search():
+    """Tests that the post-filtered dense candidates fused with the filtered lexical search are the results of the
+    filtered hybrid search."""
+    rng = np.random.default_rng(0)
+    words = "revenue income loss margin cash debt growth iphone cloud services".split()
+    chunks = []
+    for i in range(300):
+        quarter = f"Q{i % 4 + 1}"
+        metadata = {"db_document_name": f"2023 {quarter} AAPL", "year": 2023, "quarter": quarter, "ticker": "AAPL"}
+        chunks.append(
+            (f"{i:04d}", " ".join(rng.choice(words, 12)), {**metadata, "page_number": i}, rng.normal(size=16))
+        )
+
+    # rescoring all the candidates makes the dense search exact
+    dense_index = QuantizedVectorIndex.build(chunks, rescore_factor=len(chunks))
+    lexical_index = BM25Index.build([chunk[:3] for chunk in chunks])
+    searcher = ConcurrentSearcher(ExactRouter(dense_index, chunks[5][3].tolist()), lexical_index=lexical_index)
+    search_kwargs = {"k": 5, "filter": {"quarter": "Q2"}}
+
+    async def run():
+        filtered = (await searcher.search("cash growth", [dict(search_kwargs)]))[0]
+        candidates = (await searcher.search("cash growth", [{"k": 100}], dense_only=True))[0]
+        dense = filter_speculative_candidates(candidates, search_kwargs)
+        return filtered, await searcher.fuse_lexical_search("cash growth", dense, search_kwargs)
+
+    filtered, speculative = asyncio.run(run())
+
+    assert [doc.id for doc in speculative] == [doc.id for doc in filtered]
@@ -0,0 +1,62 @@
+"""Tests the loading of the components of the app by the warmup."""
+
+import asyncio
+
+from financeqa.app.startup import Warmup
+
+
+def test_transient_errors_are_retried():
+    """Tests that a component failing to connect, even behind a wrapping error, is retried until it loads."""
+    warmup = Warmup(retry_interval=0.01)
+    attempts = []
+
+    @warmup.component("searcher")
+    def load_searcher():
+        attempts.append(None)
+        if len(attempts) < 3:
+            try:
+                raise ConnectionError("Connection refused")
+            except ConnectionError:
+                # like chromadb, without chaining the errors explicitly
+                raise ValueError("Could not connect to a Chroma server")  # noqa: B904
+
+    warmup.start()
+
+    assert asyncio.run(warmup.wait(timeout=5.0))
+    assert len(attempts) == 3
+
+
+def test_configuration_errors_fail_fast():
+    """Tests that a required component failing because of its configuration isn't retried and fails the startup."""
+    warmup = Warmup(retry_interval=0.01)
+    attempts = []
+
+    @warmup.component("generator")
+    def load_generator():
+        attempts.append(None)
+        raise ValueError("HF_API_KEY is required by the generator")
+
+    warmup.start()
+
+    assert not asyncio.run(warmup.wait(timeout=5.0))
+    assert warmup.has_failed
+    assert warmup.get_status()["status"] == "failed"
+    assert len(attempts) == 1
+
+
+def test_optional_components_do_not_gate_readiness():
+    """Tests that the app is ready without the optional components that failed to load."""
+    warmup = Warmup(retry_interval=0.01)
+
+    @warmup.component("generator")
+    def load_generator():
+        pass
+
+    @warmup.component("reranker", required=False)
+    def load_reranker():
+        raise OSError("unknown-model is not a valid model identifier")
+
+    warmup.start()
+
+    assert asyncio.run(warmup.wait(timeout=5.0))
+    assert warmup.get_status()["components"]["reranker"]["status"] == "failed"